@@ -0,0 +1,348 @@
+import asyncio
+import datetime
+import discord
+import fake
+import json
+import metrics
+import os
+import platform
+import re
+import runner
+import subprocess
+import sys
+import testbot
+import time
+import typing
+
+# Benchmarks of the code which runs on every gateway event, or on every lookup made by a test.
+#
+# Each benchmark is an async function which performs its operation the given number of times.  Benchmarks are run
+# several times and the fastest round is kept, as slower rounds are measuring something other than testbot.
+
+Benchmark = typing.Callable[[int], typing.Coroutine[typing.Any, typing.Any, None]]
+
+# The benchmarks in the order they are run, with the number of operations per round.
+benchmarks: typing.List[typing.Tuple[str, int, Benchmark]] = []
+
+# Results which are slower than the previous run by more than this fraction are reported as regressions.
+regression_threshold = 0.1
+
+results_path = 'bench_results.jsonl'
+
+
+def benchmark(name: str, operations: int) -> typing.Callable[[Benchmark], Benchmark]:
+    '''
+    A function decorator for adding a benchmark.
+    '''
+
+    def decorator(func: Benchmark) -> Benchmark:
+        '''
+        Add the benchmark.
+        '''
+
+        benchmarks.append((name, operations, func))
+
+        return func
+
+    return decorator
+
+
+def build_guild(members: int, channels: int, roles: int) -> typing.Tuple[fake.FakeGuild, fake.FakeMember]:
+    '''
+    Create a fake guild of the given size, with a bot under test.
+
+    Returns the guild and the bot.
+    '''
+
+    guild = fake.FakeGuild('Benchmark')
+
+    for i in range(channels):
+        guild.add_text_channel('channel-' + str(i))
+
+    for i in range(roles):
+        guild.add_role('role-' + str(i))
+
+    for i in range(members):
+        guild.add_member('member-' + str(i), guild.roles[i % roles:i % roles + 1])
+
+    bot = guild.add_member('Bot Under Test')
+    bot.bot = True
+
+    return guild, bot
+
+
+def flood(
+    guild: fake.FakeGuild,
+    author: fake.FakeMember,
+    count: int,
+    embeds: typing.Iterable[discord.Embed] = ()
+) -> typing.List[fake.FakeMessage]:
+    '''
+    Create messages spread over every text channel in the guild.
+    '''
+
+    channels = [c for c in guild.channels if isinstance(c, fake.FakeTextChannel)]
+
+    return [fake.FakeMessage(channels[i % len(channels)], author, 'Message ' + str(i), embeds) for i in range(count)]
+
+
+def define_benchmarks(guild: fake.FakeGuild, bot: fake.FakeMember) -> None:
+    '''
+    Add the benchmarks, which use the given guild and bot.
+    '''
+
+    other = typing.cast(fake.FakeMember, guild.members[0])
+    first_channel = guild.channels[0]
+    last_channel = guild.channels[-1].name
+    last_role = guild.roles[-1].name
+    last_member = guild.members[-2].display_name
+    fields = [{'name': 'Field ' + str(i), 'value': str(i)} for i in range(5)]
+    report = discord.Embed(description='Report')
+
+    for field in fields:
+        report.add_field(name=field['name'], value=field['value'])
+
+    message = fake.FakeMessage(first_channel, bot, 'Message 0', [report])
+
+    # Messages are created up front so that only testbot is timed.
+    from_others = flood(guild, other, 100000)
+    from_bot = flood(guild, bot, 100000)
+
+    async def run_check(check: testbot.CheckFunction, n: int) -> None:
+        '''
+        Call a check n times, ignoring failures.
+        '''
+
+        for _ in range(n):
+            try:
+                await check(message)
+            except Exception:
+                pass
+
+    @benchmark('receive_message from other members', 100000)
+    async def receive_other(n: int) -> None:
+        for m in from_others[:n]:
+            testbot.receive_message(m)
+
+    @benchmark('receive_message from the bot', 100000)
+    async def receive_bot(n: int) -> None:
+        for m in from_bot[:n]:
+            testbot.receive_message(m)
+
+    @benchmark('receive_message with waiters', 100000)
+    async def receive_waiting(n: int) -> None:
+        channels = guild.channels[:10]
+        queues = [(c.id, testbot.add_waiter(c.id)) for c in channels]
+
+        try:
+            for m in from_bot[:n]:
+                testbot.receive_message(m)
+        finally:
+            for key, queue in queues:
+                testbot.remove_waiter(key, queue)
+
+    @benchmark('receive_message with 1000 text waiters', 100000)
+    async def receive_text_waiting(n: int) -> None:
+        texts = [frozenset(['Expected ' + str(i)]) for i in range(1000)]
+        queues = [(t, testbot.add_waiter(first_channel.id, t)) for t in texts]
+
+        try:
+            for m in from_bot[:n]:
+                testbot.receive_message(m)
+        finally:
+            for t, queue in queues:
+                testbot.remove_waiter(first_channel.id, queue, t)
+
+    @benchmark('expect already received', 10000)
+    async def expect_received(n: int) -> None:
+        for m in from_bot[:n]:
+            since = testbot.mark()
+            testbot.receive_message(m)
+
+            if isinstance(m.channel, discord.TextChannel):
+                await testbot.expect(m.channel, testbot.text(m.content), since)
+
+        metrics.reset()
+
+    @benchmark('get_expectation_name', 100000)
+    async def expectation_name(n: int) -> None:
+        check = testbot.embed('Report', *fields)
+
+        for _ in range(n):
+            testbot.get_expectation_name(check)
+
+    @benchmark('text pass', 100000)
+    async def text_pass(n: int) -> None:
+        await run_check(testbot.text('Message 0'), n)
+
+    @benchmark('text fail', 100000)
+    async def text_fail(n: int) -> None:
+        await run_check(testbot.text('Message 1'), n)
+
+    @benchmark('regex pass', 100000)
+    async def regex_pass(n: int) -> None:
+        await run_check(testbot.regex('Message \\d+'), n)
+
+    @benchmark('embed pass', 100000)
+    async def embed_pass(n: int) -> None:
+        await run_check(testbot.embed('Report', *fields), n)
+
+    @benchmark('any of 5, last passes', 100000)
+    async def any_last(n: int) -> None:
+        await run_check(testbot.any(*[testbot.text('Message ' + str(i)) for i in range(4, -1, -1)]), n)
+
+    @benchmark('all of 5', 100000)
+    async def all_pass(n: int) -> None:
+        await run_check(testbot.all(*[testbot.regex('Message.*') for _ in range(5)]), n)
+
+    @benchmark('channel() last of ' + str(len(guild.channels)), 1000)
+    async def channel_lookup(n: int) -> None:
+        for _ in range(n):
+            testbot.channel(last_channel)
+
+    @benchmark('role() last of ' + str(len(guild.roles)), 1000)
+    async def role_lookup(n: int) -> None:
+        for _ in range(n):
+            testbot.role(last_role)
+
+    @benchmark('member() last of ' + str(len(guild.members)), 1000)
+    async def member_lookup(n: int) -> None:
+        for _ in range(n):
+            testbot.member(last_member)
+
+
+async def run_benchmarks(
+    selected: typing.List[typing.Tuple[str, int, Benchmark]],
+    rounds: int
+) -> typing.Dict[str, float]:
+    '''
+    Run each benchmark for the given number of rounds.
+
+    Returns the fastest time per operation of each benchmark, in nanoseconds.
+    '''
+
+    results = {}
+
+    for name, operations, func in selected:
+        best = float('inf')
+
+        for _ in range(rounds):
+            start = time.perf_counter()
+            await func(operations)
+            best = min(best, time.perf_counter() - start)
+
+        results[name] = best / operations * 1e9
+
+    return results
+
+
+def revision() -> str:
+    '''
+    Get the git revision being benchmarked, with "+" appended if there are uncommitted changes.
+    '''
+
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '-uno'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return head.stdout.strip() + ('+' if status.stdout.strip() else '')
+
+
+def load_previous(path: str) -> typing.Dict[str, typing.Tuple[float, str]]:
+    '''
+    Get the most recent stored result of each benchmark, and the revision it was measured at.
+    '''
+
+    previous: typing.Dict[str, typing.Tuple[float, str]] = {}
+
+    if not os.path.exists(path):
+        return previous
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                run = json.loads(line)
+                previous.update((name, (ns, run['revision'])) for name, ns in run['results'].items())
+
+    return previous
+
+
+def compare(
+    results: typing.Dict[str, float],
+    previous: typing.Dict[str, typing.Tuple[float, str]]
+) -> typing.Tuple[str, int]:
+    '''
+    Format the results, with the change since each benchmark was last run.
+
+    Returns the report and the number of regressions.
+    '''
+
+    lines = []
+    regressions = 0
+
+    for name, ns in results.items():
+        line = f'{name:<40} {ns:12.0f} ns/op'
+
+        if name in previous:
+            before, before_revision = previous[name]
+            change = ns / before - 1
+            line += f' {change:+8.1%} since {before_revision}'
+
+            if change > regression_threshold:
+                line += ' REGRESSION'
+                regressions += 1
+
+        lines.append(line)
+
+    return '\n'.join(lines), regressions
+
+
+async def main(members: int, channels: int, rounds: int, path: str, bench_filter: str) -> int:
+    '''
+    Run the benchmarks matching the filter, store the results and report any regressions.
+
+    Returns the number of regressions.
+    '''
+
+    guild, bot = build_guild(members, channels, 100)
+
+    testbot.set_guild(guild)
+    testbot.set_bot(bot)
+    testbot.set_default_channel(guild.channels[0])
+    define_benchmarks(guild, bot)
+
+    # Filter the benchmarks in the same way as "!test" filters tests.
+    selected = [b for b in benchmarks if re.match('.*' + bench_filter + '.*', b[0])]
+    results = await run_benchmarks(selected, rounds)
+
+    report, regressions = compare(results, load_previous(path))
+    print(report)
+
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({
+            'revision': revision(),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'members': len(guild.members),
+            'channels': len(guild.channels),
+            'results': results,
+        }) + '\n')
+
+    return regressions
+
+
+options, bench_filter = runner.parse_arguments(' '.join(sys.argv[1:]))
+
+try:
+    members = int(options.get('members', '10000'))
+    channels = int(options.get('channels', '1000'))
+    rounds = int(options.get('rounds', '5'))
+except ValueError:
+    print('Usage: python -m bench [--members=N] [--channels=N] [--rounds=N] [--output=path] [filter]')
+    exit(1)
+
+regressions = asyncio.run(main(members, channels, rounds, options.get('output', results_path), bench_filter))
+
+exit(1 if regressions else 0)
@@ -0,0 +1,218 @@
+import asyncio
+import discord
+import fake
+import json
+import logging
+import testbot
+import typing
+
+log = logging.getLogger('testbot')
+
+# A cassette is a JSON Lines file.  The first line describes the guild and later lines are events, in the order they
+# were received:
+#
+#   {"type": "guild", "name": ..., "channels": [...], "roles": [...], "members": [...], "me": id, "bot": id,
+#    "default_channel": id}
+#   {"type": "message", "channel": id, "author": id, "content": ..., "embeds": [...]}
+#   {"type": "member", "id": id, "roles": [role ids]}
+#
+# Messages from TestBot are the commands sent by tests, and mark where each response starts.
+
+recording: typing.TextIO | None = None
+
+# The ID of the guild being recorded.  Only one run is recorded at a time.
+recording_guild: int | None = None
+
+
+def start_recording(path: str, guild: discord.Guild, bot: discord.Member, default_channel: discord.TextChannel) -> None:
+    '''
+    Start writing the guild and every event from TestBot and the bot under test to a cassette.
+    '''
+
+    global recording, recording_guild
+
+    members = [guild.me, bot]
+    header = {
+        'type': 'guild',
+        'name': guild.name,
+        'channels': [
+            {'id': c.id, 'name': c.name, 'voice': isinstance(c, discord.VoiceChannel)}
+            for c in guild.channels
+            if isinstance(c, (discord.TextChannel, discord.VoiceChannel))
+        ],
+        'roles': [{'id': r.id, 'name': r.name} for r in guild.roles],
+        'members': [{'id': m.id, 'name': m.display_name, 'roles': [r.id for r in m.roles]} for m in members],
+        'me': guild.me.id,
+        'bot': bot.id,
+        'default_channel': default_channel.id,
+    }
+
+    recording = open(path, 'w', encoding='utf-8')
+    recording_guild = guild.id
+    write(header)
+
+
+def stop_recording() -> None:
+    '''
+    Finish writing the cassette.
+    '''
+
+    global recording, recording_guild
+
+    if recording is not None:
+        recording.close()
+        recording = None
+        recording_guild = None
+
+
+def write(event: typing.Dict[str, typing.Any]) -> None:
+    '''
+    Write an event to the cassette being recorded.
+    '''
+
+    if recording is not None:
+        recording.write(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def record_message(message: discord.Message) -> None:
+    '''
+    Record a message if it was sent by TestBot or the bot under test.
+    '''
+
+    run = testbot.find_run(message.guild)
+
+    if recording is None or message.guild is None or message.guild.id != recording_guild:
+        return
+
+    if run is None or run.bot is None or message.author.id not in (message.guild.me.id, run.bot.id):
+        return
+
+    write({
+        'type': 'message',
+        'channel': message.channel.id,
+        'author': message.author.id,
+        'content': message.content,
+        'embeds': [e.to_dict() for e in message.embeds],
+    })
+
+
+def record_member(member: discord.Member) -> None:
+    '''
+    Record a change to TestBot or the bot under test.
+    '''
+
+    run = testbot.find_run(member.guild)
+
+    if recording is None or member.guild.id != recording_guild or run is None or run.bot is None:
+        return
+
+    if member.id not in (member.guild.me.id, run.bot.id):
+        return
+
+    write({'type': 'member', 'id': member.id, 'roles': [r.id for r in member.roles]})
+
+
+class Player:
+    '''
+    Plays back the responses recorded in a cassette as tests send the same commands.
+    '''
+
+    def __init__(self, events: typing.List[typing.Dict[str, typing.Any]], guild: fake.FakeGuild) -> None:
+        self.events = events
+        self.position = 0
+        self.guild = guild
+
+    def is_command(self, event: typing.Dict[str, typing.Any]) -> bool:
+        '''
+        Check whether an event is a message sent by TestBot.
+        '''
+
+        return event['type'] == 'message' and event['author'] == self.guild.me.id
+
+    def sent(self, channel: fake.FakeTextChannel, message: fake.FakeMessage) -> None:
+        '''
+        Play back the events which followed the same message when the cassette was recorded.
+
+        Messages which were not recorded get no response.  Recorded commands which are skipped over, and their
+        responses, are never played.
+        '''
+
+        for i in range(self.position, len(self.events)):
+            event = self.events[i]
+
+            if self.is_command(event) and event['channel'] == channel.id and event['content'] == message.content:
+                break
+        else:
+            log.warning('The cassette has no recording of sending "' + message.content + '" to #' + channel.name)
+            return
+
+        self.position = i + 1
+        loop = asyncio.get_running_loop()
+
+        while self.position < len(self.events) and not self.is_command(self.events[self.position]):
+            loop.call_soon(self.play, self.events[self.position])
+            self.position += 1
+
+    def play(self, event: typing.Dict[str, typing.Any]) -> None:
+        '''
+        Pass a recorded event to testbot as if it had just been received.
+        '''
+
+        if event['type'] == 'message':
+            channel = discord.utils.get(self.guild.channels, id=event['channel'])
+            author = discord.utils.get(self.guild.members, id=event['author'])
+
+            if isinstance(channel, fake.FakeTextChannel) and isinstance(author, fake.FakeMember):
+                embeds = [discord.Embed.from_dict(e) for e in event['embeds']]
+                testbot.receive_message(fake.FakeMessage(channel, author, event['content'], embeds))
+        elif event['type'] == 'member':
+            member = discord.utils.get(self.guild.members, id=event['id'])
+
+            if isinstance(member, fake.FakeMember):
+                member.set_roles(r for r in self.guild.roles if r.id in event['roles'])
+
+
+def load(path: str) -> typing.Tuple[fake.FakeGuild, fake.FakeMember, fake.FakeTextChannel]:
+    '''
+    Build a fake guild from a cassette which plays back the recorded responses.
+
+    Returns the guild, the bot under test and the channel from which the tests were run.
+    '''
+
+    with open(path, encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+
+    if not lines or lines[0]['type'] != 'guild':
+        raise Exception('Not a cassette: ' + path)
+
+    header = lines[0]
+    guild = fake.FakeGuild(header['name'], id=1)
+    guild.members.clear()
+
+    for c in header['channels']:
+        if c['voice']:
+            guild.add_voice_channel(c['name'], c['id'])
+        else:
+            guild.add_text_channel(c['name'], c['id'])
+
+    for r in header['roles']:
+        guild.add_role(r['name'], r['id'])
+
+    for m in header['members']:
+        guild.add_member(m['name'], [r for r in guild.roles if r.id in m['roles']], m['id'])
+
+    me = discord.utils.get(guild.members, id=header['me'])
+    bot = discord.utils.get(guild.members, id=header['bot'])
+    default_channel = discord.utils.get(guild.channels, id=header['default_channel'])
+
+    if not isinstance(me, fake.FakeMember) or not isinstance(bot, fake.FakeMember):
+        raise Exception('The cassette does not describe TestBot and the bot under test')
+
+    if not isinstance(default_channel, fake.FakeTextChannel):
+        raise Exception('The cassette does not describe the channel the tests were run from')
+
+    guild.me = me
+    bot.bot = True
+    guild.on_send = Player(lines[1:], guild).sent
+
+    return guild, bot, default_channel
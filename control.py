@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import os
+import runner
+import stat
+import sys
+import typing
+
+log = logging.getLogger('testbot')
+
+# Runs can be requested over a Unix socket, so that many runs share one connection to Discord.
+#
+# A client sends one line of JSON, such as:
+#
+#   {"filter": "battery", "channel": 1234, "concurrency": 4, "timeout": 15, "deadline": 600, "format": "jsonl",
+#    "results": "results/ci", "order": "fail-fast"}
+#
+# Every field is optional.  Instead of a filter, "tests" may list the names of the tests to run.  The server replies
+# with one line per event, as JSON if the format is "jsonl" or as text if it is "text", and closes the connection after
+# the last event:
+#
+#   {"type": "progress", "message": "Running test_battery.test_drain_energize..."}
+#   {"type": "test", "name": ..., "passed": true, "started": ..., "duration": 1.2, "failures": [], "messages": [...]}
+#   {"type": "failure", "name": ..., "description": ...}
+#   {"type": "summary", "tests": 2, "failures": 0, "not_run": 0, "deadline_reached": false, "duration": 12.3}
+#   {"type": "error", "message": ...}
+#   {"type": "exit", "status": 0}
+#
+# A "test" event is sent as each test finishes, and the results are also written to files as described in results.py.
+# The exit status is 0 if every test passed, 1 if any failed and 2 if the tests could not be run.
+
+Event = typing.Dict[str, typing.Any]
+
+# Sends an event to the client.
+EventSender = typing.Callable[[Event], typing.Awaitable[None]]
+
+# Runs the tests for a request, sending events as it goes, and returns the exit status.
+RequestHandler = typing.Callable[[Event, EventSender], typing.Awaitable[int]]
+
+formats = ('jsonl', 'text')
+
+
+def format_event(event: Event, output_format: str) -> str:
+    '''
+    Format an event as one line.
+    '''
+
+    if output_format == 'jsonl':
+        return json.dumps(event, ensure_ascii=False)
+
+    if event['type'] == 'test':
+        return ('ok ' if event['passed'] else 'failed ') + event['name'] + f' ({event["duration"]:.2f}s)'
+
+    if event['type'] == 'failure':
+        return 'FAIL ' + event['name'] + ': ' + event['description']
+
+    if event['type'] == 'summary':
+        return f'{event["tests"]} tests, {event["failures"]} failures in {event["duration"]:.2f} seconds'
+
+    if event['type'] == 'error':
+        return 'ERROR: ' + event['message']
+
+    if event['type'] == 'exit':
+        return 'Exit status: ' + str(event['status'])
+
+    return str(event.get('message', ''))
+
+
+async def serve(path: str, handler: RequestHandler) -> asyncio.AbstractServer:
+    '''
+    Start accepting requests on a Unix socket.
+
+    Only the user running TestBot may connect.  Raises a FileExistsError if something other than a socket is at the
+    path.
+    '''
+
+    async def connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Handle one request.
+        '''
+
+        output_format = 'jsonl'
+        connected = True
+
+        async def send(event: Event) -> None:
+            '''
+            Send an event, unless the client has gone away.  The run carries on without it.
+            '''
+
+            nonlocal connected
+
+            if not connected:
+                return
+
+            try:
+                writer.write((format_event(event, output_format) + '\n').encode())
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+        line = await reader.readline()
+
+        # The client was checking that the server is listening.
+        if not line.strip():
+            writer.close()
+            return
+
+        try:
+            request = json.loads(line)
+
+            if not isinstance(request, dict):
+                raise ValueError('The request must be a JSON object')
+
+            output_format = request.get('format', 'jsonl')
+
+            if output_format not in formats:
+                output_format = 'jsonl'
+                raise ValueError('The format must be one of ' + ', '.join(formats))
+
+            log.info('Control request: ' + json.dumps(request))
+            status = await handler(request, send)
+        except ValueError as e:
+            await send({'type': 'error', 'message': str(e)})
+            status = 2
+
+        await send({'type': 'exit', 'status': status})
+        writer.close()
+
+    # Replace a socket left behind by an earlier server, but never another kind of file.
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError(path + ' already exists and is not a socket')
+
+        os.remove(path)
+
+    # Create the socket without access for other users, so that they cannot connect before its mode is set.
+    umask = os.umask(0o177)
+
+    try:
+        server = await asyncio.start_unix_server(connection, path)
+    finally:
+        os.umask(umask)
+
+    os.chmod(path, 0o600)
+    log.info('Listening for run requests on ' + path)
+
+    return server
+
+
+async def is_listening(path: str) -> bool:
+    '''
+    Check whether a server is accepting requests on a socket.
+    '''
+
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except OSError:
+        return False
+
+    writer.close()
+
+    return True
+
+
+async def request_events(path: str, request: Event) -> typing.AsyncIterator[Event]:
+    '''
+    Ask the server to run tests, and yield the events as they arrive, ending with the exit event.
+    '''
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write((json.dumps({**request, 'format': 'jsonl'}) + '\n').encode())
+    await writer.drain()
+
+    try:
+        async for line in reader:
+            yield json.loads(line)
+    finally:
+        writer.close()
+
+
+async def request_run(path: str, request: Event) -> int:
+    '''
+    Ask the server to run tests, print the events as they arrive, and return the exit status.
+    '''
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write((json.dumps(request) + '\n').encode())
+    await writer.drain()
+    status = 2
+
+    async for line in reader:
+        text = line.decode().rstrip('\n')
+        print(text, flush=True)
+
+        if request.get('format', 'jsonl') == 'jsonl':
+            event = json.loads(text)
+
+            if event['type'] == 'exit':
+                status = event['status']
+        elif text.startswith('Exit status: '):
+            status = int(text[len('Exit status: '):])
+
+    writer.close()
+
+    return status
+
+
+if __name__ == '__main__':
+    options, test_filter = runner.parse_arguments(' '.join(sys.argv[2:]))
+
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(
+            'Usage: python -m control <socket> [--channel=ID] [--concurrency=N] [--timeout=S] [--deadline=S]'
+            ' [--format=jsonl|text] [--results=path]'
+            ' [--order=found|fail-fast|longest-first] [filter]'
+        )
+        exit(2)
+
+    run_request: Event = {'filter': test_filter, **options}
+
+    try:
+        exit(asyncio.run(request_run(sys.argv[1], run_request)))
+    except OSError as e:
+        print('Could not connect to TestBot: ' + str(e))
+        exit(2)
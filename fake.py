@@ -0,0 +1,405 @@
+import asyncio
+import copy
+import datetime
+import discord
+import random
+import re
+import testbot
+import typing
+
+# Stand-ins for the py-cord objects used by tests, which work without a connection to Discord.
+#
+# They are subclasses of the real classes so that isinstance() checks in testbot still pass, but only have the
+# attributes that testbot and the tests use.  Class attributes shadow py-cord's properties so that each instance can
+# set its own values.
+
+last_snowflake = 0
+
+# Called with the channel and the message when TestBot sends a message to a fake channel.
+SendHook = typing.Callable[['FakeTextChannel', 'FakeMessage'], None]
+
+# Called with the member when TestBot changes a fake member's roles.
+RolesHook = typing.Callable[['FakeMember'], None]
+
+# Called with the bot, the message and the regular expression match when a FakeBot receives a command.
+CommandHandler = typing.Callable[['FakeBot', 'FakeMessage', re.Match], None]
+
+
+def snowflake() -> int:
+    '''
+    Generate a unique Discord ID for the current time.
+    '''
+
+    global last_snowflake
+
+    last_snowflake = max(discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc)), last_snowflake + 1)
+
+    return last_snowflake
+
+
+class FakeRole(discord.Role):
+    id = 0
+    name = ''
+
+    def __init__(self, name: str, id: int = 0) -> None:
+        self.id = id or snowflake()
+        self.name = name
+
+
+class FakeMember(discord.Member):
+    id = 0
+    name = ''
+    display_name = ''
+    mention = ''
+    bot = False
+    roles: typing.List[discord.Role] = []
+    guild: 'FakeGuild'
+
+    def __init__(self, guild: 'FakeGuild', name: str, roles: typing.Iterable[discord.Role] = (), id: int = 0) -> None:
+        self.id = id or snowflake()
+        self.name = name
+        self.display_name = name
+        self.mention = '<@' + str(self.id) + '>'
+        self.roles = list(roles)
+        self.guild = guild
+
+    def __repr__(self) -> str:
+        return '<FakeMember id=' + str(self.id) + ' name=' + repr(self.name) + '>'
+
+    def __str__(self) -> str:
+        return self.display_name
+
+    def snapshot(self) -> 'FakeMember':
+        '''
+        Copy the member, as py-cord does when passing the new state of a member to on_member_update.
+        '''
+
+        copy = FakeMember(self.guild, self.name, self.roles, self.id)
+        copy.bot = self.bot
+
+        return copy
+
+    def set_roles(self, roles: typing.Iterable[discord.Role]) -> None:
+        '''
+        Replace the member's roles and send a member update event, as Discord would.
+        '''
+
+        self.roles = list(roles)
+        asyncio.get_running_loop().call_soon(testbot.member_update, self.snapshot())
+
+    async def add_roles(self, *roles: discord.abc.Snowflake, reason: str | None = None, atomic: bool = True) -> None:
+        self.set_roles(self.roles + [r for r in roles if isinstance(r, discord.Role) and r not in self.roles])
+
+        if self.guild.on_roles is not None:
+            self.guild.on_roles(self)
+
+    async def remove_roles(
+        self,
+        *roles: discord.abc.Snowflake,
+        reason: str | None = None,
+        atomic: bool = True
+    ) -> None:
+        self.set_roles([r for r in self.roles if r not in roles])
+
+        if self.guild.on_roles is not None:
+            self.guild.on_roles(self)
+
+    async def edit(  # type: ignore[override]
+        self,
+        *,
+        roles: typing.Iterable[discord.abc.Snowflake] | None = None,
+        **kwargs: typing.Any
+    ) -> None:
+        if roles is not None:
+            self.set_roles(r for r in roles if isinstance(r, discord.Role))
+
+            if self.guild.on_roles is not None:
+                self.guild.on_roles(self)
+
+
+class FakeMessage(discord.Message):
+    def __init__(
+        self,
+        channel: 'FakeTextChannel',
+        author: FakeMember,
+        content: str = '',
+        embeds: typing.Iterable[discord.Embed] = (),
+        id: int = 0
+    ) -> None:
+        self.id = id or snowflake()
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = list(embeds)
+        self.guild = channel.guild
+
+    def __repr__(self) -> str:
+        return '<FakeMessage id=' + str(self.id) + ' content=' + repr(self.content) + '>'
+
+
+class FakeReaction(discord.Reaction):
+    def __init__(self, message: FakeMessage, emoji: str) -> None:
+        self.message = message
+        self.emoji = emoji
+
+    def __repr__(self) -> str:
+        return '<FakeReaction emoji=' + repr(self.emoji) + '>'
+
+
+class FakeTextChannel(discord.TextChannel):
+    id = 0
+    name = ''
+    guild: 'FakeGuild'
+
+    def __init__(self, guild: 'FakeGuild', name: str, id: int = 0) -> None:
+        self.id = id or snowflake()
+        self.name = name
+        self.guild = guild
+
+    def __repr__(self) -> str:
+        return '<FakeTextChannel id=' + str(self.id) + ' name=' + repr(self.name) + '>'
+
+    async def send(  # type: ignore[override]
+        self,
+        content: str | None = None,
+        *,
+        embed: discord.Embed | None = None,
+        **kwargs: typing.Any
+    ) -> FakeMessage:
+        '''
+        Send a message from TestBot.
+
+        The message is passed back to testbot as Discord would, and then to the guild's send hook.
+        '''
+
+        message = FakeMessage(self, self.guild.me, content or '', [embed] if embed is not None else [])
+        asyncio.get_running_loop().call_soon(testbot.receive_message, message)
+
+        if self.guild.on_send is not None:
+            self.guild.on_send(self, message)
+
+        return message
+
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    id = 0
+    name = ''
+    guild: 'FakeGuild'
+
+    def __init__(self, guild: 'FakeGuild', name: str, id: int = 0) -> None:
+        self.id = id or snowflake()
+        self.name = name
+        self.guild = guild
+
+    def __repr__(self) -> str:
+        return '<FakeVoiceChannel id=' + str(self.id) + ' name=' + repr(self.name) + '>'
+
+
+class FakeGuild(discord.Guild):
+    id = 0
+    name = ''
+    channels: typing.List[typing.Any] = []
+    roles: typing.List[discord.Role] = []
+    members: typing.List[discord.Member] = []
+    me = typing.cast(FakeMember, None)
+
+    def __init__(self, name: str = 'TestBot Guild', me: str = 'TestBot', id: int = 0) -> None:
+        self.id = id or snowflake()
+        self.name = name
+        self.channels = []
+        self.roles = []
+        self.members = []
+        self.me = self.add_member(me)
+        self.on_send: SendHook | None = None
+        self.on_roles: RolesHook | None = None
+
+    def __repr__(self) -> str:
+        return '<FakeGuild id=' + str(self.id) + ' name=' + repr(self.name) + '>'
+
+    def add_text_channel(self, name: str, id: int = 0) -> FakeTextChannel:
+        '''
+        Create a text channel.
+        '''
+
+        channel = FakeTextChannel(self, name, id)
+        self.channels.append(channel)
+
+        return channel
+
+    def add_voice_channel(self, name: str, id: int = 0) -> FakeVoiceChannel:
+        '''
+        Create a voice channel.
+        '''
+
+        channel = FakeVoiceChannel(self, name, id)
+        self.channels.append(channel)
+
+        return channel
+
+    def add_role(self, name: str, id: int = 0) -> FakeRole:
+        '''
+        Create a role.
+        '''
+
+        role = FakeRole(name, id)
+        self.roles.append(role)
+
+        return role
+
+    def add_member(self, name: str, roles: typing.Iterable[discord.Role] = (), id: int = 0) -> FakeMember:
+        '''
+        Create a member.
+        '''
+
+        member = FakeMember(self, name, roles, id)
+        self.members.append(member)
+
+        return member
+
+    async def query_members(
+        self,
+        query: str | None = None,
+        *,
+        limit: int | None = 5,
+        user_ids: typing.List[int] | None = None,
+        presences: bool = False,
+        cache: bool = True
+    ) -> typing.List[discord.Member]:
+        '''
+        Find the members whose name starts with the query, or who have one of the IDs, as Discord does.
+
+        Every member of a fake guild is already cached.
+        '''
+
+        found = [
+            m for m in self.members
+            if (query is not None and m.name.startswith(query)) or (user_ids is not None and m.id in user_ids)
+        ]
+
+        return found[:limit]
+
+
+class FakeBot:
+    '''
+    A scriptable stand-in for the bot under test.
+
+    Commands are regular expressions which are matched against the whole of each message that TestBot sends.
+    The first matching command's handler is called, and can respond with say() and set_roles().
+
+    Responses are delayed by the latency, plus or minus a random amount up to the jitter, but are always delivered in
+    the order that they were made.
+    '''
+
+    def __init__(self, guild: FakeGuild, name: str, latency: float = 0.0, jitter: float = 0.0) -> None:
+        self.guild = guild
+        self.member = guild.add_member(name)
+        self.member.bot = True
+        self.latency = latency
+        self.jitter = jitter
+        self.commands: typing.List[typing.Tuple[re.Pattern, str | None, CommandHandler]] = []
+        self.next_delivery = 0.0
+        guild.on_send = self.receive
+
+    def command(self, pattern: str, channel: str | None = None) -> typing.Callable[[CommandHandler], CommandHandler]:
+        '''
+        A function decorator for adding a command handler.
+
+        If a channel name is given then the command is only handled in that channel.
+        '''
+
+        def decorator(handler: CommandHandler) -> CommandHandler:
+            '''
+            Add the handler.
+            '''
+
+            self.commands.append((re.compile(pattern, re.DOTALL), channel, handler))
+
+            return handler
+
+        return decorator
+
+    def receive(self, channel: FakeTextChannel, message: FakeMessage) -> None:
+        '''
+        Handle a message sent by TestBot.
+        '''
+
+        for pattern, channel_name, handler in self.commands:
+            if channel_name is not None and channel_name != channel.name:
+                continue
+
+            match = pattern.fullmatch(message.content)
+
+            if match:
+                handler(self, message, match)
+                return
+
+    def later(self, callback: typing.Callable[..., None], *args: typing.Any) -> None:
+        '''
+        Call a function after the bot's response time.
+        '''
+
+        loop = asyncio.get_running_loop()
+        delay = max(self.latency + random.uniform(-self.jitter, self.jitter), 0)
+        # Timers due at the same time may run in any order, so keep them a microsecond apart.
+        self.next_delivery = max(loop.time() + delay, self.next_delivery + 0.000001)
+        loop.call_at(self.next_delivery, callback, *args)
+
+    def say(self, channel: FakeTextChannel, content: str = '', embed: discord.Embed | None = None) -> FakeMessage:
+        '''
+        Send a message from the bot.
+
+        Returns the message, which can be edited, deleted or reacted to later.
+        '''
+
+        message = FakeMessage(channel, self.member, content, [embed] if embed is not None else [])
+        self.later(testbot.receive_message, message)
+
+        return message
+
+    def edit(self, message: FakeMessage, content: str) -> None:
+        '''
+        Change the content of one of the bot's messages.
+        '''
+
+        def update() -> None:
+            '''
+            Change the content.
+            '''
+
+            before = copy.copy(message)
+            message.content = content
+            testbot.message_edit(before, message)
+
+        self.later(update)
+
+    def delete(self, message: FakeMessage) -> None:
+        '''
+        Delete a message.
+        '''
+
+        self.later(testbot.message_delete, message)
+
+    def react(self, message: FakeMessage, emoji: str) -> None:
+        '''
+        React to a message as the bot.
+        '''
+
+        self.later(testbot.reaction_change, 'reaction_add', FakeReaction(message, emoji), self.member)
+
+    def set_roles(self, member: FakeMember, add: typing.Iterable[str] = (), remove: typing.Iterable[str] = ()) -> None:
+        '''
+        Add and remove roles from a member by name.
+        '''
+
+        added = [r for r in self.guild.roles if r.name in add]
+        removed = [r.name for r in self.guild.roles if r.name in remove]
+
+        def update() -> None:
+            '''
+            Change the roles.
+            '''
+
+            kept = [r for r in member.roles if r.name not in removed]
+            member.set_roles(kept + [r for r in added if r not in kept])
+
+        self.later(update)
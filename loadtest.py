@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import metrics
+import ratelimit
+import runner
+import testbot
+import typing
+
+log = logging.getLogger('testbot')
+
+# The most tests which may be running or waiting for their turn at once when generating load at a fixed rate.
+max_in_flight = 100
+
+
+async def run_load(
+    functions: typing.List[testbot.TestFunction],
+    default_channel: str,
+    duration: float,
+    rate: float | None,
+    concurrency: int
+) -> str:
+    '''
+    Run the tests over and over for the given number of seconds, and return a report.
+
+    If a rate is given then tests are started at that many per second, taking each test in turn.
+    Otherwise "concurrency" tests are run at a time, each starting as soon as the last one finishes.
+
+    Tests are scheduled as runner.run_tests() schedules them, so tests which share channels, resources or role states
+    are not run at the same time, and each is run with runner.run_test_body().  Function fixtures are torn down after
+    each test, and module fixtures after the last of the module's tests which are waiting or running, as
+    runner.run_tests() does.  Session fixtures are torn down at the end.
+
+    When Discord rate limits TestBot the rate is halved, and then raised back towards the target.
+
+    default_channel: The name of the channel that tests get from text_channel() with no name.
+
+    Raises a ValueError if the rate is not more than 0.
+    '''
+
+    if rate is not None and rate <= 0:
+        raise ValueError('The rate must be more than 0, found ' + str(rate))
+
+    monitor = ratelimit.watch_rate_limits()
+    limited_before = monitor.count
+    loop = asyncio.get_running_loop()
+    outcomes = {'passed': 0, 'timed out': 0, 'failed': 0, 'skipped': 0}
+    ordered = runner.group_by_role_state(functions)
+    start = loop.time()
+    end = start + duration
+    current_rate = rate or 0.0
+
+    metrics.reset()
+
+    async def iteration(test: testbot.TestFunction) -> None:
+        '''
+        Run one test and record the outcome.
+        '''
+
+        metrics.current_test.set(test.__name__)
+
+        try:
+            # Tests which were waiting for their turn when the time ran out are not run.
+            if loop.time() < end:
+                await monitor.wait()
+                await runner.run_test_body(test)
+                outcomes['passed'] += 1
+        except Exception as e:
+            # Tests which run out of time, and expectations which see no matching response, raise TimeoutErrors.
+            outcome = 'timed out' if isinstance(e, TimeoutError) or isinstance(e.__cause__, TimeoutError) else 'failed'
+            outcomes[outcome] += 1
+            log.debug('Load test iteration ' + outcome + ': ' + str(e))
+        finally:
+            errors = await testbot.teardown_fixtures('function')
+
+            if scheduler.last_in_module(test):
+                errors += await testbot.teardown_fixtures('module', test.__module__)
+
+            for error in errors:
+                log.warning(error)
+
+    try:
+        if rate is None:
+            while loop.time() < end:
+                scheduler = runner.Scheduler(default_channel, concurrency, iteration)
+
+                for function in ordered:
+                    scheduler.add(function)
+
+                scheduler.close()
+                await scheduler.run()
+        else:
+            scheduler = runner.Scheduler(default_channel, max_in_flight, iteration)
+
+            async with asyncio.TaskGroup() as group:
+                group.create_task(scheduler.run())
+
+                try:
+                    n = 0
+                    next_start = start
+                    rate_limits = monitor.count
+
+                    while next_start < end:
+                        await asyncio.sleep(max(next_start - loop.time(), 0))
+
+                        if monitor.count > rate_limits:
+                            # Back off quickly, then recover slowly.
+                            rate_limits = monitor.count
+                            current_rate = max(current_rate / 2, rate / 16)
+                            await monitor.wait()
+                            next_start = loop.time()
+                        else:
+                            current_rate = min(current_rate * 1.05, rate)
+
+                        if scheduler.running + len(scheduler.pending) < max_in_flight:
+                            scheduler.add(ordered[n % len(ordered)])
+                            n += 1
+                        else:
+                            outcomes['skipped'] += 1
+
+                        next_start += 1 / current_rate
+                finally:
+                    scheduler.close()
+    finally:
+        for module in sorted({f.__module__ for f in functions}):
+            for error in await testbot.teardown_fixtures('module', module):
+                log.warning(error)
+
+        for error in await testbot.teardown_fixtures('session'):
+            log.warning(error)
+
+    elapsed = loop.time() - start
+    total = sum(outcomes.values())
+
+    # With a duration of 0 nothing may have run, and no time may have passed to divide by.
+    throughput = f'{outcomes["passed"] / elapsed:.2f}/s' if elapsed > 0 and outcomes['passed'] else 'none'
+
+    lines = [
+        f'Load test of {len(functions)} tests over {elapsed:.1f}s',
+        f'iterations={total} ' + ' '.join(k.replace(' ', '-') + '=' + str(v) for k, v in outcomes.items()),
+        f'throughput={throughput} rate-limited={monitor.count - limited_before}',
+    ]
+
+    if rate is not None:
+        lines[-1] += f' target-rate={rate:.2f}/s final-rate={current_rate:.2f}/s'
+
+    lines.append(metrics.report(('test', 'reply', 'expect', 'send', 'queue', 'limited')))
+
+    return '\n'.join(lines)
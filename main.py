@@ -1,175 +1,567 @@
 import asyncio
+import cassette
+import control
 import discord
-import glob
-import importlib
-import inspect
+import functools
+import loadtest
 import logging
-import re
+import metrics
+import ratelimit
+import resource
+import results
+import runner
 import sys
 import time
 import typing
-from testbot import (find_bot, get_total_expectations, member_update,
-                     receive_message, set_bot, set_default_channel, set_guild)
+from testbot import (TestFunction, active_runs, fetch_members, find_run, get_bot, get_total_expectations, guild,
+                     index_add, index_remove, member, member_update, message_delete, message_edit, reaction_change,
+                     receive_message, send, set_bot, set_default_channel, set_guild, set_default_timeout,
+                     set_inbox_capacity, text_channel)
 
-# Test functions are async, take no parameters, and return None.
-TestFunction = typing.Callable[[], typing.Coroutine[typing.Any, typing.Any, None]]
+# When the process started, for logging how long it took to connect.
+process_start = time.monotonic()
+
+# Options given on the command line after the token.
+startup_options, _ = runner.parse_arguments(' '.join(sys.argv[2:]))
 
 intents = discord.Intents.default()
 intents.members = True
 intents.reactions = True
 intents.message_content = True
 
-bot = discord.Bot(intents=intents, guild_subscriptions=True)
+# With --lean, members are not all fetched when TestBot connects.  The members which are needed, TestBot, the bot under
+# test and the members named by tests, are fetched by name.  Members are still cached when they join, are fetched, or
+# first change, so that member updates are passed on for them, but not because of voice states or interactions.
+lean = 'lean' in startup_options
+member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+if lean:
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.joined = True
+
+bot = discord.Bot(
+    intents=intents,
+    guild_subscriptions=True,
+    chunk_guilds_at_startup=not lean,
+    member_cache_flags=member_cache_flags
+)
 
 log = logging.getLogger('testbot')
-tests: typing.List[TestFunction] = []
 
+# The server for run requests on the control socket, once started.
+control_server: asyncio.AbstractServer | None = None
 
-def find_tests() -> typing.List[TestFunction]:
-    '''
-    Find all the test functions.
+# The most failures listed in the result embed, and the most characters of each.  Discord limits embeds to 25 fields
+# and 6000 characters, so the full results are only in the result files.
+max_failure_fields = 10
+max_failure_length = 400
 
-    Test functions must be in the 'tests' directory and start with 'test_'.
 
-    Returns a list of functions.
-    '''
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member) -> None:
+    cassette.record_member(after)
+    index_remove('member', before)
+    index_add('member', after)
+    member_update(after)
 
-    functions: typing.List[TestFunction] = []
-    paths = sorted(glob.glob('./tests/test*.py'))
 
-    for path in paths:
-        module_name_match = re.match('./tests/(.*)\\.py', path)
+@bot.event
+async def on_member_join(joined: discord.Member) -> None:
+    index_add('member', joined)
 
-        if not module_name_match:
-            continue
 
-        module_name = module_name_match.group(1)
+@bot.event
+async def on_member_remove(removed: discord.Member) -> None:
+    index_remove('member', removed)
 
-        module = importlib.import_module('tests.' + module_name)
-        members = inspect.getmembers(module, inspect.isfunction)
-        module_functions = [f[1] for f in members if f[0].startswith('test_')]
 
-        for function in module_functions:
-            function.__name__ = module_name + '.' + function.__name__
+@bot.event
+async def on_message_edit(before: discord.Message, after: discord.Message) -> None:
+    message_edit(before, after)
 
-        functions.extend(module_functions)
 
-    return functions
+@bot.event
+async def on_message_delete(message: discord.Message) -> None:
+    message_delete(message)
 
 
 @bot.event
-async def on_member_update(before: discord.Member, after: discord.Member) -> None:
-    member_update(after)
+async def on_reaction_add(reaction: discord.Reaction, user: discord.Member | discord.User) -> None:
+    reaction_change('reaction_add', reaction, user)
 
 
 @bot.event
-async def on_message(message: discord.Message) -> None:
+async def on_reaction_remove(reaction: discord.Reaction, user: discord.Member | discord.User) -> None:
+    reaction_change('reaction_remove', reaction, user)
+
+
+@bot.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel) -> None:
+    index_add('channel', channel)
+
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel) -> None:
+    index_remove('channel', before)
+    index_add('channel', after)
+
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel) -> None:
+    index_remove('channel', channel)
+
+
+@bot.event
+async def on_guild_role_create(role: discord.Role) -> None:
+    index_add('role', role)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role) -> None:
+    index_remove('role', before)
+    index_add('role', after)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role) -> None:
+    index_remove('role', role)
+
+
+async def begin_run(channel: discord.TextChannel) -> str | None:
     '''
-    Handle an incoming message.
+    Find the bot under test and start a run in a channel, for the current task.
+
+    Runs can happen in several guilds at once, but only one at a time in each guild.
+
+    Returns the reason if a run cannot be started, or None.
     '''
 
-    # Process messages from the bot under test.
-    if find_bot():
-        receive_message(message)
+    if find_run(channel.guild) is not None:
+        return 'A test is already in progress'
 
-    # Process the command to run the test suite.
-    if message.content.startswith('!test'):
-        if message.guild is None:
-            await message.author.send('This command cannot be used in DM')
+    set_guild(channel.guild)
+
+    # Find the bot to test.
+    bot_name = 'HexCorp Mxtress AI Dev'
+
+    try:
+        await fetch_members([bot_name])
+        bot_under_test = member(bot_name)
+    except Exception as e:
+        set_guild(None)
+        log.error('Failed to find bot ' + bot_name + ': ' + str(e))
+        return 'Cannot find bot to test: ' + str(e)
+
+    set_bot(bot_under_test)
+    set_default_channel(channel)
+
+    return None
+
+
+async def start_run(message: discord.Message) -> bool:
+    '''
+    Find the bot under test and set the current guild and channel for a run started by a message.
+
+    Returns False, having replied to the message, if a run cannot be started.
+    '''
+
+    if message.guild is None:
+        await message.author.send('This command cannot be used in DM')
+        return False
+
+    if not isinstance(message.channel, discord.TextChannel):
+        await message.author.send('This command can only be used in a text channel')
+        return False
+
+    if find_run(message.guild) is not None:
+        await message.channel.send('A test is already in progress')
+        return False
+
+    error = await begin_run(message.channel)
+
+    if error is not None:
+        await message.author.send(error)
+        return False
+
+    return True
+
+
+def end_run() -> None:
+    '''
+    Clear the bot under test and end the current task's run.
+    '''
+
+    set_bot(None)
+    set_guild(None)
+
+
+async def run_suite(message: discord.Message, arguments: str) -> None:
+    '''
+    Run the test suite in response to a "!test" command.
+    '''
+
+    options, test_filter = runner.parse_arguments(arguments)
+
+    try:
+        concurrency = int(options.get('concurrency', '1'))
+        inbox_capacity = int(options.get('inbox', '50'))
+        expect_timeout = float(options.get('timeout', '15'))
+        deadline = float(options['deadline']) if 'deadline' in options else None
+    except ValueError:
+        await message.channel.send('The concurrency, inbox, timeout and deadline options must be numbers')
+        return
+
+    if options.get('order', 'found') not in runner.orders:
+        await message.channel.send('The order option must be one of ' + ', '.join(runner.orders))
+        return
+
+    if 'record' in options and cassette.recording is not None:
+        await message.channel.send('Another run is already being recorded')
+        return
+
+    if not await start_run(message):
+        return
+
+    try:
+        try:
+            set_inbox_capacity(inbox_capacity)
+        except ValueError as e:
+            await message.channel.send(str(e))
             return
 
-        if not isinstance(message.channel, discord.TextChannel):
-            await message.author.send('This command can only be used in a text channel')
+        set_default_timeout(expect_timeout)
+
+        if 'record' in options:
+            cassette.start_recording(options['record'], guild(), get_bot(), text_channel())
+
+        await run_filtered_tests(text_channel(), options, test_filter, concurrency, deadline)
+    finally:
+        cassette.stop_recording()
+        end_run()
+
+
+async def load_tests(channel: discord.TextChannel, test_filter: str) -> typing.List[TestFunction] | None:
+    '''
+    Import the tests matching the filter, first reloading any test modules which have changed.
+
+    Returns None, having posted the error, if they could not be imported.
+    '''
+
+    try:
+        reloaded = runner.reload_changed()
+
+        if reloaded:
+            await send(channel, 'Reloaded ' + ', '.join(reloaded))
+
+        return runner.find_tests(test_filter)
+    except Exception as e:
+        log.exception('Failed to load tests')
+        await send(channel, 'Failed to load tests: ' + str(e))
+        return None
+
+
+async def run_filtered_tests(
+    channel: discord.TextChannel,
+    options: typing.Dict[str, str],
+    test_filter: str,
+    concurrency: int,
+    deadline: float | None
+) -> None:
+    '''
+    Run the tests matching the filter and post the results.
+    '''
+
+    filtered_tests = await load_tests(channel, test_filter)
+
+    if filtered_tests is None:
+        return
+
+    path = options.get('results') or results.default_path(channel.id)
+
+    with results.ResultWriter(path, len(filtered_tests)) as writer:
+        result = await runner.run_tests(
+            filtered_tests,
+            channel.name,
+            concurrency,
+            deadline,
+            functools.partial(send, channel),
+            writer.write,
+            options.get('order', 'found')
+        )
+        writer.close(len(filtered_tests), result)
+
+    failures = result.failures
+
+    description = (
+        'Checked **'
+        + str(get_total_expectations())
+        + '** expectations with **'
+        + str(len(failures))
+        + '** failures'
+    )
+
+    colour = discord.Color.red() if len(failures) else discord.Color.green()
+
+    if result.deadline_reached:
+        description += '\n\nSuite deadline reached, **' + str(result.not_run) + '** tests were not run'
+
+    log.info(runner.describe_transitions(result))
+
+    if result.transitions_saved:
+        description += f'\n\nGrouped tests by role, saving **{result.transitions_saved}** role changes'
+        description += f' and about **{result.seconds_saved:.1f}** seconds'
+
+    if len(failures):
+        description += '\n\n❌ **FAILURE**'
+    else:
+        description += '\n\n✅ **SUCCESS**'
+
+    if len(failures) > max_failure_fields:
+        description += f'\n\nShowing {max_failure_fields} of {len(failures)} failures'
+
+    description += '\n\nResults written to `' + writer.path + '.jsonl` and `' + writer.path + '.xml`'
+
+    embed = discord.Embed(title='Test Result', description=description, color=colour)
+
+    for failure in failures[:max_failure_fields]:
+        embed.add_field(
+            name=shorten('❌ ' + failure['name'], 200),
+            value=shorten(failure['description'], max_failure_length),
+            inline=False
+        )
+
+    embed.set_footer(text=f'Test suite completed in {result.duration:.2f} seconds')
+
+    await send(channel, embed=embed)
+
+    latency_report = metrics.report()
+    log.info('Latency report:\n' + latency_report)
+
+    if 'latency' in options and latency_report:
+        await send_report(channel, latency_report)
+
+
+def shorten(text: str, length: int) -> str:
+    '''
+    Cut text down to at most the given number of characters.
+    '''
+
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+
+async def send_report(channel: discord.TextChannel, report: str) -> None:
+    '''
+    Post a plain text report as a code block.
+    '''
+
+    # Discord messages are limited to 2000 characters.
+    if len(report) > 1900:
+        report = report[:1900] + '\n...'
+
+    await send(channel, '```\n' + report + '\n```')
+
+
+async def run_load_command(message: discord.Message, arguments: str) -> None:
+    '''
+    Replay the tests matching the filter to put the bot under load, in response to a "!load" command.
+    '''
+
+    options, test_filter = runner.parse_arguments(arguments)
+
+    try:
+        duration = float(options.get('duration', '60'))
+        rate = float(options['rate']) if 'rate' in options else None
+        concurrency = int(options.get('concurrency', '1'))
+        expect_timeout = float(options.get('timeout', '15'))
+    except ValueError:
+        await message.channel.send('The duration, rate, concurrency and timeout options must be numbers')
+        return
+
+    if rate is not None and rate <= 0:
+        await message.channel.send('The rate must be more than 0')
+        return
+
+    if not await start_run(message):
+        return
+
+    try:
+        filtered_tests = await load_tests(text_channel(), test_filter)
+
+        if filtered_tests is None:
             return
 
-        if find_bot():
-            await message.channel.send('A test is already in progress')
+        if not filtered_tests:
+            await send(text_channel(), 'No tests match ' + test_filter)
             return
 
-        # Find the bot to test.
-        bot_name = 'HexCorp Mxtress AI Dev'
-        bot_under_test = discord.utils.get(message.guild.members, display_name=bot_name)
+        set_default_timeout(expect_timeout)
+        names = ', '.join(t.__name__ for t in filtered_tests)
+        log.info('Starting load test of ' + names)
+        await send(text_channel(), 'Running load test of ' + names + ' for ' + str(duration) + ' seconds...')
+        load_report = await loadtest.run_load(filtered_tests, text_channel().name, duration, rate, max(concurrency, 1))
+        log.info('Load report:\n' + load_report)
+        await send_report(text_channel(), load_report)
+    finally:
+        end_run()
 
-        if bot_under_test is None:
-            log.error('Failed to find bot ' + bot_name)
-            await message.author.send('Cannot find bot to test: ' + bot_name)
-            return
 
-        set_bot(bot_under_test)
-        set_guild(message.guild)
-        set_default_channel(message.channel)
-
-        failures = []
-        regex = '.*' + message.content[6:].strip() + '.*'
-
-        filtered_tests = [t for t in tests if re.match(regex, t.__name__)]
-        start_time = time.time()
-
-        for test in filtered_tests:
-            try:
-                log.info('Running ' + test.__name__ + '...')
-                await message.channel.send('Running ' + test.__name__ + '...')
-                await test()
-            except asyncio.CancelledError:
-                # Ignore cancelled tasks, the error is handled in expect().
-                pass
-            except Exception as e:
-                failures.append({'name': test.__name__, 'description': str(e)})
-
-        description = (
-            'Checked **'
-            + str(get_total_expectations())
-            + '** expectations with **'
-            + str(len(failures))
-            + '** failures'
-        )
+async def run_control_request(request: control.Event, send: control.EventSender) -> int:
+    '''
+    Run the tests in response to a request on the control socket.
 
-        colour = discord.Color.red() if len(failures) else discord.Color.green()
+    Returns the exit status: 0 if every test passed, 1 if any failed, or 2 if the tests could not be run.
+    '''
 
-        if len(failures):
-            description += '\n\n❌ **FAILURE**'
-        else:
-            description += '\n\n✅ **SUCCESS**'
+    try:
+        channel_id = int(request.get('channel', startup_options.get('channel', '0')))
+        concurrency = int(request.get('concurrency', 1))
+        inbox_capacity = int(request.get('inbox', 50))
+        expect_timeout = float(request.get('timeout', 15))
+        deadline = float(request['deadline']) if 'deadline' in request else None
+    except (TypeError, ValueError):
+        raise ValueError('The channel, concurrency, inbox, timeout and deadline must be numbers')
 
-        embed = discord.Embed(title='Test Result', description=description, color=colour)
+    if not isinstance(request.get('tests', []), list):
+        raise ValueError('The tests must be a list of test names')
 
-        for failure in failures:
-            embed.add_field(name='❌ ' + failure['name'], value=failure['description'], inline=False)
+    order = request.get('order', 'found')
 
-        duration = time.time() - start_time
-        embed.set_footer(text=f'Test suite completed in {duration:.2f} seconds')
+    if order not in runner.orders:
+        raise ValueError('The order must be one of ' + ', '.join(runner.orders))
 
-        await message.channel.send(embed=embed)
+    channel = bot.get_channel(channel_id)
 
-        set_bot(None)
-        set_guild(None)
+    if not isinstance(channel, discord.TextChannel):
+        raise ValueError('No text channel with the ID ' + str(channel_id))
+
+    error = await begin_run(channel)
+
+    if error is not None:
+        raise ValueError(error)
+
+    try:
+        set_inbox_capacity(inbox_capacity)
+        set_default_timeout(expect_timeout)
+
+        for name in runner.reload_changed():
+            await send({'type': 'progress', 'message': 'Reloaded ' + name})
 
+        if 'tests' in request:
+            names = set(request['tests'])
+            functions = runner.load_tests([t for t in runner.scan_tests() if t.name in names])
+        else:
+            functions = runner.find_tests(str(request.get('filter', '')))
+
+        async def progress(message: str) -> None:
+            '''
+            Send a progress message to the client.
+            '''
+
+            await send({'type': 'progress', 'message': message})
+
+        async def report(test_result: runner.TestResult) -> None:
+            '''
+            Write the result of a test, and send it to the client.
+            '''
+
+            await writer.write(test_result)
+            await send({
+                'type': 'test',
+                'name': test_result.name,
+                'passed': test_result.passed,
+                'started': test_result.started,
+                'duration': test_result.duration,
+                'failures': test_result.failures,
+                'messages': test_result.messages,
+            })
+
+        path = str(request.get('results') or results.default_path(channel.id))
+
+        with results.ResultWriter(path, len(functions)) as writer:
+            result = await runner.run_tests(functions, channel.name, concurrency, deadline, progress, report, order)
+            writer.close(len(functions), result)
+
+        await send({'type': 'progress', 'message': 'Results written to ' + writer.path + '.jsonl and .xml'})
+
+        for failure in result.failures:
+            await send({'type': 'failure', **failure})
+
+        await send({
+            'type': 'summary',
+            'tests': len(functions),
+            'failures': len(result.failures),
+            'not_run': result.not_run,
+            'deadline_reached': result.deadline_reached,
+            'duration': result.duration,
+        })
+
+        return 1 if result.failures else 0
+    except Exception as e:
+        log.exception('Control request failed')
+        await send({'type': 'error', 'message': str(e)})
+
+        return 2
+    finally:
+        end_run()
+
+
+def memory_used() -> float:
+    '''
+    Get the most memory that the process has used, in megabytes.
+    '''
+
+    # The maximum resident set size is in kilobytes on Linux, and in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
 
-def configure_log() -> None:
+
+@bot.event
+async def on_ready() -> None:
     '''
-    Set up the logger.
+    Log how long TestBot took to connect, and start listening for run requests if a control socket was given.
     '''
 
-    log_handler = logging.StreamHandler()
-    log_handler.setLevel(logging.DEBUG)
+    global control_server
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+    cached = sum(len(g.members) for g in bot.guilds)
+    members = sum(g.member_count or 0 for g in bot.guilds)
+    log.info(
+        f'Ready after {time.monotonic() - process_start:.1f} seconds in {len(bot.guilds)} guilds, with {cached} of'
+        f' {members} members cached, using {memory_used():.0f} MB'
+    )
 
-    log_handler.setFormatter(formatter)
+    if 'control' in startup_options and control_server is None:
+        control_server = await control.serve(startup_options['control'], run_control_request)
 
-    log.addHandler(log_handler)
 
-    log.setLevel(logging.DEBUG)
+@bot.event
+async def on_message(message: discord.Message) -> None:
+    '''
+    Handle an incoming message.
+    '''
 
+    # Process messages in guilds where tests are running, and direct messages while any tests are running.
+    if find_run(message.guild) is not None or message.guild is None and active_runs:
+        cassette.record_message(message)
+        receive_message(message)
 
-if len(sys.argv) != 2:
-    print('Usage: python -m main <token>')
-    exit(1)
+    # Process the command to run the test suite.
+    if message.content.startswith('!test'):
+        await run_suite(message, message.content[6:])
+
+    # Process the command to run a load test.
+    if message.content.startswith('!load'):
+        await run_load_command(message, message.content[6:])
 
-configure_log()
 
-tests = find_tests()
+if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+    print('Usage: python -m main <token> [--control=<socket path>] [--channel=<channel ID>] [--lean]')
+    exit(1)
+
+runner.configure_log()
+ratelimit.watch_rate_limits()
 
-log.debug('Found tests: ' + ', '.join([t.__name__ for t in tests]))
+log.debug('Found tests: ' + ', '.join([t.name for t in runner.scan_tests()]))
 
 bot.run(sys.argv[1])
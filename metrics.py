@@ -0,0 +1,164 @@
+import contextlib
+import contextvars
+import logging
+import math
+import time
+import typing
+
+log = logging.getLogger('testbot')
+
+
+class Sample(typing.NamedTuple):
+    '''
+    The timing of one send, expectation, wait for a rate limit, role change or test.
+
+    Times are from time.monotonic(), except for "reply" samples which use Discord's message timestamps.
+    first is when the first event arrived, or None if no event arrived.
+    rejected is the number of events which did not pass the expectation.
+    '''
+
+    test: str
+    kind: str
+    name: str
+    start: float
+    end: float
+    first: float | None = None
+    rejected: int = 0
+    passed: bool = True
+
+
+# The samples of the current run.  reset() starts a new list for the calling task, which the tasks it starts share, so
+# that runs in different guilds keep separate samples.
+run_samples: contextvars.ContextVar[typing.List[Sample] | None] = contextvars.ContextVar('run_samples', default=None)
+
+# Samples recorded before any run was reset.
+unowned_samples: typing.List[Sample] = []
+
+# The name of the test which is running in the current task.
+current_test: contextvars.ContextVar[str] = contextvars.ContextVar('current_test', default='')
+
+
+def reset() -> None:
+    '''
+    Start a new list of samples for a run in the current task.
+    '''
+
+    run_samples.set([])
+
+
+def samples() -> typing.List[Sample]:
+    '''
+    Get the samples of the current run.
+    '''
+
+    current = run_samples.get()
+
+    return current if current is not None else unowned_samples
+
+
+def record(
+    kind: str,
+    name: str,
+    start: float,
+    first: float | None = None,
+    rejected: int = 0,
+    passed: bool = True,
+    end: float | None = None
+) -> None:
+    '''
+    Record a sample for the current test which ends now, or at the given end time.
+    '''
+
+    finish = end if end is not None else time.monotonic()
+    samples().append(Sample(current_test.get(), kind, name, start, finish, first, rejected, passed))
+
+
+@contextlib.asynccontextmanager
+async def timed(kind: str, name: str) -> typing.AsyncIterator[None]:
+    '''
+    Record a sample for the time taken by the body of an "async with" block.
+    '''
+
+    start = time.monotonic()
+    passed = False
+
+    try:
+        yield
+        passed = True
+    finally:
+        record(kind, name, start, passed=passed)
+
+
+def percentile(values: typing.Sequence[float], p: float) -> float:
+    '''
+    Get the p-th percentile of the values, using the nearest rank.
+    '''
+
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+
+    return ordered[rank - 1]
+
+
+def summarise(group: typing.List[Sample]) -> str:
+    '''
+    Format the count and latency percentiles of a group of samples.
+    '''
+
+    durations = [s.end - s.start for s in group]
+    firsts = [s.first - s.start for s in group if s.first is not None]
+    rejected = sum(s.rejected for s in group)
+
+    line = (
+        f'n={len(group):<4} p50={percentile(durations, 50):6.2f}s p95={percentile(durations, 95):6.2f}s'
+        f' p99={percentile(durations, 99):6.2f}s'
+    )
+
+    if firsts:
+        line += f' first-p50={percentile(firsts, 50):6.2f}s'
+
+    if rejected:
+        line += f' rejected={rejected}'
+
+    return line
+
+
+def report(
+    kinds: typing.Iterable[str] = ('test', 'expect', 'reply', 'send', 'queue', 'limited', 'role', 'transition')
+) -> str:
+    '''
+    Format a report of the latency percentiles for each test and each expectation, reply, send, wait for a rate limit
+    and role change, and each role state transition.
+
+    Groups are listed slowest first by p95.
+    '''
+
+    lines = []
+
+    for kind in kinds:
+        groups: typing.Dict[str, typing.List[Sample]] = {}
+
+        for s in samples():
+            if s.kind == kind:
+                groups.setdefault(s.test if kind == 'test' else s.name, []).append(s)
+
+        if not groups:
+            continue
+
+        def p95(item: typing.Tuple[str, typing.List[Sample]]) -> float:
+            '''
+            Get the 95th percentile duration of a group.
+            '''
+
+            return percentile([s.end - s.start for s in item[1]], 95)
+
+        lines.append(kind + ':')
+
+        for name, group in sorted(groups.items(), key=p95, reverse=True):
+            label = name if len(name) <= 50 else name[:47] + '...'
+            lines.append(f'  {label:<50} {summarise(group)}')
+
+    return '\n'.join(lines)
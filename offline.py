@@ -0,0 +1,119 @@
+import asyncio
+import fake
+import metrics
+import ratelimit
+import results
+import runner
+import sys
+import testbot
+import tests.fake_hexcorp
+import time
+
+
+# The scripted bot is much faster than the real one, so its timings are kept apart.
+offline_history_path = '.offline_history.json'
+
+
+def measure_dispatch(guild: fake.FakeGuild, bot: fake.FakeBot, count: int) -> float:
+    '''
+    Pass a flood of messages from the bot to testbot, with an expectation waiting on every channel.
+
+    Returns the number of events dispatched per second.
+    '''
+
+    channels = [c for c in guild.channels if isinstance(c, fake.FakeTextChannel)]
+    messages = [fake.FakeMessage(channels[i % len(channels)], bot.member, 'Flood ' + str(i)) for i in range(count)]
+    queues = [(c.id, testbot.add_waiter(c.id)) for c in channels]
+
+    try:
+        start = time.perf_counter()
+
+        for message in messages:
+            testbot.receive_message(message)
+
+        elapsed = time.perf_counter() - start
+    finally:
+        for key, queue in queues:
+            testbot.remove_waiter(key, queue)
+
+    return count / elapsed
+
+
+async def run_offline(
+    test_filter: str,
+    latency: float,
+    jitter: float,
+    concurrency: int,
+    flood: int,
+    results_path: str | None,
+    order: str
+) -> int:
+    '''
+    Run the tests against the scripted HexCorp bot, then measure the dispatcher's throughput.
+
+    Results are written to files at results_path, if given.  Returns the number of failures.
+    '''
+
+    guild, bot = tests.fake_hexcorp.build(latency, jitter)
+
+    testbot.set_guild(guild)
+    testbot.set_bot(bot.member)
+    testbot.set_default_channel(testbot.text_channel('testing'))
+
+    # Responses arrive after the scripted latency, so only wait a little longer than the slowest possible response.
+    testbot.set_default_timeout(max(latency + jitter, 0.1) * 5)
+
+    # The stand-in's channels have no rate limits.
+    ratelimit.pacing = False
+
+    metrics.reset()
+    functions = runner.find_tests(test_filter)
+    writer = results.ResultWriter(results_path, len(functions)) if results_path else None
+    result = await runner.run_tests(
+        functions,
+        'testing',
+        concurrency,
+        report=writer.write if writer else None,
+        order=order,
+        history_file=offline_history_path
+    )
+
+    if writer is not None:
+        writer.close(len(functions), result)
+
+    for failure in result.failures:
+        print('FAIL ' + failure['name'] + ': ' + failure['description'])
+
+    print(f'{len(functions)} tests, {len(result.failures)} failures in {result.duration:.2f} seconds')
+    print(runner.describe_transitions(result))
+    print(metrics.report())
+
+    if flood:
+        print(f'Dispatched {flood} events at {measure_dispatch(guild, bot, flood):.0f} events/s')
+
+    return len(result.failures)
+
+
+options, test_filter = runner.parse_arguments(' '.join(sys.argv[1:]))
+
+try:
+    latency = float(options.get('latency', '0'))
+    jitter = float(options.get('jitter', '0'))
+    concurrency = int(options.get('concurrency', '1'))
+    flood = int(options.get('flood', '100000'))
+    order = options.get('order', 'found')
+
+    if order not in runner.orders:
+        raise ValueError(order)
+except ValueError:
+    print('Usage: python -m offline [--latency=S] [--jitter=S] [--concurrency=N] [--flood=N] [--results=path]'
+          ' [--order=found|fail-fast|longest-first] [filter]')
+    exit(1)
+
+runner.configure_log()
+
+failures = asyncio.run(
+    run_offline(test_filter, latency, jitter, concurrency, flood, options.get('results') or None, order)
+)
+
+exit(1 if failures else 0)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import metrics
+import time
+import typing
+
+log = logging.getLogger('testbot')
+
+# Discord limits how often each route may be used, mostly per channel or per guild, and how many requests a bot may
+# make across all routes.  py-cord only waits once Discord has said a bucket is empty, or has answered with a 429, and
+# it waits inside the request, where the wait would look like the bot under test being slow or time out an expectation.
+#
+# Every request TestBot makes on behalf of a test waits for its turn here first, pacing requests to stay within the
+# limits.  The time spent waiting is recorded as a "queue" sample, separately from the request and the response.
+#
+# The buckets, and the rate limits seen by watch_rate_limits(), are deliberately shared by every run in the process:
+# the limits belong to TestBot's account, so runs in several guilds at once take turns from the same buckets.
+
+
+class Limit(typing.NamedTuple):
+    '''
+    The number of requests which may be made in a period of seconds.
+    '''
+
+    requests: int
+    per: float
+
+
+# The limits for each route, which apply separately to each channel or guild.  These are Discord's usual limits, which
+# are not guaranteed, so they can be lowered with set_limit() if 429s are still reported.
+limits: typing.Dict[str, Limit] = {
+    'message': Limit(5, 5.0),
+    'member': Limit(10, 10.0),
+}
+
+# The limit across every route.
+global_limit = Limit(50, 1.0)
+
+# Whether requests are paced.  Runs against fake channels, which have no rate limits, turn it off.  It applies to the
+# whole process, so it must only be turned off by scripts which don't connect to Discord.
+pacing = True
+
+
+class TokenBucket:
+    '''
+    Paces requests to a limit.
+
+    The bucket holds up to the limit's number of tokens, and refills at the limit's rate.  Each request takes a token
+    when it is scheduled.  If the bucket is empty the token is borrowed from the future, so requests are given turns in
+    the order they were scheduled.
+    '''
+
+    def __init__(self, limit: Limit) -> None:
+        self.limit = limit
+        self.tokens = float(limit.requests)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        '''
+        Take a token, and return the number of seconds until it is available.
+        '''
+
+        now = time.monotonic()
+        rate = self.limit.requests / self.limit.per
+        self.tokens = min(self.tokens + (now - self.updated) * rate, self.limit.requests) - 1
+        self.updated = now
+
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+
+# The bucket for each route and channel or guild ID, created when first used.
+buckets: typing.Dict[typing.Tuple[str, int], TokenBucket] = {}
+global_bucket = TokenBucket(global_limit)
+
+
+def set_limit(route: str, requests: int, per: float) -> None:
+    '''
+    Change the limit for a route, or for every route if the route is "global".
+    '''
+
+    global global_bucket
+
+    if route == 'global':
+        global_bucket = TokenBucket(Limit(requests, per))
+        return
+
+    limits[route] = Limit(requests, per)
+
+    for key in [k for k in buckets if k[0] == route]:
+        del buckets[key]
+
+
+async def wait_turn(route: str, key: int, name: str) -> None:
+    '''
+    Wait until a request may be made on a route for a channel or guild ID.
+
+    name: The name of the "queue" sample recording the wait, such as the channel.
+    '''
+
+    start = time.monotonic()
+
+    if not pacing:
+        metrics.record('queue', name, start)
+        return
+
+    bucket = buckets.get((route, key))
+
+    if bucket is None:
+        bucket = buckets[route, key] = TokenBucket(limits[route])
+
+    delay = bucket.reserve()
+
+    if delay > 0:
+        log.debug(f'Waiting {delay:.2f}s to use {route} {key}')
+        await asyncio.sleep(delay)
+
+    # The global token is only taken once the route's turn comes, so that waiting requests don't hold up others.
+    delay = global_bucket.reserve()
+
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    metrics.record('queue', name, start)
+
+
+class RateLimitLog(logging.Handler):
+    '''
+    Watch py-cord's HTTP log for the rate limits which pacing did not avoid, and record each one as a "limited" sample.
+
+    The sample lasts as long as py-cord waits before retrying, and is recorded for the test which made the request.
+    The end of the latest rate limit is kept, so that load generation can back off until it is over.
+    '''
+
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.count = 0
+        self.paused_until = 0.0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        '''
+        Record a rate limit.
+        '''
+
+        if not str(record.msg).startswith('We are being rate limited'):
+            return
+
+        # The arguments are the number of seconds until the rate limit is over, and py-cord's name for the bucket.
+        args = record.args if isinstance(record.args, tuple) else ()
+        retry_after = args[0] if args and isinstance(args[0], (int, float)) else 0.0
+        bucket = str(args[1]) if len(args) > 1 else 'unknown'
+        self.count += 1
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + retry_after)
+        metrics.record('limited', bucket, now, end=now + retry_after)
+
+    async def wait(self) -> None:
+        '''
+        Wait until the latest rate limit is over.
+        '''
+
+        delay = self.paused_until - time.monotonic()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# The handler watching py-cord's HTTP log, once watch_rate_limits() has been called.
+rate_limit_log: RateLimitLog | None = None
+
+
+def watch_rate_limits() -> RateLimitLog:
+    '''
+    Start recording the rate limits reported by py-cord, if they are not already being recorded.
+
+    Returns the handler, whose count and paused_until are shared by everything watching the rate limits.
+    '''
+
+    global rate_limit_log
+
+    if rate_limit_log is None:
+        rate_limit_log = RateLimitLog()
+        logging.getLogger('discord.http').addHandler(rate_limit_log)
+
+    return rate_limit_log
@@ -0,0 +1,48 @@
+import asyncio
+import cassette
+import ratelimit
+import runner
+import sys
+import testbot
+
+
+async def replay(path: str, test_filter: str) -> int:
+    '''
+    Run the tests against the responses recorded in a cassette.
+
+    Returns the number of failures.
+    '''
+
+    guild, bot, default_channel = cassette.load(path)
+
+    testbot.set_guild(guild)
+    testbot.set_bot(bot)
+    testbot.set_default_channel(default_channel)
+
+    # Recorded responses are played back straight away, so there is no need to wait long for them.
+    testbot.set_default_timeout(0.5)
+
+    # The cassette's channels have no rate limits.
+    ratelimit.pacing = False
+
+    functions = runner.find_tests(test_filter)
+    result = await runner.run_tests(functions, default_channel.name, history_file=None)
+
+    for failure in result.failures:
+        print('FAIL ' + failure['name'] + ': ' + failure['description'])
+
+    print(f'{len(functions)} tests, {len(result.failures)} failures in {result.duration:.2f} seconds')
+    print(runner.describe_transitions(result))
+
+    return len(result.failures)
+
+
+if len(sys.argv) not in (2, 3):
+    print('Usage: python -m replay <cassette> [filter]')
+    exit(1)
+
+runner.configure_log()
+
+failures = asyncio.run(replay(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else ''))
+
+exit(1 if failures else 0)
@@ -0,0 +1,139 @@
+import datetime
+import json
+import logging
+import os
+import runner
+import typing
+import xml.sax.saxutils
+
+log = logging.getLogger('testbot')
+
+# Results are written as each test finishes, so that a run which is interrupted still leaves the results so far, and
+# so that memory use doesn't grow with the size of the suite.
+#
+# The JSON Lines file has one line per event:
+#
+#   {"type": "start", "time": ..., "tests": 12}
+#   {"type": "test", "name": ..., "passed": true, "started": ..., "duration": 1.2, "failures": [], "messages": [...]}
+#   {"type": "summary", "tests": 12, "failures": 0, "not_run": 0, "deadline_reached": false, "duration": 12.3}
+#
+# The JUnit XML file has a testcase element for each test, and is complete once the summary has been written.
+
+# Where results are written, unless another path is given.
+results_directory = 'results'
+
+
+def default_path(channel_id: int | None = None) -> str:
+    '''
+    Get a path for the results of a run starting now, without the file extension.
+
+    The time includes microseconds, and the path includes the ID of the channel the run is in if given, so that runs
+    starting in the same second, in the same or different guilds, don't overwrite each other's results.
+    '''
+
+    name = datetime.datetime.now().strftime('run-%Y%m%d-%H%M%S-%f')
+
+    if channel_id is not None:
+        name += '-' + str(channel_id)
+
+    return os.path.join(results_directory, name)
+
+
+def timestamp(seconds: float) -> str:
+    '''
+    Format a time.time() as an ISO 8601 timestamp.
+    '''
+
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+
+class ResultWriter:
+    '''
+    Writes test results to "<path>.jsonl" and "<path>.xml" as they arrive.
+
+    Pass write() to runner.run_tests() as its report callback, then call close() with the suite's result.  Use it in a
+    "with" statement so that the files are closed even if the run fails, in which case no summary is written.
+    '''
+
+    def __init__(self, path: str, tests: int) -> None:
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        self.jsonl = open(path + '.jsonl', 'w', encoding='utf-8')
+        self.xml = open(path + '.xml', 'w', encoding='utf-8')
+
+        self.write_line({'type': 'start', 'time': now, 'tests': tests})
+        self.xml.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.xml.write('<testsuite name="testbot" timestamp=' + xml.sax.saxutils.quoteattr(now) + '>\n')
+        self.xml.flush()
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.jsonl.close()
+        self.xml.close()
+
+    def write_line(self, event: typing.Dict[str, typing.Any]) -> None:
+        '''
+        Write an event to the JSON Lines file.
+        '''
+
+        self.jsonl.write(json.dumps(event, ensure_ascii=False) + '\n')
+        self.jsonl.flush()
+
+    async def write(self, result: runner.TestResult) -> None:
+        '''
+        Write the result of a test.
+        '''
+
+        self.write_line({
+            'type': 'test',
+            'name': result.name,
+            'passed': result.passed,
+            'started': timestamp(result.started),
+            'duration': result.duration,
+            'failures': result.failures,
+            'messages': result.messages,
+        })
+
+        module, _, name = result.name.rpartition('.')
+        quote = xml.sax.saxutils.quoteattr
+        escape = xml.sax.saxutils.escape
+
+        self.xml.write(
+            f'  <testcase classname={quote(module or "testbot")} name={quote(name)} time="{result.duration:.3f}">\n'
+        )
+
+        for failure in result.failures:
+            self.xml.write(f'    <failure message={quote(failure.splitlines()[0] if failure else "")}>')
+            self.xml.write(escape(failure) + '</failure>\n')
+
+        if result.messages:
+            self.xml.write('    <system-out>' + escape('\n'.join(result.messages)) + '</system-out>\n')
+
+        self.xml.write('  </testcase>\n')
+        self.xml.flush()
+
+    def close(self, tests: int, result: runner.SuiteResult) -> None:
+        '''
+        Write the summary of the run and close the files.
+        '''
+
+        self.write_line({
+            'type': 'summary',
+            'tests': tests,
+            'failures': len(result.failures),
+            'not_run': result.not_run,
+            'deadline_reached': result.deadline_reached,
+            'duration': result.duration,
+        })
+
+        self.xml.write('</testsuite>\n')
+        self.jsonl.close()
+        self.xml.close()
+        log.info('Results written to ' + self.path + '.jsonl and ' + self.path + '.xml')
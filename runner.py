@@ -0,0 +1,915 @@
+import ast
+import asyncio
+import collections
+import glob
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import metrics
+import os
+import re
+import sys
+import time
+import traceback
+import typing
+from testbot import TestFunction, captured_messages, fetch_members, other_runs, start_test, teardown_fixtures
+
+log = logging.getLogger('testbot')
+
+
+class SuiteResult(typing.NamedTuple):
+    '''
+    The outcome of running a set of tests.
+
+    failures is a list of dicts with the keys 'name' and 'description'.
+    transitions is the number of role state changes in the order the tests were run, and transitions_saved is how
+    many fewer that was than in the order they were found.  seconds_saved estimates the time saved from the changes
+    which were made.
+    '''
+
+    failures: typing.List[typing.Dict[str, str]]
+    not_run: int
+    deadline_reached: bool
+    duration: float
+    transitions: int = 0
+    transitions_saved: int = 0
+    seconds_saved: float = 0.0
+
+
+class TestResult(typing.NamedTuple):
+    '''
+    The outcome of one test, reported as soon as it finishes.
+
+    started is the time.time() at which the test started, and duration is in seconds.
+    failures is empty if the test passed.  messages are the messages captured by testbot.captured_messages().
+    '''
+
+    name: str
+    started: float
+    duration: float
+    failures: typing.List[str]
+    messages: typing.List[str]
+
+    @property
+    def passed(self) -> bool:
+        return not self.failures
+
+
+# Called with the result of each test as it finishes.
+ResultCallback = typing.Callable[[TestResult], typing.Awaitable[typing.Any]]
+
+
+class TestInfo(typing.NamedTuple):
+    '''
+    A test found by scanning the tests directory, which has not necessarily been imported.
+
+    name is the name used in reports and filters, "<module>.<function>".
+    '''
+
+    name: str
+    module: str
+    function: str
+
+
+# Where the names of the tests found in each file are cached between runs.
+index_path = '.test_index.json'
+
+
+def scan_file(path: str) -> typing.List[str]:
+    '''
+    Get the names of the test functions defined in a file, without importing it.
+    '''
+
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+    return sorted(n.name for n in tree.body if isinstance(n, definitions) and n.name.startswith('test_'))
+
+
+def scan_tests() -> typing.List[TestInfo]:
+    '''
+    Find all the test functions without importing them.
+
+    Test functions must be defined in the 'tests' directory, in files starting with 'test', and start with 'test_'.
+
+    The tests in each file are cached in the index file, and a file is only parsed again when its size or modification
+    time has changed and so has a hash of its contents.
+    '''
+
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    updated = {}
+    tests: typing.List[TestInfo] = []
+
+    for path in sorted(glob.glob('./tests/test*.py')):
+        module_name_match = re.match('./tests/(.*)\\.py', path)
+
+        if not module_name_match:
+            continue
+
+        module_name = module_name_match.group(1)
+        stat = os.stat(path)
+        entry = index.get(path)
+
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+
+            if entry is None or entry['hash'] != digest:
+                log.debug('Scanning ' + path)
+                entry = {'hash': digest, 'tests': scan_file(path)}
+
+            entry = {**entry, 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+        updated[path] = entry
+        tests.extend(TestInfo(module_name + '.' + name, 'tests.' + module_name, name) for name in entry['tests'])
+
+    if updated != index:
+        try:
+            with open(index_path, 'w', encoding='utf-8') as f:
+                json.dump(updated, f, indent=1)
+        except OSError as e:
+            log.warning('Could not save the test index: ' + str(e))
+
+    return tests
+
+
+# The modification time and size of each module in the tests package when it was imported.
+module_stats: typing.Dict[str, typing.Tuple[int, int]] = {}
+
+
+def file_stat(path: str) -> typing.Tuple[int, int]:
+    '''
+    Get the modification time and size of a file.
+    '''
+
+    stat = os.stat(path)
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def test_modules() -> typing.Dict[str, str]:
+    '''
+    Get the file of each imported module in the tests package.
+    '''
+
+    files = {}
+
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+
+        if name.startswith('tests.') and isinstance(path, str):
+            files[name] = path
+
+    return files
+
+
+def record_module_stats() -> None:
+    '''
+    Note the modification time and size of any modules in the tests package which were imported since the last call.
+    '''
+
+    for name, path in test_modules().items():
+        if name not in module_stats:
+            module_stats[name] = file_stat(path)
+
+
+def module_imports(path: str) -> typing.Set[str]:
+    '''
+    Get the names of the modules imported by a file, and of the names imported from modules.
+    '''
+
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+
+    names: typing.Set[str] = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.add(node.module)
+            names.update(node.module + '.' + alias.name for alias in node.names)
+
+    return names
+
+
+def reload_changed() -> typing.List[str]:
+    '''
+    Reload the imported test modules whose files have changed, and the test modules which import them.
+
+    Modules are reloaded after the modules they import.  Returns the names of the reloaded modules.
+
+    Runs in other guilds may be running tests from the modules, so nothing is reloaded while they are in progress.  The
+    changes are picked up by the next run which starts on its own.
+    '''
+
+    if other_runs():
+        log.info('Not reloading changed test modules while runs in other servers are in progress')
+        return []
+
+    importlib.invalidate_caches()
+    modules = test_modules()
+    changed = set()
+
+    for name, path in modules.items():
+        try:
+            if name in module_stats and file_stat(path) != module_stats[name]:
+                changed.add(name)
+        except OSError:
+            # The file has been deleted.  The module is left as it is, and its tests will no longer be found.
+            pass
+
+    if not changed:
+        return []
+
+    imports = {name: module_imports(path) & modules.keys() for name, path in modules.items() if os.path.exists(path)}
+
+    # Modules which use a changed module have to be reloaded to see the changes.
+    stale = set(changed)
+
+    while True:
+        dependents = {name for name, imported in imports.items() if imported & stale} - stale
+
+        if not dependents:
+            break
+
+        stale |= dependents
+
+    reloaded: typing.List[str] = []
+
+    while stale:
+        ready = sorted(name for name in stale if not (imports.get(name, set()) & stale) - {name})
+
+        # Reload the rest in any order if they import each other.
+        for name in ready or sorted(stale):
+            log.info('Reloading ' + name)
+            importlib.reload(sys.modules[name])
+            module_stats[name] = file_stat(modules[name])
+            reloaded.append(name)
+            stale.discard(name)
+
+    record_module_stats()
+
+    return reloaded
+
+
+def load_tests(infos: typing.List[TestInfo]) -> typing.List[TestFunction]:
+    '''
+    Import the modules of the given tests, and get the test functions.
+
+    Each function's name is set to the test's name.
+    '''
+
+    functions: typing.List[TestFunction] = []
+
+    for info in infos:
+        module = importlib.import_module(info.module)
+        function = getattr(module, info.function, None)
+
+        if not inspect.isfunction(function):
+            raise Exception('Could not load test ' + info.name)
+
+        function.__name__ = info.name
+        functions.append(function)
+
+    record_module_stats()
+
+    return functions
+
+
+def find_tests(test_filter: str = '') -> typing.List[TestFunction]:
+    '''
+    Find and import the tests whose names match a regular expression.
+    '''
+
+    return load_tests(select_tests(scan_tests(), test_filter))
+
+
+def select_tests(tests: typing.List[TestInfo], test_filter: str) -> typing.List[TestInfo]:
+    '''
+    Get the tests whose names match a regular expression.
+    '''
+
+    regex = '.*' + test_filter + '.*'
+
+    return [t for t in tests if re.match(regex, t.name)]
+
+
+def parse_arguments(arguments: str) -> typing.Tuple[typing.Dict[str, str], str]:
+    '''
+    Split the arguments of the "!test" command into options and a test filter.
+
+    Options take the form "--name=value", or "--name" for a flag, and may appear anywhere.
+    The remaining words form the filter.
+    '''
+
+    options = {}
+    words = []
+
+    for word in arguments.split():
+        option = re.fullmatch('--([a-z-]+)(?:=(.*))?', word)
+
+        if option:
+            options[option.group(1)] = option.group(2) or ''
+        else:
+            words.append(word)
+
+    return options, ' '.join(words)
+
+
+def count_transitions(functions: typing.List[TestFunction]) -> int:
+    '''
+    Count the changes of role state needed to run the tests in order, including getting into the first state.
+    '''
+
+    count = 0
+    state = None
+
+    for function in functions:
+        needed = getattr(function, 'role_state', None)
+
+        if needed is not None and needed != state:
+            count += 1
+            state = needed
+
+    return count
+
+
+def group_by_role_state(functions: typing.List[TestFunction]) -> typing.List[TestFunction]:
+    '''
+    Reorder tests so that those needing the same role state run one after another.
+
+    The groups, including the tests which don't need a role state, are in the order of their first test, and tests
+    keep their order within each group.  So the first test given is always run first.
+    '''
+
+    groups: typing.Dict[str | None, typing.List[TestFunction]] = {}
+
+    for function in functions:
+        groups.setdefault(getattr(function, 'role_state', None), []).append(function)
+
+    return [f for group in groups.values() for f in group]
+
+
+def describe_transitions(result: SuiteResult) -> str:
+    '''
+    Describe the role state changes made by a run and the time saved by grouping tests.
+    '''
+
+    return (
+        f'{result.transitions} role state changes, {result.transitions_saved} fewer than in the order the tests were'
+        f' found, saving about {result.seconds_saved:.1f} seconds'
+    )
+
+
+# Where the recent durations and outcomes of each test are kept between runs against Discord.
+history_path = '.test_history.json'
+
+# The number of runs of each test kept in the history.
+history_length = 10
+
+# A test which failed in any of this many of its latest runs counts as recently failing.
+recent_runs = 3
+
+# The orders that tests can be run in, before they are grouped by role state.
+# "found" is the order the tests were found in.
+# "fail-fast" runs recently failing tests first, then tests with no history, then the rest, fastest first.
+# "longest-first" runs the slowest tests first, so that concurrent runs aren't left waiting on one long test at the end.
+orders = ('found', 'fail-fast', 'longest-first')
+
+# The durations and outcomes of each test's latest runs, oldest first, keyed by test name.
+History = typing.Dict[str, typing.Dict[str, typing.List[typing.Any]]]
+
+
+def load_history(path: str) -> History:
+    '''
+    Read a test history, or start a new one if there isn't one.
+    '''
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return history if isinstance(history, dict) else {}
+
+
+def save_history(history: History, path: str, names: typing.Iterable[str]) -> None:
+    '''
+    Write the entries for the named tests to a test history.
+
+    Other entries are read from the file again first, so that runs in other processes which share the file, such as
+    the shards of a sharded run, don't lose each other's results.
+    '''
+
+    latest = load_history(path)
+    latest.update((name, history[name]) for name in names if name in history)
+
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(latest, f, indent=1)
+    except OSError as e:
+        log.warning('Could not save the test history: ' + str(e))
+
+
+def record_history(history: History, result: TestResult) -> None:
+    '''
+    Add the result of a test to the history, forgetting the oldest run if there are too many.
+    '''
+
+    entry = history.setdefault(result.name, {'durations': [], 'passed': []})
+    entry['durations'] = (entry['durations'] + [round(result.duration, 3)])[-history_length:]
+    entry['passed'] = (entry['passed'] + [result.passed])[-history_length:]
+
+
+def estimate_durations(names: typing.Iterable[str], history: History) -> typing.Dict[str, float]:
+    '''
+    Estimate how long each of the named tests will take from the median of its recent durations.
+
+    Tests with no history are expected to take the median estimate of the others, or 0 if no test has a history.
+    '''
+
+    names = list(names)
+    known = {
+        name: metrics.percentile(history[name]['durations'], 50)
+        for name in names
+        if history.get(name, {}).get('durations')
+    }
+    typical = metrics.percentile(list(known.values()), 50)
+
+    return {name: known.get(name, typical) for name in names}
+
+
+def sort_by_module(
+    functions: typing.List[TestFunction],
+    key: typing.Callable[[TestFunction], typing.Any]
+) -> typing.List[TestFunction]:
+    '''
+    Sort the tests of each module by a key, and the modules by the key of their first test.
+
+    Each module's tests stay together, so that its module fixtures are set up once and torn down after its last test,
+    rather than being kept set up while other modules' tests run.
+    '''
+
+    modules: typing.Dict[str, typing.List[TestFunction]] = {}
+
+    for function in sorted(functions, key=key):
+        modules.setdefault(function.__module__, []).append(function)
+
+    return [f for tests in modules.values() for f in tests]
+
+
+def order_tests(functions: typing.List[TestFunction], order: str, history: History) -> typing.List[TestFunction]:
+    '''
+    Sort tests into one of the orders, using their history.
+
+    The tests in each module are kept together, in the order of the module's first test.
+    '''
+
+    if order == 'found':
+        return list(functions)
+
+    estimates = estimate_durations((f.__name__ for f in functions), history)
+
+    if order == 'longest-first':
+        return sort_by_module(functions, lambda f: -estimates[f.__name__])
+
+    if order == 'fail-fast':
+        def key(function: TestFunction) -> typing.Tuple[int, float]:
+            '''
+            Sort by recent failures, most first, then with new tests first, then by duration.
+            '''
+
+            entry = history.get(function.__name__)
+
+            if not entry or not entry['passed']:
+                return (0, 0.0)
+
+            return (-entry['passed'][-recent_runs:].count(False), estimates[function.__name__])
+
+        return sort_by_module(functions, key)
+
+    raise ValueError('The order must be one of ' + ', '.join(orders))
+
+
+def format_seconds(seconds: float) -> str:
+    '''
+    Format a duration for a progress message, such as "1m 05s" or "2.5s".
+    '''
+
+    if seconds < 10:
+        return f'{seconds:.1f}s'
+
+    minutes, seconds = divmod(round(seconds), 60)
+
+    return f'{minutes}m {seconds:02}s' if minutes else f'{seconds}s'
+
+
+def test_resources(test: TestFunction, default_channel: str) -> typing.FrozenSet[str] | None:
+    '''
+    Get the names of the channels and other shared state used by a test.
+
+    Returns None if the test has not declared its channels and so must be run on its own.
+    '''
+
+    channels = getattr(test, 'channels', None)
+
+    if channels is None:
+        return None
+
+    resources = frozenset('#' + (c or default_channel) for c in channels)
+
+    return resources | getattr(test, 'resources', frozenset())
+
+
+class Scheduler:
+    '''
+    Runs tests in the order they are added, running up to "concurrency" tests at once.
+
+    A test is only started when none of its channels or resources are in use by a running test.
+    Tests which have not declared their channels are only started when nothing else is running.
+
+    Tests which need the role state that TestBot is already in may run at the same time.  A test which needs a
+    different role state changes TestBot's roles, so it is only started when nothing else is running, and nothing else
+    is started until it finishes.
+
+    The resources of a module's module scope fixtures are held from when the first test which uses them starts until
+    none of the module's tests are left, so that other modules' tests can't change them while the fixtures are set up.
+
+    run_test must not raise exceptions.
+    '''
+
+    def __init__(
+        self,
+        default_channel: str,
+        concurrency: int,
+        run_test: typing.Callable[[TestFunction], typing.Awaitable[None]]
+    ) -> None:
+        self.default_channel = default_channel
+        self.concurrency = concurrency
+        self.run_test = run_test
+        self.pending: typing.List[typing.Tuple[TestFunction, typing.FrozenSet[str] | None]] = []
+        self.running = 0
+        self.in_use: typing.Set[str] = set()
+        self.exclusive = False
+        self.closed = False
+
+        # The role state of the last test which needed one, which TestBot should still be in.
+        self.current_state: str | None = None
+
+        # The number of each module's tests which are pending or running.
+        self.unfinished: collections.Counter[str] = collections.Counter()
+
+        # The module holding each resource of a module fixture, and the modules whose last test is running.
+        self.held: typing.Dict[str, str] = {}
+        self.closing: typing.Set[str] = set()
+
+        # Set when a test is added or finishes, so that run() looks for a test to start.
+        self.changed = asyncio.Event()
+
+    def add(self, function: TestFunction) -> None:
+        '''
+        Add a test to be run after the tests already added.
+        '''
+
+        self.pending.append((function, test_resources(function, self.default_channel)))
+        self.unfinished[function.__module__] += 1
+        self.changed.set()
+
+    def close(self) -> None:
+        '''
+        Let run() return once every test added so far has finished.
+        '''
+
+        self.closed = True
+        self.changed.set()
+
+    def last_in_module(self, function: TestFunction) -> bool:
+        '''
+        Check whether a running test is the last of its module's tests, so that the module's fixtures should be torn
+        down after it.
+
+        If so, none of the module's tests which are added later are started until it has finished.
+        '''
+
+        if self.unfinished[function.__module__] > 1:
+            return False
+
+        self.closing.add(function.__module__)
+
+        return True
+
+    def runs_alone(self, function: TestFunction, resources: typing.FrozenSet[str] | None) -> bool:
+        '''
+        Check whether a test must run on its own.
+        '''
+
+        state = getattr(function, 'role_state', None)
+
+        return resources is None or state is not None and state != self.current_state
+
+    def held_elsewhere(self, function: TestFunction, resources: typing.FrozenSet[str] | None) -> bool:
+        '''
+        Check whether a test uses a resource held by another module's fixtures.
+        '''
+
+        return any(
+            module != function.__module__ and (resources is None or resource in resources)
+            for resource, module in self.held.items()
+        )
+
+    def can_start(self, function: TestFunction, resources: typing.FrozenSet[str] | None) -> bool:
+        '''
+        Check whether a test with the given resources can be started now.
+        '''
+
+        if self.exclusive or self.running >= self.concurrency:
+            return False
+
+        if function.__module__ in self.closing or self.held_elsewhere(function, resources):
+            return False
+
+        if resources is None or self.runs_alone(function, resources):
+            return not self.running
+
+        return self.in_use.isdisjoint(resources)
+
+    def next_ready(self) -> typing.Tuple[TestFunction, typing.FrozenSet[str] | None] | None:
+        '''
+        Get the first pending test which can be started now, or None.
+        '''
+
+        for p in self.pending:
+            if self.can_start(*p):
+                return p
+
+            # Don't let later tests overtake a test which is waiting to run on its own, unless it is waiting for
+            # another module to finish, which may need the later tests to run first.
+            if self.runs_alone(*p) and not self.held_elsewhere(*p):
+                return None
+
+        return None
+
+    async def run_one(self, function: TestFunction, resources: typing.FrozenSet[str] | None, alone: bool) -> None:
+        '''
+        Run a test, then release its resources, and its module's held resources if it was the module's last test.
+        '''
+
+        module = function.__module__
+
+        try:
+            await self.run_test(function)
+        finally:
+            self.running -= 1
+            self.unfinished[module] -= 1
+
+            if alone:
+                self.exclusive = False
+
+            if resources is not None:
+                self.in_use.difference_update(resources)
+
+            # Only the module's last test runs while it is closing, but more of its tests may have been added since.
+            self.closing.discard(module)
+
+            if not self.unfinished[module]:
+                self.held = {r: m for r, m in self.held.items() if m != module}
+
+            self.changed.set()
+
+    async def run(self) -> None:
+        '''
+        Start tests as they can be started, until close() has been called and every test has finished.
+        '''
+
+        async with asyncio.TaskGroup() as group:
+            while self.pending or not self.closed:
+                ready = self.next_ready()
+
+                if ready is None:
+                    # Wait for a test to be added, or for a running test to finish and free up its resources.
+                    self.changed.clear()
+                    await self.changed.wait()
+                    continue
+
+                self.pending.remove(ready)
+                function, resources = ready
+                alone = self.runs_alone(function, resources)
+                self.exclusive = alone
+                self.current_state = getattr(function, 'role_state', None) or self.current_state
+                self.running += 1
+                self.held.update((r, function.__module__) for r in getattr(function, 'module_resources', ()))
+
+                if resources is not None:
+                    self.in_use.update(resources)
+
+                group.create_task(self.run_one(function, resources, alone))
+
+
+async def run_test_body(test: TestFunction) -> None:
+    '''
+    Run a test within its time limit, after fetching the members it uses, and record a "test" sample for it.
+
+    Raises whatever the test raised, or a TimeoutError saying so if it did not finish within its time limit.  Fixtures
+    are left for the caller to tear down.
+    '''
+
+    start_test()
+    time_limit = getattr(test, 'timeout', None)
+
+    async with metrics.timed('test', test.__name__):
+        limit = asyncio.timeout(time_limit)
+
+        try:
+            async with limit:
+                await fetch_members(getattr(test, 'members', ()))
+                await test()
+        except TimeoutError as e:
+            if limit.expired():
+                raise TimeoutError(f'Test did not finish within its time limit of {time_limit} seconds') from e
+
+            raise
+
+
+def describe_timeout(e: TimeoutError) -> str:
+    '''
+    Describe a TimeoutError which failed a test.
+
+    TimeoutErrors raised by asyncio have no message, so they are described by where in the tests they were raised.
+    '''
+
+    if str(e):
+        return str(e)
+
+    frames = [f for f in traceback.extract_tb(e.__traceback__) if os.sep + 'asyncio' + os.sep not in f.filename]
+
+    if not frames:
+        return 'Timed out'
+
+    return f'Timed out at {os.path.relpath(frames[-1].filename)}:{frames[-1].lineno}'
+
+
+async def run_tests(
+    functions: typing.List[TestFunction],
+    default_channel: str,
+    concurrency: int = 1,
+    deadline: float | None = None,
+    progress: typing.Callable[[str], typing.Awaitable[typing.Any]] | None = None,
+    report: ResultCallback | None = None,
+    order: str = 'found',
+    history_file: str | None = history_path
+) -> SuiteResult:
+    '''
+    Run the tests and collect their failures.
+
+    Tests which need the same role state are grouped together, so that TestBot's roles change as few times as
+    possible.  Role state changes should be timed with the metrics kind "transition".
+
+    default_channel: The name of the channel that tests get from text_channel() with no name.
+    concurrency: The most tests to run at once.
+    deadline: The number of seconds after which to cancel the remaining tests.
+    progress: Called with a message as each test starts, with an estimate of the time left once there is a history.
+    report: Called with the result of each test as it finishes.  Failures to tear down session fixtures are reported
+    as a test named "fixtures".
+    order: One of "orders".
+    history_file: Where the duration and outcome of each test are kept, to decide the order and estimate the time
+    left.  Tests run against a different bot should use a different file, or None to keep no history.
+    '''
+
+    metrics.reset()
+    failures: typing.List[typing.Dict[str, str]] = []
+    started: typing.List[TestFunction] = []
+    start_time = time.time()
+    history = load_history(history_file) if history_file is not None else {}
+    estimates = estimate_durations((f.__name__ for f in functions), history)
+    ordered = group_by_role_state(order_tests(functions, order, history))
+    transitions = count_transitions(ordered)
+    transitions_saved = count_transitions(functions) - transitions
+
+    # The estimated number of seconds of tests which have not finished.
+    unfinished = sum(estimates.values())
+
+    def describe_start(test: TestFunction) -> str:
+        '''
+        Describe the start of a test, with how many have started and roughly how long the run has left.
+        '''
+
+        message = f'Running {test.__name__}... ({len(started)}/{len(functions)}'
+
+        if unfinished:
+            # Subtracting each finished test's estimate can leave the total slightly below 0 through rounding.
+            message += ', about ' + format_seconds(max(0.0, unfinished) / max(concurrency, 1)) + ' left'
+
+        return message + ')'
+
+    async def run_test(test: TestFunction) -> None:
+        '''
+        Run a single test and record any failure.
+        '''
+
+        nonlocal unfinished
+
+        started.append(test)
+        metrics.current_test.set(test.__name__)
+        test_started = time.time()
+        errors: typing.List[str] = []
+        cancelled = False
+
+        try:
+            message = describe_start(test)
+            log.info(message)
+
+            if progress is not None:
+                await progress(message)
+
+            await run_test_body(test)
+        except asyncio.CancelledError:
+            # The suite deadline has passed.
+            errors.append('Cancelled at the suite deadline')
+            cancelled = True
+            raise
+        except TimeoutError as e:
+            errors.append(describe_timeout(e))
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            errors += await teardown_fixtures('function')
+
+            if scheduler.last_in_module(test):
+                errors += await teardown_fixtures('module', test.__module__)
+
+            failures.extend({'name': test.__name__, 'description': e} for e in errors)
+            unfinished -= estimates[test.__name__]
+            result = TestResult(test.__name__, test_started, time.time() - test_started, errors, captured_messages())
+
+            # A cancelled test didn't get to run for as long as it needed.
+            if not cancelled and history_file is not None:
+                record_history(history, result)
+
+            if report is not None:
+                await report(result)
+
+    scheduler = Scheduler(default_channel, max(concurrency, 1), run_test)
+
+    for function in ordered:
+        scheduler.add(function)
+
+    scheduler.close()
+    deadline_reached = False
+
+    try:
+        async with asyncio.timeout(deadline):
+            await scheduler.run()
+    except TimeoutError:
+        deadline_reached = True
+
+    if history_file is not None:
+        save_history(history, history_file, (t.__name__ for t in started))
+
+    teardown_started = time.time()
+    errors = await teardown_fixtures('session')
+    failures.extend({'name': 'fixtures', 'description': e} for e in errors)
+
+    if errors and report is not None:
+        await report(TestResult('fixtures', teardown_started, time.time() - teardown_started, errors, []))
+
+    # Estimate the time saved from the role state changes which were timed.
+    changes = [s.end - s.start for s in metrics.samples() if s.kind == 'transition']
+    seconds_saved = transitions_saved * sum(changes) / len(changes) if changes else 0.0
+
+    return SuiteResult(
+        failures,
+        len(functions) - len(started),
+        deadline_reached,
+        time.time() - start_time,
+        transitions,
+        transitions_saved,
+        seconds_saved
+    )
+
+
+def configure_log() -> None:
+    '''
+    Set up the logger.
+    '''
+
+    log_handler = logging.StreamHandler()
+    log_handler.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+
+    log_handler.setFormatter(formatter)
+
+    log.addHandler(log_handler)
+
+    log.setLevel(logging.DEBUG)
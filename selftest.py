@@ -0,0 +1,541 @@
+import asyncio
+import fake
+import json
+import os
+import ratelimit
+import re
+import runner
+import sys
+import tempfile
+import testbot
+import time
+import typing
+
+# Checks of testbot itself, run against a bot scripted with FakeBot.
+#
+# Each check is an async function which is given a fresh guild's bot and channel, and raises an Exception if testbot
+# does not behave as expected.  The tests in ./tests check the bot under test, so they cannot check that testbot
+# reports their failures correctly.
+
+SelfTest = typing.Callable[[fake.FakeBot, fake.FakeTextChannel], typing.Coroutine[typing.Any, typing.Any, None]]
+
+# The checks in the order they are run.
+checks: typing.List[typing.Tuple[str, SelfTest]] = []
+
+# The default expectation timeout during checks.  Anything which should fail fast must fail well within it.
+check_timeout = 2.0
+fast = 0.5
+
+
+def check(name: str) -> typing.Callable[[SelfTest], SelfTest]:
+    '''
+    A function decorator for adding a check.
+    '''
+
+    def decorator(func: SelfTest) -> SelfTest:
+        '''
+        Add the check.
+        '''
+
+        checks.append((name, func))
+
+        return func
+
+    return decorator
+
+
+async def expect_error(
+    awaitable: typing.Awaitable[typing.Any],
+    message: str,
+    within: float = fast,
+    error: typing.Type[Exception] = Exception
+) -> None:
+    '''
+    Check that an awaitable raises an exception of the given type, whose message contains the given text, in time.
+    '''
+
+    start = time.monotonic()
+
+    try:
+        await awaitable
+    except error as e:
+        elapsed = time.monotonic() - start
+
+        if message not in str(e):
+            raise Exception('Expected an error containing ' + repr(message) + ', found ' + repr(str(e))) from e
+
+        if elapsed > within:
+            raise Exception(f'Expected to fail within {within}s, took {elapsed:.2f}s') from e
+
+        return
+
+    raise Exception('Expected an error containing ' + repr(message) + ', but nothing was raised')
+
+
+def contents(messages: typing.Iterable[typing.Any]) -> typing.List[str]:
+    '''
+    Get the content of each message.
+    '''
+
+    return [m.content for m in messages]
+
+
+def same(found: typing.Any, expected: typing.Any) -> None:
+    '''
+    Check that a value is the expected one.
+    '''
+
+    if found != expected:
+        raise Exception('Expected ' + repr(expected) + ', found ' + repr(found))
+
+
+def respond(bot: fake.FakeBot, command: str, channel: fake.FakeTextChannel, content: str) -> None:
+    '''
+    Make the bot answer a command with a message in the channel.
+    '''
+
+    @bot.command(command)
+    def handler(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        bot.say(channel, content)
+
+
+def in_module(module: str) -> typing.Callable[[testbot.AnyFunction], testbot.AnyFunction]:
+    '''
+    Make a test look like it was found in the given module.
+    '''
+
+    def decorator(func: testbot.AnyFunction) -> testbot.AnyFunction:
+        func.__module__ = module
+
+        return func
+
+    return decorator
+
+
+@check('expect_sequence passes in order, skipping other messages')
+async def sequence_in_order(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    for content in ('one', 'two', 'three'):
+        bot.say(ch, content)
+
+    same(contents(await testbot.expect_sequence(ch, testbot.text('one'), testbot.text('three'))), ['one', 'three'])
+
+
+@check('expect_sequence reports how far an out of order sequence got')
+async def sequence_out_of_order(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    bot.say(ch, 'two')
+    bot.say(ch, 'one')
+
+    await expect_error(
+        testbot.expect_sequence(ch, testbot.text('one'), testbot.text('two'), timeout=0.1),
+        'after 1 of 2 passed.  Passed: text(one).  Still waiting for: text(two).  Received: "two", "one"'
+    )
+
+
+@check('expect_all_of passes in any order, returning messages in the order of the expectations')
+async def all_of_any_order(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    bot.say(ch, 'b')
+    bot.say(ch, 'a')
+
+    same(contents(await testbot.expect_all_of(ch, testbot.text('a'), testbot.text('b'))), ['a', 'b'])
+
+
+@check('expect_all_of reports the expectations still waiting')
+async def all_of_missing(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    bot.say(ch, 'a')
+
+    await expect_error(
+        testbot.expect_all_of(ch, testbot.text('a'), testbot.text('c'), timeout=0.1),
+        'all_of(text(a), text(c)) after 1 of 2 passed.  Passed: text(a).  Still waiting for: text(c)'
+    )
+
+
+@check('expect_count passes each message once')
+async def count_passes(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    for content in ('x', 'y', 'x', 'x'):
+        bot.say(ch, content)
+
+    same(contents(await testbot.expect_count(ch, 2, testbot.text('x'))), ['x', 'x'])
+    same(contents(await testbot.expect_count(ch, 1, testbot.text('x'))), ['x'])
+
+
+@check('expect_count reports how many messages passed')
+async def count_short(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    bot.say(ch, 'x')
+
+    await expect_error(
+        testbot.expect_count(ch, 3, testbot.text('x'), timeout=0.1),
+        'sequence(text(x), text(x), text(x)) after 1 of 3 passed'
+    )
+
+
+@check('empty groups pass at once and negative counts are rejected')
+async def empty_groups(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    start = time.monotonic()
+
+    same(await testbot.expect_sequence(ch), [])
+    same(await testbot.expect_all_of(ch), [])
+    same(await testbot.expect_count(ch, 0, testbot.text('x')), [])
+
+    if time.monotonic() - start > fast:
+        raise Exception('Empty groups waited for messages')
+
+    await expect_error(testbot.expect_count(ch, -1, testbot.text('x')), 'at least 0', error=ValueError)
+
+
+@check('reject fails as soon as a message passes it')
+async def reject_fails_fast(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    respond(bot, '!fail', ch, 'Error: no such drone')
+
+    await expect_error(
+        testbot.send_and_expect(ch, '!fail', testbot.text('Done'), reject=testbot.regex('Error.*')),
+        'Expected text(Done), Received "Error: no such drone" which matches regex(Error.*)'
+    )
+
+
+@check('final fails as soon as the first message does not pass')
+async def final_fails_fast(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    respond(bot, '!fail', ch, 'Something else')
+
+    await expect_error(
+        testbot.send_and_expect(ch, '!fail', testbot.text('Done'), final=True),
+        'Expected: "Done" Found: "Something else"'
+    )
+
+
+@check('final only judges messages received since the test last sent one')
+async def final_ignores_earlier(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    respond(bot, '!first', ch, 'First response')
+    respond(bot, '!second', ch, 'Second response')
+
+    await testbot.send(ch, '!first')
+    await asyncio.sleep(0.05)
+    await testbot.send(ch, '!second')
+    await testbot.expect(ch, testbot.text('Second response'), final=True)
+
+
+@check('a test fails at its time limit rather than at the expectation timeout')
+async def test_time_limit(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    @testbot.timeout(0.1)
+    async def test_never_answered() -> None:
+        await testbot.expect(ch, testbot.text('Never sent'))
+
+    start = time.monotonic()
+    result = await runner.run_tests([test_never_answered], ch.name, history_file=None)
+
+    same(result.failures, [{
+        'name': 'test_never_answered',
+        'description': 'Test did not finish within its time limit of 0.1 seconds'
+    }])
+
+    if time.monotonic() - start > fast:
+        raise Exception('The test ran past its time limit')
+
+
+@check('a module fixture stays set up until its module finishes, whatever the order')
+async def module_fixture_order(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    owner = ['']
+
+    @testbot.fixture('module')
+    @testbot.uses('thing')
+    async def owned_by_alpha() -> typing.AsyncIterator[None]:
+        owner[0] = 'alpha'
+        yield
+        same(owner[0], 'alpha')
+
+    async def check_owner() -> None:
+        await asyncio.sleep(0.02)
+        same(owner[0], 'alpha')
+
+    @owned_by_alpha
+    @in_module('alpha')
+    @testbot.uses_channels('one')
+    async def test_alpha_first() -> None:
+        await check_owner()
+
+    @owned_by_alpha
+    @in_module('alpha')
+    @testbot.uses_channels('two')
+    async def test_alpha_second() -> None:
+        await check_owner()
+
+    @in_module('beta')
+    @testbot.uses('thing')
+    @testbot.uses_channels('three')
+    async def test_beta() -> None:
+        owner[0] = 'beta'
+
+    # Sorted across modules, longest first would put the other module's test between the fixture's tests, as the
+    # found order does here.
+    history = {
+        name: {'durations': [duration], 'passed': [True]}
+        for name, duration in (('test_alpha_first', 0.3), ('test_beta', 0.2), ('test_alpha_second', 0.1))
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history.json')
+
+        for order in ('longest-first', 'found'):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(history, f)
+
+            result = await runner.run_tests(
+                [test_alpha_first, test_beta, test_alpha_second],
+                ch.name,
+                concurrency=2,
+                order=order,
+                history_file=path
+            )
+
+            same((order, result.failures), (order, []))
+
+
+@check('a module\'s test added while its last test is running starts after it')
+async def module_added_while_closing(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    ran: typing.List[bool] = []
+
+    @in_module('alpha')
+    @testbot.uses_channels('one')
+    async def test_again() -> None:
+        pass
+
+    async def run_test(test: testbot.TestFunction) -> None:
+        ran.append(scheduler.last_in_module(test))
+
+        # Tests are added while others run when load testing at a fixed rate.
+        if len(ran) == 1:
+            scheduler.add(test)
+            scheduler.close()
+            await asyncio.sleep(0.01)
+
+    scheduler = runner.Scheduler(ch.name, 2, run_test)
+    scheduler.add(test_again)
+
+    try:
+        await asyncio.wait_for(scheduler.run(), fast)
+    except TimeoutError as e:
+        raise Exception('The scheduler stopped starting tests after ' + str(len(ran))) from e
+
+    same(ran, [True, True])
+
+
+@check('fail-fast and longest-first keep the tests of each module together')
+async def order_by_module(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    @in_module('alpha')
+    async def test_quick() -> None:
+        pass
+
+    @in_module('beta')
+    async def test_failing() -> None:
+        pass
+
+    @in_module('alpha')
+    async def test_slow() -> None:
+        pass
+
+    history: runner.History = {
+        'test_quick': {'durations': [0.1], 'passed': [True]},
+        'test_failing': {'durations': [0.2], 'passed': [False]},
+        'test_slow': {'durations': [0.3], 'passed': [True]},
+    }
+    functions = [test_quick, test_failing, test_slow]
+
+    same(
+        [f.__name__ for f in runner.order_tests(functions, 'fail-fast', history)],
+        ['test_failing', 'test_quick', 'test_slow']
+    )
+    same(
+        [f.__name__ for f in runner.order_tests(functions, 'longest-first', history)],
+        ['test_slow', 'test_quick', 'test_failing']
+    )
+
+
+@check('a test without a time limit reports where it timed out')
+async def timeout_without_limit(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    async def test_waits_too_long() -> None:
+        await asyncio.wait_for(asyncio.sleep(1), 0.05)
+
+    line = test_waits_too_long.__code__.co_firstlineno + 1
+    result = await runner.run_tests([test_waits_too_long], ch.name, history_file=None)
+
+    same(result.failures, [{'name': 'test_waits_too_long', 'description': f'Timed out at selftest.py:{line}'}])
+
+
+@check('expectations in one guild do not skip messages for a run in another')
+async def consumed_per_run(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    other_guild = fake.FakeGuild('Other Self Test')
+    other_channel = other_guild.add_text_channel('testing')
+    other_bot = fake.FakeBot(other_guild, bot.member.name, latency=0.01)
+
+    # The bot under test is the same user in both guilds.
+    other_bot.member.id = bot.member.id
+    said = asyncio.Event()
+    consumed = asyncio.Event()
+
+    async def other_run() -> None:
+        '''
+        Expect a message in the other guild which arrived before one which passed an expectation in this guild.
+        '''
+
+        testbot.set_guild(other_guild)
+        testbot.set_bot(other_bot.member)
+        testbot.set_default_channel(other_channel)
+        testbot.start_test()
+
+        try:
+            other_bot.say(other_channel, 'Other guild')
+            await asyncio.sleep(0.05)
+            said.set()
+            await consumed.wait()
+            await testbot.expect(other_bot.member, testbot.text('Other guild'), timeout=0.2)
+        finally:
+            testbot.set_guild(None)
+
+    task = asyncio.create_task(other_run())
+    await said.wait()
+    bot.say(ch, 'This guild')
+    await testbot.expect(bot.member, testbot.text('This guild'))
+    consumed.set()
+    await task
+
+
+@check('the inbox size is only changed when no run in another guild is in progress')
+async def inbox_capacity_shared(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    started = asyncio.Event()
+    finished = asyncio.Event()
+    capacity = testbot.inbox_capacity
+
+    async def other_run() -> None:
+        '''
+        Keep a run in another guild in progress until this guild's run has tried to change the inbox size.
+        '''
+
+        testbot.set_guild(fake.FakeGuild('Other Self Test'))
+
+        try:
+            started.set()
+            await finished.wait()
+        finally:
+            testbot.set_guild(None)
+
+    task = asyncio.create_task(other_run())
+    await started.wait()
+
+    try:
+        testbot.set_inbox_capacity(capacity)
+        testbot.set_inbox_capacity(capacity + 1)
+    except ValueError as e:
+        same(str(e), f'The inbox size can\'t be changed to {capacity + 1} while runs in other servers keep {capacity} '
+             'events')
+    else:
+        raise Exception('The inbox size was changed during another run')
+    finally:
+        finished.set()
+        await task
+
+    testbot.set_inbox_capacity(capacity + 1)
+    testbot.set_inbox_capacity(capacity)
+
+
+@check('event_stream only gives the kinds, sender and channel asked for')
+async def stream_filter(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    other = bot.guild.add_text_channel('other')
+
+    with testbot.event_stream(channel=ch, kinds=('edit', 'delete', 'reaction_add'), timeout=0.2) as stream:
+        await ch.send('From TestBot')
+        elsewhere = bot.say(other, 'Elsewhere')
+        bot.edit(elsewhere, 'Edited elsewhere')
+        message = bot.say(ch, 'Before')
+        bot.edit(message, 'After')
+        bot.react(message, '⬡')
+        bot.delete(message)
+
+        edit = await anext(stream)
+        same((edit.kind, edit.before.content, edit.value.content), ('edit', 'Before', 'After'))
+
+        reaction = await anext(stream)
+        same((reaction.kind, reaction.emoji, reaction.value.id), ('reaction_add', '⬡', message.id))
+
+        deletion = await anext(stream)
+        same((deletion.kind, deletion.value.id), ('delete', message.id))
+
+        await expect_error(anext(stream), 'Timed out waiting for delete or edit or reaction_add events', fast)
+
+
+@check('event_stream reports events lost while it was full')
+async def stream_overflow(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    with testbot.event_stream(kinds=('message',), capacity=2) as stream:
+        for content in ('one', 'two', 'three'):
+            bot.say(ch, content)
+
+        await asyncio.sleep(0.1)
+
+        same([(await anext(stream)).value.content for _ in range(2)], ['one', 'two'])
+        await expect_error(anext(stream), 'More than 2 events arrived before they were read', fast)
+
+
+@check('event_stream times out waiting for an event')
+async def stream_timeout(bot: fake.FakeBot, ch: fake.FakeTextChannel) -> None:
+    with testbot.event_stream(timeout=0.1) as stream:
+        await expect_error(anext(stream), 'Timed out waiting for', fast)
+
+    same(testbot.streams, [])
+
+
+def set_up() -> typing.Tuple[fake.FakeBot, fake.FakeTextChannel]:
+    '''
+    Start a run in a new fake guild, with a bot under test which responds after a short delay.
+    '''
+
+    guild = fake.FakeGuild('Self Test')
+    channel = guild.add_text_channel('testing')
+    bot = fake.FakeBot(guild, 'Bot Under Test', latency=0.01)
+
+    testbot.set_guild(guild)
+    testbot.set_bot(bot.member)
+    testbot.set_default_channel(channel)
+    testbot.set_default_timeout(check_timeout)
+    testbot.start_test()
+
+    return bot, channel
+
+
+async def run_checks(selected: typing.List[typing.Tuple[str, SelfTest]]) -> int:
+    '''
+    Run each check in a new guild.
+
+    Returns the number of failures.
+    '''
+
+    failures = 0
+
+    for name, func in selected:
+        bot, channel = set_up()
+
+        try:
+            await func(bot, channel)
+        except Exception as e:
+            failures += 1
+            print('FAIL ' + name + ': ' + str(e))
+        else:
+            print('PASS ' + name)
+        finally:
+            testbot.set_guild(None)
+
+    print(f'{len(selected)} checks, {failures} failures')
+
+    return failures
+
+
+options, check_filter = runner.parse_arguments(' '.join(sys.argv[1:]))
+
+if options:
+    print('Usage: python -m selftest [filter]')
+    exit(1)
+
+# The fake channels have no rate limits.
+ratelimit.pacing = False
+
+# Filter the checks in the same way as "!test" filters tests.
+failures = asyncio.run(run_checks([c for c in checks if re.match('.*' + check_filter + '.*', c[0])]))
+
+exit(1 if failures else 0)
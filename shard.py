@@ -0,0 +1,266 @@
+import asyncio
+import control
+import json
+import logging
+import results
+import runner
+import sys
+import time
+import typing
+
+log = logging.getLogger('testbot')
+
+# A sharded run splits the selected tests between several TestBots, each logged in with its own account and running
+# from its own channel, so that a large suite isn't limited by one account's rate limits or by one process.
+#
+# The shards are described by a JSON file:
+#
+#   [
+#     {"token": "...", "socket": "/tmp/testbot-1.sock", "channel": 1234},
+#     {"token": "...", "socket": "/tmp/testbot-2.sock", "channel": 5678}
+#   ]
+#
+# A TestBot which is already listening on a shard's socket is used as it is.  Otherwise one is started with the shard's
+# token, and stopped at the end of the run.  Tests in different shards run at the same time, so shards in the same
+# guild must not share channels.  The simplest way to ensure that is to give each shard its own staging guild.
+
+
+class Shard(typing.NamedTuple):
+    '''
+    A TestBot which runs part of a sharded run.
+
+    channel is the ID of the channel that the shard's tests are run from.
+    '''
+
+    token: str
+    socket: str
+    channel: int
+
+
+class ShardResult(typing.NamedTuple):
+    '''
+    The outcome of one shard's part of a run.
+
+    summary is the shard's summary event, or None if the shard could not run its tests.
+    '''
+
+    status: int
+    summary: control.Event | None
+    failures: typing.List[typing.Dict[str, str]]
+
+
+# The number of seconds to wait for a TestBot which has been started to connect to Discord.
+startup_timeout = 120.0
+
+
+def load_shards(path: str) -> typing.List[Shard]:
+    '''
+    Read the description of the shards.
+    '''
+
+    with open(path, encoding='utf-8') as f:
+        shards = json.load(f)
+
+    if not isinstance(shards, list) or not shards:
+        raise ValueError(path + ' must contain a list of shards')
+
+    return [Shard(str(s['token']), str(s['socket']), int(s['channel'])) for s in shards]
+
+
+def split_tests(
+    names: typing.List[str],
+    shards: int,
+    estimates: typing.Dict[str, float]
+) -> typing.List[typing.List[str]]:
+    '''
+    Split tests between shards so that each shard is expected to take about as long as the others.
+
+    Tests are given out longest first, each to the shard with the least work so far.  Within each shard the tests keep
+    the order they were given in.
+    '''
+
+    totals = [0.0] * shards
+    assigned: typing.List[typing.List[str]] = [[] for _ in range(shards)]
+    position = {name: i for i, name in enumerate(names)}
+
+    for name in sorted(names, key=lambda n: -estimates.get(n, 0.0)):
+        shard = totals.index(min(totals))
+        assigned[shard].append(name)
+
+        # Count every test as taking some time, so that tests with no history are spread out too.
+        totals[shard] += max(estimates.get(name, 0.0), 0.001)
+
+    return [sorted(a, key=position.__getitem__) for a in assigned]
+
+
+async def start_worker(shard: Shard) -> asyncio.subprocess.Process | None:
+    '''
+    Start a TestBot for a shard, unless one is already listening on its socket, and wait until it is listening.
+
+    Returns the process which was started, or None if the shard's TestBot was already running.
+    '''
+
+    if await control.is_listening(shard.socket):
+        return None
+
+    log.info('Starting TestBot for ' + shard.socket)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'main', shard.token, '--control=' + shard.socket, '--channel=' + str(shard.channel)
+    )
+
+    try:
+        async with asyncio.timeout(startup_timeout):
+            while not await control.is_listening(shard.socket):
+                if process.returncode is not None:
+                    raise Exception('TestBot for ' + shard.socket + ' exited with status ' + str(process.returncode))
+
+                await asyncio.sleep(0.5)
+    except BaseException:
+        await stop_worker(process)
+        raise
+
+    return process
+
+
+async def stop_worker(process: asyncio.subprocess.Process) -> None:
+    '''
+    Stop a TestBot which was started for a shard.
+    '''
+
+    if process.returncode is None:
+        process.terminate()
+        await process.wait()
+
+
+async def run_shard(
+    number: int,
+    shard: Shard,
+    request: control.Event,
+    writer: results.ResultWriter
+) -> ShardResult:
+    '''
+    Run a shard's tests, writing their results as they arrive.
+    '''
+
+    prefix = '[' + str(number) + '] '
+    status = 2
+    summary = None
+    failures = []
+
+    try:
+        async for event in control.request_events(shard.socket, {**request, 'channel': shard.channel}):
+            if event['type'] == 'progress':
+                log.info(prefix + event['message'])
+            elif event['type'] == 'test':
+                await writer.write(runner.TestResult(
+                    event['name'],
+                    event['started'],
+                    event['duration'],
+                    event['failures'],
+                    event['messages']
+                ))
+            elif event['type'] == 'failure':
+                failures.append({'name': event['name'], 'description': event['description']})
+            elif event['type'] == 'summary':
+                summary = event
+            elif event['type'] == 'error':
+                log.error(prefix + event['message'])
+                failures.append({'name': 'shard ' + str(number), 'description': event['message']})
+            elif event['type'] == 'exit':
+                status = event['status']
+    except (OSError, ValueError) as e:
+        log.error(prefix + 'Lost connection to ' + shard.socket + ': ' + str(e))
+        failures.append({'name': 'shard ' + str(number), 'description': str(e)})
+
+    return ShardResult(status, summary, failures)
+
+
+async def run_sharded(shards: typing.List[Shard], test_filter: str, options: typing.Dict[str, str]) -> int:
+    '''
+    Run the tests matching the filter, split between the shards, and report the merged results.
+
+    Returns the exit status: 0 if every test passed, 1 if any failed, or 2 if any shard could not run its tests.
+    '''
+
+    start_time = time.time()
+    names = [t.name for t in runner.select_tests(runner.scan_tests(), test_filter)]
+    estimates = runner.estimate_durations(names, runner.load_history(runner.history_path))
+    split = split_tests(names, len(shards), estimates)
+
+    # Shards are numbered from 1 in reports, and shards with no tests are not used.
+    assigned = [(i + 1, shard, tests) for i, (shard, tests) in enumerate(zip(shards, split)) if tests]
+    path = options.get('results') or results.default_path()
+    processes: typing.List[asyncio.subprocess.Process] = []
+
+    request: control.Event = {
+        key: options[key] for key in ('concurrency', 'timeout', 'deadline', 'order') if key in options
+    }
+
+    try:
+        started = await asyncio.gather(*[start_worker(shard) for _, shard, _ in assigned], return_exceptions=True)
+        processes.extend(p for p in started if isinstance(p, asyncio.subprocess.Process))
+
+        for error in started:
+            if isinstance(error, BaseException):
+                print('Could not start the shards: ' + str(error))
+                return 2
+
+        with results.ResultWriter(path, len(names)) as writer:
+            outcomes = await asyncio.gather(*[
+                run_shard(number, shard, {**request, 'tests': tests, 'results': path + '-shard' + str(number)}, writer)
+                for number, shard, tests in assigned
+            ])
+
+            failures = [f for o in outcomes for f in o.failures]
+            summaries = [o.summary for o in outcomes if o.summary is not None]
+            not_run = sum(o.summary['not_run'] if o.summary else len(a[2]) for a, o in zip(assigned, outcomes))
+            result = runner.SuiteResult(
+                failures,
+                not_run,
+                any(s['deadline_reached'] for s in summaries),
+                time.time() - start_time
+            )
+            writer.close(len(names), result)
+    finally:
+        for process in processes:
+            await stop_worker(process)
+
+    for (number, shard, tests), outcome in zip(assigned, outcomes):
+        if outcome.summary is None:
+            print(f'Shard {number}: {len(tests)} tests not run')
+        else:
+            duration = outcome.summary['duration']
+            print(f'Shard {number}: {len(tests)} tests, {len(outcome.failures)} failures in {duration:.2f} seconds')
+
+    for failure in failures:
+        print('FAIL ' + failure['name'] + ': ' + failure['description'])
+
+    print(f'{len(names)} tests, {len(failures)} failures in {result.duration:.2f} seconds')
+
+    if not_run:
+        print(str(not_run) + ' tests were not run')
+
+    if any(o.status == 2 for o in outcomes):
+        return 2
+
+    return 1 if failures else 0
+
+
+options, test_filter = runner.parse_arguments(' '.join(sys.argv[2:]))
+
+if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+    print(
+        'Usage: python -m shard <shards.json> [--concurrency=N] [--timeout=S] [--deadline=S] [--order=...]'
+        ' [--results=path] [filter]'
+    )
+    exit(2)
+
+runner.configure_log()
+
+try:
+    shards = load_shards(sys.argv[1])
+except (OSError, KeyError, TypeError, ValueError) as e:
+    print('Could not read the shards: ' + str(e))
+    exit(2)
+
+exit(asyncio.run(run_sharded(shards, test_filter, options)))
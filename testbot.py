@@ -1,19 +1,135 @@
+import abc
 import asyncio
+import collections
+import contextlib
+import contextvars
 import discord
 import functools
 import logging
+import metrics
+import ratelimit
 import re
+import time
 import typing
 
 log = logging.getLogger('testbot')
 CheckFunction = typing.Callable[[typing.Any], typing.Coroutine[typing.Any, typing.Any, None]]
 
-current_guild = None
-expect_future = None
-awaiting_from = 0
-default_channel = None
-bot_under_test = None
-total_expectations = 0
+# Test functions are async, take no parameters, and return None.
+TestFunction = typing.Callable[[], typing.Coroutine[typing.Any, typing.Any, None]]
+
+# The number of seconds expect() waits for a message in a new run, until changed by set_default_timeout().
+default_timeout = 15.0
+
+# The event history and dispatcher below are shared by every run.  Channel IDs are unique across guilds, and events
+# keyed by member ID are only matched in the guild of the member being waited on.
+
+# Events are numbered in the order they are received, so that expectations can ask for events after a given point.
+Event = typing.Tuple[int, typing.Any]
+event_count = 0
+
+# Queues of events for each pending expectation, keyed by the ID of the channel or member being waited on.
+waiters: typing.Dict[int, typing.List[asyncio.Queue]] = {}
+
+# Queues for pending expectations which only pass messages with certain texts, keyed by channel or member ID and then
+# by text.  A message is only put in the queues indexed by its text, so any number of these cost one lookup per message.
+text_waiters: typing.Dict[int, typing.Dict[str, typing.List[asyncio.Queue]]] = {}
+
+# The most recent events from the bot under test, keyed by channel or member ID.
+# Each inbox holds at most inbox_capacity events, and the least recently used inbox is dropped when there are more
+# than max_inboxes.
+inbox_capacity = 50
+max_inboxes = 200
+inboxes: collections.OrderedDict[int, collections.deque[Event]] = collections.OrderedDict()
+
+# The channel or member ID and number of recent events which have passed an expectation.
+# An event can only pass one expectation, so that tests running side by side on one channel don't share responses.
+claimed: typing.Set[typing.Tuple[int, int]] = set()
+claim_order: collections.deque[typing.Tuple[int, int]] = collections.deque()
+max_claims = 1000
+
+# The event count when the current test started, or None if no test is running.
+test_start: contextvars.ContextVar[int | None] = contextvars.ContextVar('test_start', default=None)
+
+# The event count when the current test last sent a message, or None if it hasn't sent one.
+last_sent: contextvars.ContextVar[int | None] = contextvars.ContextVar('last_sent', default=None)
+
+# The messages sent and received by the current test, most recent last, or None if no test is running.
+# Only the last max_captured are kept, so that a chatty test can't use unbounded memory.
+captured: contextvars.ContextVar[collections.deque[str] | None] = contextvars.ContextVar('captured', default=None)
+max_captured = 100
+
+
+class RunContext:
+    '''
+    The state of a test run in one guild.
+
+    The current run is carried by a context variable, which tasks started by the run inherit.  So one TestBot can run
+    tests in several guilds at once, and the functions below act on the run of the task calling them.
+    '''
+
+    def __init__(self, guild: discord.Guild) -> None:
+        self.guild = guild
+        self.default_channel: discord.TextChannel | None = None
+        self.bot: discord.Member | None = None
+        self.total_expectations = 0
+        self.default_timeout = default_timeout
+
+        # Channels, roles and members of the guild, keyed by kind ('channel', 'role' or 'member') and then by name.
+        # Each kind is indexed when it is first looked up, and kept up to date by index_add() and index_remove().
+        # Names map to lists so that ambiguous names can be detected.
+        self.name_index: typing.Dict[str, typing.Dict[str, typing.List[typing.Any]]] = {}
+
+        # The number of the last event which passed an expectation in this run, keyed by channel or member ID.
+        # Members are in every guild they have joined, so each run keeps its own.
+        self.consumed: typing.Dict[int, int] = {}
+
+        # The IDs of TestBot's roles, as last confirmed by a member update, or None until first needed.
+        self.my_role_ids: typing.Set[int] | None = None
+
+        # The set up fixtures, in the order they were set up, keyed by scope and then by the test task or module.
+        self.fixture_cache: typing.Dict[typing.Tuple[str, typing.Any], typing.Dict['Fixture', 'FixtureState']] = {}
+
+        # The locks which stop two tests setting up the same fixture at once, keyed in the same way.
+        self.fixture_locks: typing.Dict[typing.Tuple[str, typing.Any], typing.Dict['Fixture', asyncio.Lock]] = {}
+
+
+# The run of the current task, or None if it is not running tests.
+current_run: contextvars.ContextVar[RunContext | None] = contextvars.ContextVar('current_run', default=None)
+
+# The runs in progress, keyed by guild ID, so that events can be passed to the run in their guild.
+active_runs: typing.Dict[int, RunContext] = {}
+
+
+def other_runs() -> typing.List[RunContext]:
+    '''
+    Get the runs in progress in guilds other than the current task's.
+    '''
+
+    return [r for r in active_runs.values() if r is not current_run.get()]
+
+
+def run_context() -> RunContext:
+    '''
+    Get the current run.
+
+    Raises an Exception if the current task is not running tests.
+    '''
+
+    run = current_run.get()
+
+    if run is None:
+        raise Exception('No current guild')
+
+    return run
+
+
+def find_run(g: discord.Guild | None) -> RunContext | None:
+    '''
+    Get the run in progress in a guild, or None.
+    '''
+
+    return active_runs.get(g.id) if g is not None else None
 
 
 def guild() -> discord.Guild:
@@ -23,19 +139,28 @@ def guild() -> discord.Guild:
     Raises an exception if there is no current guild, ie the message was a DM.
     '''
 
-    if current_guild is None:
-        raise Exception('No current guild')
-
-    return current_guild
+    return run_context().guild
 
 
 def set_guild(new_guild: discord.Guild | None) -> None:
     '''
-    Set the current guild.
+    Start a run in a guild, for the current task and the tasks it starts.
+
+    Setting the guild to None ends the current run.
     '''
 
-    global current_guild
-    current_guild = new_guild
+    run = current_run.get()
+
+    if run is not None and active_runs.get(run.guild.id) is run:
+        del active_runs[run.guild.id]
+
+    if new_guild is None:
+        current_run.set(None)
+        return
+
+    run = RunContext(new_guild)
+    current_run.set(run)
+    active_runs[new_guild.id] = run
 
 
 def set_default_channel(c: discord.TextChannel) -> None:
@@ -43,8 +168,7 @@ def set_default_channel(c: discord.TextChannel) -> None:
     Set the default channel to be returned if no channel name is given to text_channel().
     '''
 
-    global default_channel
-    default_channel = c
+    run_context().default_channel = c
 
 
 def get_bot() -> discord.Member:
@@ -54,10 +178,12 @@ def get_bot() -> discord.Member:
     Raises an Exception if there is no bot under test.
     '''
 
-    if bot_under_test is None:
+    bot = find_bot()
+
+    if bot is None:
         raise Exception('No bot under test')
 
-    return bot_under_test
+    return bot
 
 
 def find_bot() -> discord.Member | None:
@@ -65,7 +191,9 @@ def find_bot() -> discord.Member | None:
     Get the Member object for the bot under test, or None.
     '''
 
-    return bot_under_test
+    run = current_run.get()
+
+    return run.bot if run is not None else None
 
 
 def set_bot(bot: discord.Member | None) -> None:
@@ -73,8 +201,12 @@ def set_bot(bot: discord.Member | None) -> None:
     Set the bot under test.
     '''
 
-    global bot_under_test
-    bot_under_test = bot
+    run = current_run.get()
+
+    if run is not None:
+        run.bot = bot
+    elif bot is not None:
+        raise Exception('No current guild')
 
 
 def get_total_expectations() -> int:
@@ -82,389 +214,1918 @@ def get_total_expectations() -> int:
     Get the number of times that the expect() function has been called.
     '''
 
-    return total_expectations
+    return run_context().total_expectations
 
 
-def member_update(member: discord.Member) -> None:
+def set_default_timeout(seconds: float) -> None:
     '''
-    Handle a change to a guild member.
+    Set the number of seconds that expect() waits for a message when no timeout is given.
     '''
 
-    global expect_future
-
-    if expect_future is not None and not expect_future.done():
-        if member.id == awaiting_from:
-            expect_future.set_result(member)
+    run_context().default_timeout = seconds
 
 
-def receive_message(message: discord.Message) -> None:
+def set_inbox_capacity(capacity: int, inboxes_kept: int = 200) -> None:
     '''
-    Handle a received message.
+    Set the number of recent events kept for each channel or member, and the number of channels and members kept.
+
+    Events are kept before it is known which run they belong to, so the inboxes are shared by every run.  Raises a
+    ValueError if runs in other guilds are in progress with a different capacity.
     '''
 
-    global expect_future
+    global inbox_capacity
+    global max_inboxes
 
-    if expect_future is not None and not expect_future.done():
-        if message.author.id == awaiting_from or message.channel.id == awaiting_from:
-            expect_future.set_result(message)
+    if other_runs() and (capacity, inboxes_kept) != (inbox_capacity, max_inboxes):
+        raise ValueError(
+            f'The inbox size can\'t be changed to {capacity} while runs in other servers keep {inbox_capacity} events'
+        )
 
+    inbox_capacity = capacity
+    max_inboxes = inboxes_kept
 
-def channel(name: str) -> discord.abc.GuildChannel:
-    '''
-    Fetch a channel in the current guild.
+    for key, inbox in inboxes.items():
+        inboxes[key] = collections.deque(inbox, maxlen=capacity)
 
-    name: The name of the channel to fetch.
+    while len(inboxes) > max_inboxes:
+        inboxes.popitem(last=False)
 
-    Raises an Exception if the channel does not exist.
-    '''
 
-    g = guild()
+def mark() -> int:
+    '''
+    Get a marker for the current point in the event history.
 
-    if g is None:
-        raise Exception('Could not find channel ' + name + ': No current guild')
+    Passing the marker to expect() as "since" only matches events received after this call.
+    '''
 
-    for channel in g.channels:
-        if channel.name == name:
-            return channel
+    return event_count
 
-    raise Exception('Could not find channel ' + name)
 
+def start_test() -> None:
+    '''
+    Mark the start of a test.
 
-def text_channel(name: str = '') -> discord.TextChannel:
+    By default expect() only looks at events received since the test started.
     '''
-    Fetch a text channel.
 
-    If the name is not specified then it selects the channel from which the "!test" command was issued.
+    test_start.set(mark())
+    last_sent.set(None)
+    captured.set(collections.deque(maxlen=max_captured))
+
+
+def default_since(sender: discord.TextChannel | discord.Member, final: bool = False) -> int:
     '''
+    Get the marker from which expect() checks messages when it isn't given one.
 
-    if not name:
-        if default_channel is None:
-            raise Exception('No default channel')
+    This is the start of the test, or the last message which passed an expectation on the sender if that is later.  If
+    final is True then only messages received after the test last sent a message are checked, so that a response to an
+    earlier command cannot decide the expectation.
+    '''
 
-        return default_channel
+    start = test_start.get()
 
-    c = channel(name)
+    if start is None:
+        return mark()
 
-    if not isinstance(c, discord.TextChannel):
-        raise Exception('Channel #' + name + ' is not a text channel')
+    since = max(start, run_context().consumed.get(sender.id, 0))
+    sent = last_sent.get()
 
-    return c
+    return max(since, sent) if final and sent is not None else since
 
 
-def voice_channel(name: str) -> discord.VoiceChannel:
+def capture(line: str) -> None:
     '''
-    Fetch a voice channel.
+    Add a line to the messages captured for the current test, if a test is running.
     '''
 
-    c = channel(name)
+    lines = captured.get()
 
-    if not isinstance(c, discord.VoiceChannel):
-        raise Exception('Channel #' + name + ' is not a voice channel')
+    if lines is not None:
+        lines.append(line)
 
-    return c
 
+def captured_messages() -> typing.List[str]:
+    '''
+    Get the messages captured for the current test.
 
-def text(value: str) -> CheckFunction:
+    Messages sent by the test start with "> " and events received by its expectations start with "< ".
     '''
-    Expect a text message.
 
-    value: The text expected to be received.
+    return list(captured.get() or ())
+
+
+def dispatch(key: int, event: typing.Any, record: bool = True) -> None:
     '''
+    Pass an event to every expectation waiting on the given channel or member ID.
 
-    async def check(message: discord.Message) -> None:
-        '''
-        Check the text of the message.
+    If record is True then the event is also kept in the inbox for the ID.
+    '''
 
-        Raises an Exception if the actual text does not match the expected text.
-        '''
+    numbered = (event_count, event)
 
-        if message.content != value:
-            raise Exception('Expected: "' + value + '" Found: "' + message.content + '"')
+    if record:
+        inbox = inboxes.get(key)
 
-    return check
+        if inbox is None:
+            inbox = inboxes[key] = collections.deque(maxlen=inbox_capacity)
 
+            if len(inboxes) > max_inboxes:
+                inboxes.popitem(last=False)
+        else:
+            inboxes.move_to_end(key)
 
-def regex(rx: str) -> CheckFunction:
-    '''
-    Expect a text message.
+        inbox.append(numbered)
 
-    rx: A regular expression matching the text expected to be received.
+    for queue in waiters.get(key, ()):
+        queue.put_nowait(numbered)
+
+    indexed = text_waiters.get(key)
+
+    if indexed and isinstance(event, discord.Message):
+        for queue in indexed.get(event.content, ()):
+            queue.put_nowait(numbered)
+
+
+def claim(key: int, number: int) -> None:
+    '''
+    Record that an event has passed an expectation, so that it cannot pass another.
     '''
 
-    async def check(message: discord.Message) -> None:
-        '''
-        Check the text of the message.
+    claimed.add((key, number))
+    claim_order.append((key, number))
+
+    if len(claim_order) > max_claims:
+        claimed.discard(claim_order.popleft())
 
-        Raises an Exception if the actual text does not match the expected text.
-        '''
 
-        if not re.fullmatch(rx, message.content):
-            raise Exception('Expected: "' + rx + '" Found: "' + message.content + '"')
+def recent_events(key: int, since: int) -> typing.List[Event]:
+    '''
+    Get the events in the inbox for a channel or member ID which were received after the given marker.
+    '''
 
-    return check
+    return [e for e in inboxes.get(key, ()) if e[0] > since]
 
 
-def add_role(role_name: str) -> CheckFunction:
+class StreamEvent(typing.NamedTuple):
     '''
-    Expect a user to obtain the given role.
+    An event passed to event streams.
+
+    kind: One of stream_kinds.
+    sender_id: The ID of the message's author, the user who reacted or the member who changed.
+    channel_id: The ID of the channel, or None for member changes.
+    guild_id: The ID of the guild, or None for direct messages.
+    value: The message for "message", "edit" and "delete", the message reacted to for reactions, or the member.
+    before: The message before an edit.
+    emoji: The emoji of a reaction.
     '''
 
-    async def check(member: discord.Member) -> None:
-        '''
-        Check that the member has a particular role.
-        Raises an exception if the user does not have the role.
-        '''
+    kind: str
+    sender_id: int
+    channel_id: int | None
+    guild_id: int | None
+    value: typing.Any
+    before: typing.Any = None
+    emoji: str | None = None
+
+
+stream_kinds = ('message', 'edit', 'delete', 'reaction_add', 'reaction_remove', 'member')
 
-        if discord.utils.get(member.roles, name=role_name) is None:
-            raise Exception('Expected role "' + role_name + '" to be added')
+# The open event streams.  Each one sees every event, and keeps those which match its filter.
+streams: typing.List['EventStream'] = []
 
-    return check
+# The most events an event stream holds before they are read, unless given a capacity.
+stream_capacity = 100
 
 
-def remove_role(role_name: str) -> CheckFunction:
+def publish(event: StreamEvent) -> None:
     '''
-    Expect a user to have the given role removed.
+    Pass an event to the event streams which want it.
     '''
 
-    async def check(member: discord.Member) -> None:
-        '''
-        Check that the member has a particular role.
-        Raises an exception if the user does not have the role.
-        '''
+    for stream in streams:
+        if stream.accepts(event):
+            stream.put(event)
+
+
+def member_update(member: discord.Member) -> None:
+    '''
+    Handle a change to a guild member.
+
+    Changes to TestBot and the bot under test in a guild with a run in progress are kept in the inbox.
+    '''
+
+    global event_count
 
-        if discord.utils.get(member.roles, name=role_name) is not None:
-            raise Exception('Expected role "' + role_name + '" to be removed')
+    event_count += 1
+    run = find_run(member.guild)
+    bot_id = run.bot.id if run is not None and run.bot is not None else None
+    dispatch(member.id, member, run is not None and member.id in (bot_id, member.guild.me.id))
 
-    return check
+    if run is not None and member.id == run.guild.me.id:
+        run.my_role_ids = {r.id for r in member.roles}
 
+    if streams:
+        publish(StreamEvent('member', member.id, None, member.guild.id, member))
 
-def all(*checks: CheckFunction) -> CheckFunction:
+
+def receive_message(message: discord.Message) -> None:
     '''
-    Require multiple checks to pass.
+    Handle a received message.
+
+    Messages are passed to expectations on the message's author, and to expectations on the message's channel if the
+    message was sent by the bot under test of the run in the message's guild.  Messages from the bot under test are
+    kept in the inbox.
+
+    Direct messages are only passed to event streams.
     '''
 
-    async def check(arg: typing.Any) -> None:
-        '''
-        Call every check.
-        Raises an exception if any of them fail.
-        '''
-        for c in checks:
-            await c(arg)
+    global event_count
+
+    if streams:
+        guild_id = getattr(message.guild, 'id', None)
+        publish(StreamEvent('message', message.author.id, message.channel.id, guild_id, message))
+
+    if message.guild is None:
+        return
+
+    event_count += 1
+    run = find_run(message.guild)
+    from_bot = run is not None and run.bot is not None and message.author.id == run.bot.id
+
+    dispatch(message.author.id, message, from_bot)
 
-    return check
+    if from_bot:
+        dispatch(message.channel.id, message)
 
 
-def any(*checks: CheckFunction) -> CheckFunction:
+def message_edit(before: discord.Message, after: discord.Message) -> None:
     '''
-    Require at least one of multiple checks to pass.
+    Handle an edited message.  Edits are only passed to event streams.
     '''
 
-    async def check(arg: typing.Any) -> None:
-        '''
-        Call every check.
-        Raises an exception if all of them fail.
-        '''
+    if streams:
+        guild_id = getattr(after.guild, 'id', None)
+        publish(StreamEvent('edit', after.author.id, after.channel.id, guild_id, after, before=before))
 
-        for c in checks:
-            try:
-                await c(arg)
-                return
-            except Exception:
-                pass
 
-    return check
+def message_delete(message: discord.Message) -> None:
+    '''
+    Handle a deleted message.  Deletions are only passed to event streams.
+    '''
+
+    if streams:
+        guild_id = getattr(message.guild, 'id', None)
+        publish(StreamEvent('delete', message.author.id, message.channel.id, guild_id, message))
 
 
-def embed(description: str, *fields: dict) -> CheckFunction:
+def reaction_change(kind: str, reaction: discord.Reaction, user: discord.abc.Snowflake) -> None:
     '''
-    Expect a message with an embed.
+    Handle a reaction being added or removed.  Reactions are only passed to event streams.
 
-    Expected fields are dicts with the optional keys 'name' and 'value'.
+    kind: "reaction_add" or "reaction_remove".
+    '''
 
-    description: The expected description of the embed.
-    fields: The expected fields of the embed.
+    if streams:
+        message = reaction.message
+        guild_id = getattr(message.guild, 'id', None)
+        publish(StreamEvent(kind, user.id, message.channel.id, guild_id, message, emoji=str(reaction.emoji)))
 
-    Raises an Exception if the actual embed does not match the expected embed.
+
+class EventStream:
     '''
+    The events which match a filter, in the order they arrive, for reading with "async for".
 
-    async def check(message: discord.Message) -> None:
+    Reading waits for the next event, and raises an Exception if none arrives within the timeout.  Events which arrive
+    while the stream is full are lost, so the stream raises an Exception once it has given out the events it kept.
+    '''
+
+    def __init__(
+        self,
+        guild_id: int,
+        sender_ids: typing.FrozenSet[int] | None,
+        channel_id: int | None,
+        kinds: typing.FrozenSet[str],
+        capacity: int,
+        timeout: float
+    ) -> None:
+        self.guild_id = guild_id
+        self.sender_ids = sender_ids
+        self.channel_id = channel_id
+        self.kinds = kinds
+        self.capacity = capacity
+        self.timeout = timeout
+        self.queue: asyncio.Queue[StreamEvent] = asyncio.Queue(capacity)
+        self.overflowed = False
+
+    def accepts(self, event: StreamEvent) -> bool:
         '''
-        Check the embeds within the message.
+        Check whether an event matches the stream's filter.
         '''
 
-        if len(message.embeds) == 0:
-            raise Exception('Expected embed "' + description + '", Found no embeds')
+        return (
+            event.kind in self.kinds
+            and event.guild_id in (None, self.guild_id)
+            and (self.sender_ids is None or event.sender_id in self.sender_ids)
+            and (self.channel_id is None or event.channel_id == self.channel_id)
+        )
+
+    def put(self, event: StreamEvent) -> None:
+        '''
+        Add an event to the stream, unless it is full.
+        '''
 
-        if message.embeds[0].description != description:
-            found = message.embeds[0].description if message.embeds[0].description is not None else '[None]'
-            raise Exception('Expected embed: "' + description + '" Found: "' + found + '"')
+        if self.queue.full():
+            self.overflowed = True
+        else:
+            self.queue.put_nowait(event)
 
-        if len(message.embeds[0].fields) != len(fields):
-            expected_count = str(len(message.embeds[0].fields))
-            raise Exception('Expected embed to have ' + str(len(fields)) + ', Found ' + expected_count)
+    def __aiter__(self) -> 'EventStream':
+        return self
 
-        for [i, expected] in enumerate(fields):
-            for key, value in expected.items():
-                if value != getattr(message.embeds[0].fields[i], key):
-                    expected_field = str(i) + ' to have "' + key + '" = "' + value
-                    actual = message.embeds[0].fields[i].name
-                    raise Exception('Expected embed field ' + expected_field + '", Found: "' + actual + '"')
+    async def __anext__(self) -> StreamEvent:
+        if self.overflowed and self.queue.empty():
+            raise Exception('More than ' + str(self.capacity) + ' events arrived before they were read')
 
-    return check
+        try:
+            async with asyncio.timeout(self.timeout):
+                event = await self.queue.get()
+        except TimeoutError as e:
+            raise Exception('Timed out waiting for ' + ' or '.join(sorted(self.kinds)) + ' events') from e
 
+        capture('< ' + event.kind + ' ' + describe_event(event.value))
 
-def get_expectation_name(expectation: CheckFunction) -> str:
+        return event
+
+
+@contextlib.contextmanager
+def event_stream(
+    sender: discord.abc.Snowflake | typing.Iterable[discord.abc.Snowflake] | None = None,
+    channel: discord.abc.Snowflake | None = None,
+    kinds: typing.Iterable[str] = stream_kinds,
+    capacity: int | None = None,
+    timeout: float | None = None
+) -> typing.Iterator[EventStream]:
     '''
-    Get a readable name for an expectation.
+    Open a stream of events for the body of a "with" block.
+
+    Only events which arrive after the stream is opened are in it.
+
+    sender: The member or members whose events are wanted.  Defaults to the bot under test.
+    channel: The channel whose events are wanted.  Defaults to every channel, and direct messages.
+    kinds: The kinds of event wanted, from stream_kinds.  Defaults to every kind.
+    capacity: The most events to hold before they are read.  Defaults to stream_capacity.
+    timeout: The number of seconds to wait for each event.  Defaults to the value given to set_default_timeout().
     '''
 
-    expecting_func_name = expectation.__qualname__.split('.')[0]
+    unknown = set(kinds) - set(stream_kinds)
 
-    closure = getattr(expectation, '__closure__', None)
+    if unknown:
+        raise Exception('Unknown event kinds: ' + ', '.join(sorted(unknown)))
 
-    if closure:
-        func_params = ', '.join([str(c.cell_contents) for c in closure])
-    else:
-        func_params = ''
+    run = run_context()
 
-    return expecting_func_name + '(' + func_params + ')'
+    if sender is None:
+        sender = get_bot()
+
+    senders = [sender] if isinstance(sender, discord.abc.Snowflake) else list(sender)
+    stream = EventStream(
+        run.guild.id,
+        frozenset(s.id for s in senders),
+        channel.id if channel is not None else None,
+        frozenset(kinds),
+        capacity if capacity is not None else stream_capacity,
+        timeout if timeout is not None else run.default_timeout
+    )
+    streams.append(stream)
 
+    try:
+        yield stream
+    finally:
+        streams.remove(stream)
 
-async def expect(sender: discord.TextChannel | discord.Member, expectation: CheckFunction) -> None:
+
+def name_of(kind: str, item: typing.Any) -> str:
+    '''
+    Get the name by which a channel, role or member is looked up.
     '''
-    Expect a message from the bot under test.
 
-    sender: The channel on which the message is expected or the user from which the message should originate.
-    expectation: The value expected to be recevied.
+    return item.display_name if kind == 'member' else item.name
+
+
+def names(kind: str) -> typing.Dict[str, typing.List[typing.Any]]:
+    '''
+    Get the index of the current guild's channels, roles or members by name, building it if necessary.
     '''
 
-    global expect_future
-    global awaiting_from
-    global total_expectations
+    run = run_context()
+    index = run.name_index.get(kind)
 
-    if not callable(expectation):
-        raise Exception('expect() parameter 2 must be a CheckFunction, found a ' + str(type(expectation)))
+    if index is None:
+        index = run.name_index[kind] = {}
+        items: typing.Sequence[typing.Any]
 
-    expectation_name = get_expectation_name(expectation)
-    expect_future = asyncio.get_running_loop().create_future()
-    awaiting_from = sender.id
-    total_expectations += 1
-    messages = []
+        if kind == 'channel':
+            items = run.guild.channels
+        elif kind == 'role':
+            items = run.guild.roles
+        else:
+            items = run.guild.members
 
-    log.debug('Testing expectation ' + expectation_name)
+        for item in items:
+            index.setdefault(name_of(kind, item), []).append(item)
 
-    try:
-        passed_synchronously = False
+    return index
 
-        # If the sender is a Member then try running the check synchronously.
-        # A member_update event happens synchronously when adding or removing a role and so may
-        # have already happened by the time we get here.
-        # If it hasn't happened then keep waiting.
-        if isinstance(sender, discord.Member):
-            try:
-                await expectation(sender)
-                log.debug('Expectation passed synchronously')
-                passed_synchronously = True
-            except Exception:
-                # Ignore exceptions and try again asynchronously
-                pass
 
-        if not passed_synchronously:
-            async with asyncio.timeout(15):
-                # Keep trying until the test passes or times out.
-                while True:
-                    # Wait for the response from the bot under test.
-                    await expect_future
-
-                    # Process the response.
-                    try:
-                        result = expect_future.result()
-                        messages.append(result)
-                        expect_future = asyncio.get_running_loop().create_future()
-                        await expectation(result)
-                        log.debug('Expectation passed asynchronously')
-                        break
-                    except Exception:
-                        # Failed to match.
-                        log.debug('Failed to meet expectations.  Retrying...')
-    except TimeoutError as e:
-        # TimeoutError does not have an error message, so create one.
-        msg = 'Test timed out waiting for ' + expectation_name
+def index_add(kind: str, item: typing.Any) -> None:
+    '''
+    Add a channel, role or member which has been created or updated to the name index of the run in its guild.
+    '''
 
-        if len(messages):
-            msg += '. Received: ' + ', '.join(messages)
+    run = find_run(item.guild)
+    index = run.name_index.get(kind) if run is not None else None
 
-        raise Exception(msg) from e
-    finally:
-        expect_future = None
+    if index is not None:
+        index_remove(kind, item)
+        index.setdefault(name_of(kind, item), []).append(item)
 
 
-def role(name: str) -> discord.Role:
+def index_remove(kind: str, item: typing.Any) -> None:
     '''
-    Fetch a user role by name.
+    Remove a channel, role or member which has been deleted, or is about to be updated, from the name index of the run
+    in its guild.
 
-    Raises an Exception if the role is not found.
+    The item is found by its ID under its current name, so when a name changes the old object should be removed.
     '''
 
-    r = discord.utils.get(guild().roles, name=name)
+    run = find_run(item.guild)
+    index = run.name_index.get(kind) if run is not None else None
+    name = name_of(kind, item)
 
-    if r is None:
-        raise Exception('Failed to find role: ' + name)
+    if index is None or name not in index:
+        return
 
-    return r
+    index[name] = [i for i in index[name] if i.id != item.id]
 
+    if not index[name]:
+        del index[name]
 
-def member(name: str) -> discord.Member:
+
+def find_named(kind: str, name: str, cls: type = object) -> typing.Any:
     '''
-    Fetch a member by name.
+    Find the channel, role or member in the current guild with the given name and type, or None.
+
+    Raises an Exception if more than one has the name.
     '''
 
-    u = discord.utils.get(guild().members, display_name=name)
+    found = [i for i in names(kind).get(name, ()) if isinstance(i, cls)]
 
-    if u is None:
-        raise Exception('Failed to find member: ' + name)
+    if len(found) > 1:
+        raise Exception('Ambiguous ' + kind + ' name "' + name + '": ' + str(len(found)) + ' ' + kind + 's have it')
 
-    return u
+    return found[0] if found else None
 
 
-# The object being decorated is a function which accepts any arguments and returns any type.
-AnyFunction = typing.Callable[..., typing.Any]
+def channel(name: str) -> discord.abc.GuildChannel:
+    '''
+    Fetch a channel in the current guild.
 
-# The decorator factory returns a decorator, which i.
-DecoratorType = typing.Callable[[AnyFunction], AnyFunction]
+    name: The name of the channel to fetch.
+
+    Raises an Exception if the channel does not exist, or if more than one channel has the name.
+    '''
+
+    if current_run.get() is None:
+        raise Exception('Could not find channel ' + name + ': No current guild')
 
+    c = find_named('channel', name)
 
-def with_role(name: str) -> DecoratorType:
+    if c is None:
+        raise Exception('Could not find channel ' + name)
+
+    return c
+
+
+def text_channel(name: str = '') -> discord.TextChannel:
     '''
-    A function decorator for giving TestBot a certain role for the duration of a test.
+    Fetch a text channel.
 
-    The name parameter is the name of the role to assign.
+    If the name is not specified then it selects the channel from which the "!test" command was issued.
     '''
 
-    def decorator(func: AnyFunction) -> AnyFunction:
-        '''
-        Return a wrapper around the given function.
-        '''
+    if not name:
+        default_channel = run_context().default_channel
 
-        @functools.wraps(func)
-        async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
-            '''
-            Assign a role, call the wrapped function, then remove the role.
-            '''
+        if default_channel is None:
+            raise Exception('No default channel')
 
-            role = discord.utils.get(guild().roles, name=name)
+        return default_channel
 
-            if role is None:
-                raise Exception('Could not find a role with the name: ' + name)
+    c = find_named('channel', name, discord.TextChannel)
 
-            await guild().me.add_roles(role)
+    if c is None:
+        # Report a missing channel, rather than the wrong type of channel, if no channel has the name.
+        channel(name)
+        raise Exception('Channel #' + name + ' is not a text channel')
 
-            result = await func(*args, **kwargs)
+    return c
 
-            await guild().me.remove_roles(role)
 
-            return result
+def voice_channel(name: str) -> discord.VoiceChannel:
+    '''
+    Fetch a voice channel.
+    '''
 
-        return wrapper
+    c = find_named('channel', name, discord.VoiceChannel)
+
+    if c is None:
+        # Report a missing channel, rather than the wrong type of channel, if no channel has the name.
+        channel(name)
+        raise Exception('Channel #' + name + ' is not a voice channel')
+
+    return c
+
+
+class Matcher(abc.ABC):
+    '''
+    An expectation which is built once, when the test creates it, and can then check any number of events.
+
+    Matchers are CheckFunctions: awaiting a matcher with an event raises an Exception if the event does not pass.
+    '''
+
+    # The texts which a message must have one of to pass, or None if messages with any text might pass.
+    # Waiters whose expectations all have texts are indexed by them, so that they are only given messages which might
+    # pass.
+    texts: typing.FrozenSet[str] | None = None
+
+    @abc.abstractmethod
+    async def __call__(self, event: typing.Any) -> None:
+        '''
+        Check an event, raising an Exception if it does not pass.
+        '''
+
+    @abc.abstractmethod
+    def describe(self) -> str:
+        '''
+        Get a readable description of the matcher for log and error messages.
+        '''
+
+
+class TextMatcher(Matcher):
+    '''
+    Expects a message with exactly the given text.
+    '''
+
+    def __init__(self, value: str) -> None:
+        self.value = value
+        self.texts = frozenset([value])
+
+    async def __call__(self, message: discord.Message) -> None:
+        if message.content != self.value:
+            raise Exception('Expected: "' + self.value + '" Found: "' + message.content + '"')
+
+    def describe(self) -> str:
+        return 'text(' + self.value + ')'
+
+
+class RegexMatcher(Matcher):
+    '''
+    Expects a message whose whole text matches a regular expression.
+    '''
+
+    def __init__(self, rx: str) -> None:
+        self.rx = rx
+        self.pattern = re.compile(rx)
+
+    async def __call__(self, message: discord.Message) -> None:
+        if not self.pattern.fullmatch(message.content):
+            raise Exception('Expected: "' + self.rx + '" Found: "' + message.content + '"')
+
+    def describe(self) -> str:
+        return 'regex(' + self.rx + ')'
+
+
+class RoleMatcher(Matcher):
+    '''
+    Expects a member to have, or not to have, a role.
+    '''
+
+    def __init__(self, role_name: str, present: bool) -> None:
+        self.role_name = role_name
+        self.present = present
+
+    async def __call__(self, member: discord.Member) -> None:
+        if (discord.utils.get(member.roles, name=self.role_name) is not None) != self.present:
+            change = 'added' if self.present else 'removed'
+            raise Exception('Expected role "' + self.role_name + '" to be ' + change)
+
+    def describe(self) -> str:
+        return ('add_role(' if self.present else 'remove_role(') + self.role_name + ')'
+
+
+class EmbedMatcher(Matcher):
+    '''
+    Expects a message whose first embed has the given description and fields.
+    '''
+
+    def __init__(self, description: str, fields: typing.Tuple[dict, ...]) -> None:
+        self.description = description
+        self.fields = fields
+
+        # The expected attributes of each field, so that each check only compares them.
+        self.field_items = [list(f.items()) for f in fields]
+
+    async def __call__(self, message: discord.Message) -> None:
+        if len(message.embeds) == 0:
+            raise Exception('Expected embed "' + self.description + '", Found no embeds')
+
+        found = message.embeds[0]
+
+        if found.description != self.description:
+            description = found.description if found.description is not None else '[None]'
+            raise Exception('Expected embed: "' + self.description + '" Found: "' + description + '"')
+
+        if len(found.fields) != len(self.field_items):
+            raise Exception(
+                'Expected embed to have ' + str(len(self.field_items)) + ' fields, Found ' + str(len(found.fields))
+            )
+
+        for i, (field, items) in enumerate(zip(found.fields, self.field_items)):
+            for key, value in items:
+                actual = getattr(field, key)
+
+                if value != actual:
+                    raise Exception(
+                        'Expected embed field ' + str(i) + ' to have "' + key + '" = "' + str(value) + '", Found: "'
+                        + str(actual) + '"'
+                    )
+
+    def describe(self) -> str:
+        return 'embed(' + ', '.join([self.description] + [str(f) for f in self.fields]) + ')'
+
+
+class AllMatcher(Matcher):
+    '''
+    Expects an event to pass every one of several checks.
+    '''
+
+    def __init__(self, checks: typing.Tuple[CheckFunction, ...]) -> None:
+        self.checks = checks
+        texts = [c.texts for c in checks if isinstance(c, Matcher) and c.texts is not None]
+
+        # A message must have the texts of every check with texts.
+        if texts:
+            self.texts = frozenset.intersection(*texts)
+
+    async def __call__(self, event: typing.Any) -> None:
+        for c in self.checks:
+            await c(event)
+
+    def describe(self) -> str:
+        return 'all(' + ', '.join(get_expectation_name(c) for c in self.checks) + ')'
+
+
+class AnyMatcher(Matcher):
+    '''
+    Expects an event to pass at least one of several checks.
+    '''
+
+    def __init__(self, checks: typing.Tuple[CheckFunction, ...]) -> None:
+        self.checks = checks
+        texts = [c.texts if isinstance(c, Matcher) else None for c in checks]
+
+        # A message must have the texts of one of the checks, unless one of them might pass any text.
+        if texts and None not in texts:
+            self.texts = frozenset().union(*typing.cast(typing.List[typing.FrozenSet[str]], texts))
+
+        # If every check is a text() then a message passes if it has any of their texts.
+        self.exact_texts = None
+
+        if checks and len([c for c in checks if isinstance(c, TextMatcher)]) == len(checks):
+            self.exact_texts = self.texts
+
+    async def __call__(self, event: typing.Any) -> None:
+        if self.exact_texts is not None and isinstance(event, discord.Message) and event.content in self.exact_texts:
+            return
+
+        errors = []
+
+        for c in self.checks:
+            try:
+                await c(event)
+                return
+            except Exception as e:
+                errors.append(e)
+
+        raise Exception('Expected any of: ' + '; '.join(str(e) for e in errors))
+
+    def describe(self) -> str:
+        return 'any(' + ', '.join(get_expectation_name(c) for c in self.checks) + ')'
+
+
+def text(value: str) -> Matcher:
+    '''
+    Expect a text message.
+
+    value: The text expected to be received.
+    '''
+
+    return TextMatcher(value)
+
+
+def regex(rx: str) -> Matcher:
+    '''
+    Expect a text message.
+
+    rx: A regular expression matching the text expected to be received.
+    '''
+
+    return RegexMatcher(rx)
+
+
+def add_role(role_name: str) -> Matcher:
+    '''
+    Expect a user to obtain the given role.
+    '''
+
+    return RoleMatcher(role_name, True)
+
+
+def remove_role(role_name: str) -> Matcher:
+    '''
+    Expect a user to have the given role removed.
+    '''
+
+    return RoleMatcher(role_name, False)
+
+
+def all(*checks: CheckFunction) -> Matcher:
+    '''
+    Require multiple checks to pass.
+    '''
+
+    return AllMatcher(checks)
+
+
+def any(*checks: CheckFunction) -> Matcher:
+    '''
+    Require at least one of multiple checks to pass.
+
+    Raises an Exception with the failure of each check if none of them pass.
+    '''
+
+    return AnyMatcher(checks)
+
+
+def embed(description: str, *fields: dict) -> Matcher:
+    '''
+    Expect a message with an embed.
+
+    Expected fields are dicts with the optional keys 'name' and 'value'.
+
+    description: The expected description of the embed.
+    fields: The expected fields of the embed.
+
+    Raises an Exception if the actual embed does not match the expected embed.
+    '''
+
+    return EmbedMatcher(description, fields)
+
+
+def get_expectation_name(expectation: CheckFunction) -> str:
+    '''
+    Get a readable name for an expectation.
+    '''
+
+    if isinstance(expectation, Matcher):
+        return expectation.describe()
+
+    expecting_func_name = expectation.__qualname__.split('.')[0]
+
+    closure = getattr(expectation, '__closure__', None)
+
+    if closure:
+        func_params = ', '.join([str(c.cell_contents) for c in closure])
+    else:
+        func_params = ''
+
+    return expecting_func_name + '(' + func_params + ')'
+
+
+def expectation_texts(expectations: typing.Iterable[CheckFunction]) -> typing.FrozenSet[str] | None:
+    '''
+    Get the texts which a message must have one of to pass any of the expectations, or None if any text might pass.
+    '''
+
+    texts: typing.FrozenSet[str] = frozenset()
+
+    for e in expectations:
+        if not isinstance(e, Matcher) or e.texts is None:
+            return None
+
+        texts |= e.texts
+
+    return texts
+
+
+def add_waiter(key: int, texts: typing.FrozenSet[str] | None = None) -> asyncio.Queue:
+    '''
+    Start collecting events for the given channel or member ID.
+
+    Returns a queue which receives every event dispatched to the ID until remove_waiter() is called.  If texts are
+    given then the queue only receives messages with one of the texts.
+    '''
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    if texts is None:
+        waiters.setdefault(key, []).append(queue)
+    else:
+        indexed = text_waiters.setdefault(key, {})
+
+        for t in texts:
+            indexed.setdefault(t, []).append(queue)
+
+    return queue
+
+
+def remove_waiter(key: int, queue: asyncio.Queue, texts: typing.FrozenSet[str] | None = None) -> None:
+    '''
+    Stop collecting events for the given channel or member ID.
+
+    texts: The texts given to add_waiter().
+    '''
+
+    if texts is None:
+        queues = waiters.get(key)
+
+        if queues is None:
+            return
+
+        queues.remove(queue)
+
+        if not queues:
+            del waiters[key]
+
+        return
+
+    indexed = text_waiters.get(key, {})
+
+    for t in texts:
+        queues = indexed.get(t)
+
+        if queues is not None:
+            queues.remove(queue)
+
+            if not queues:
+                del indexed[t]
+
+    if not indexed:
+        text_waiters.pop(key, None)
+
+
+# A message to send and the response expected to it.
+Step = typing.Tuple[str, CheckFunction]
+
+
+def describe_event(event: typing.Any) -> str:
+    '''
+    Get a readable description of a message or member update for error messages.
+    '''
+
+    if isinstance(event, discord.Message):
+        if event.embeds and not event.content:
+            return 'embed "' + str(event.embeds[0].description) + '"'
+
+        return '"' + event.content + '"'
+
+    if isinstance(event, discord.Member):
+        return event.display_name + ' with roles ' + ', '.join(r.name for r in event.roles)
+
+    return str(event)
+
+
+async def try_expectation(expectation: CheckFunction, event: typing.Any) -> Exception | None:
+    '''
+    Check an event against an expectation.
+
+    Returns the exception raised by the expectation, or None if the event passes.
+    '''
+
+    try:
+        await expectation(event)
+        return None
+    except Exception as e:
+        return e
+
+
+async def arrivals(
+    sender: discord.TextChannel | discord.Member,
+    queue: asyncio.Queue,
+    since: int,
+    texts: typing.FrozenSet[str] | None = None
+) -> typing.AsyncGenerator[Event, None]:
+    '''
+    Yield the numbered events for a channel or member which were received after the "since" marker.
+
+    Events in the inbox are yielded first, then events from a queue created by add_waiter() as they arrive.  Events
+    which have already passed an expectation are skipped, as are events from the member in other guilds, since a
+    member's ID is the same in every guild.
+
+    texts: Only yield messages from the inbox with one of these texts, as a queue indexed by them would.
+    '''
+
+    # Events from the queue which were already in the inbox are skipped.
+    last_seen = since
+
+    for number, event in recent_events(sender.id, since):
+        last_seen = number
+
+        if (sender.id, number) in claimed:
+            continue
+
+        if texts is None or isinstance(event, discord.Message) and event.content in texts:
+            yield number, event
+
+    while True:
+        number, event = await queue.get()
+        event_guild = getattr(event, 'guild', None)
+
+        if number <= last_seen or (sender.id, number) in claimed:
+            continue
+
+        if event_guild is None or event_guild.id == sender.guild.id:
+            yield number, event
+
+
+def waiter_texts(
+    expectations: typing.Iterable[CheckFunction],
+    reject: CheckFunction | None = None,
+    final: bool = False
+) -> typing.FrozenSet[str] | None:
+    '''
+    Get the texts to index a waiter for the expectations by, or None if the waiter must be given every event.
+
+    A waiter which rejects events, or fails on the first one, must see the events which don't pass too.
+    '''
+
+    return expectation_texts(expectations) if reject is None and not final else None
+
+
+def received_events(
+    key: int,
+    since: int,
+    checked: typing.List[Event],
+    texts: typing.FrozenSet[str] | None
+) -> typing.List[typing.Any]:
+    '''
+    Get the events received by a waiter, in the order they arrived.
+
+    checked: The events which the waiter checked.
+    texts: The texts that the waiter was indexed by, if any.  The events it was not given are added from the inbox.
+    '''
+
+    numbered = checked
+
+    if texts is not None:
+        until = checked[-1][0] if checked and (key, checked[-1][0]) in claimed else event_count
+        numbered = sorted(checked + skipped_events(key, since, until, texts), key=lambda e: e[0])
+
+    return [event for _, event in numbered]
+
+
+def skipped_events(key: int, since: int, until: int, texts: typing.FrozenSet[str]) -> typing.List[Event]:
+    '''
+    Get the events in the inbox for a channel or member ID which a waiter indexed by texts was not given.
+
+    These are the events received after "since" and up to "until" which don't have one of the texts, other than those
+    which passed another expectation.  They are reported as received in captured messages and error messages.
+    '''
+
+    return [
+        (n, e) for n, e in recent_events(key, since)
+        if n <= until and (key, n) not in claimed and not (isinstance(e, discord.Message) and e.content in texts)
+    ]
+
+
+async def wait_for(
+    sender: discord.TextChannel | discord.Member,
+    queue: asyncio.Queue,
+    expectation: CheckFunction,
+    since: int,
+    reject: CheckFunction | None = None,
+    final: bool = False,
+    timeout: float | None = None,
+    started: float | None = None
+) -> typing.Any:
+    '''
+    Wait for an event which passes the expectation, and return it.
+
+    The events from arrivals() are checked in turn.  Unless there is a reject check or final is True, only messages with
+    the expectation's texts are checked, if it has any, as a queue indexed by waiter_texts() is only given those.
+
+    sender: The channel or member that the queue is collecting events for.
+    reject: Fail immediately if an event passes this check.
+    final: Fail immediately if the first event does not pass the expectation.
+    timeout: The number of seconds to wait.  Defaults to the value given to set_default_timeout().
+    started: The time.monotonic() at which the message being responded to was sent.  Defaults to now.
+    '''
+
+    if not callable(expectation):
+        raise Exception('expect() parameter 2 must be a CheckFunction, found a ' + str(type(expectation)))
+
+    run = run_context()
+    expectation_name = get_expectation_name(expectation)
+    run.total_expectations += 1
+    texts = waiter_texts([expectation], reject, final)
+    checked: typing.List[Event] = []
+    start = started if started is not None else time.monotonic()
+    first_event = None
+    passed = False
+
+    log.debug('Testing expectation ' + expectation_name)
+
+    async def check(number: int, result: typing.Any) -> bool:
+        '''
+        Check a received event.
+
+        Returns True if the expectation passed, or raises an Exception if the expectation has failed for good.
+        '''
+
+        nonlocal first_event
+        nonlocal passed
+
+        if first_event is None:
+            first_event = time.monotonic()
+
+        checked.append((number, result))
+
+        if reject is not None and await try_expectation(reject, result) is None:
+            raise Exception(
+                'Expected ' + expectation_name + ', Received ' + describe_event(result)
+                + ' which matches ' + get_expectation_name(reject)
+            )
+
+        error = await try_expectation(expectation, result)
+
+        if error is None:
+            run.consumed[sender.id] = number
+            claim(sender.id, number)
+            passed = True
+            return True
+
+        if final:
+            raise Exception(str(error))
+
+        # Failed to match.
+        log.debug('Failed to meet expectations.  Retrying...')
+
+        return False
+
+    try:
+        # If the sender is a Member then try running the check synchronously.
+        # A member_update event happens synchronously when adding or removing a role and so may
+        # have already happened by the time we get here.
+        # If it hasn't happened then keep waiting.
+        if isinstance(sender, discord.Member):
+            if await try_expectation(expectation, sender) is None:
+                log.debug('Expectation passed synchronously')
+                passed = True
+                return sender
+
+        # Keep trying until the test passes or times out.
+        async with (
+            asyncio.timeout(timeout if timeout is not None else run.default_timeout),
+            contextlib.aclosing(arrivals(sender, queue, since, texts)) as events
+        ):
+            async for number, result in events:
+                if await check(number, result):
+                    log.debug('Expectation passed')
+                    return result
+    except TimeoutError as e:
+        # TimeoutError does not have an error message, so create one.
+        msg = 'Test timed out waiting for ' + expectation_name
+        messages = received_events(sender.id, since, checked, texts)
+
+        if len(messages):
+            msg += '. Received: ' + ', '.join(describe_event(m) for m in messages)
+
+        raise Exception(msg) from e
+    finally:
+        for event in received_events(sender.id, since, checked, texts):
+            capture('< ' + describe_event(event))
+
+        rejected = len(checked) - 1 if passed and checked else len(checked)
+        metrics.record('expect', expectation_name, start, first_event, rejected, passed)
+
+
+async def expect(
+    sender: discord.TextChannel | discord.Member,
+    expectation: CheckFunction,
+    since: int | None = None,
+    reject: CheckFunction | None = None,
+    final: bool = False,
+    timeout: float | None = None
+) -> None:
+    '''
+    Expect a message from the bot under test.
+
+    Messages already received are checked before waiting for new ones.  By default these are messages received since
+    the test started, not counting any that have already passed an expectation.  With final, they are only messages
+    received since the test last sent a message.
+
+    sender: The channel on which the message is expected or the user from which the message should originate.
+    expectation: The value expected to be recevied.
+    since: A marker from mark().  Only messages received after the marker are checked.
+    reject: Fail immediately if a message passes this check, rather than waiting for the timeout.
+    final: Fail immediately if the first message does not pass the expectation.
+    timeout: The number of seconds to wait.  Defaults to the value given to set_default_timeout().
+    '''
+
+    if since is None:
+        since = default_since(sender, final)
+
+    texts = waiter_texts([expectation], reject, final)
+    queue = add_waiter(sender.id, texts)
+
+    try:
+        await wait_for(sender, queue, expectation, since, reject, final, timeout)
+    finally:
+        remove_waiter(sender.id, queue, texts)
+
+
+async def send(channel: discord.TextChannel, content: str | None = None, **kwargs: typing.Any) -> discord.Message:
+    '''
+    Send a message, once it can be sent without exceeding Discord's rate limits.
+
+    Tests should send messages with this rather than channel.send(), so that any wait for a rate limit is recorded as
+    queueing rather than counted as the bot under test being slow.  Takes the same arguments as channel.send().
+    '''
+
+    command = '#' + channel.name + ' ' + (content or '').split(' ')[0]
+
+    await ratelimit.wait_turn('message', channel.id, '#' + channel.name)
+
+    if content is not None:
+        capture('> #' + channel.name + ' ' + content)
+
+    last_sent.set(mark())
+
+    async with metrics.timed('send', command):
+        return await channel.send(content, **kwargs)
+
+
+async def send_and_expect(
+    channel: discord.TextChannel,
+    content: str,
+    expectation: CheckFunction,
+    sender: discord.TextChannel | discord.Member | None = None,
+    reject: CheckFunction | None = None,
+    final: bool = False,
+    timeout: float | None = None
+) -> None:
+    '''
+    Send a message and expect a response from the bot under test.
+
+    The expectation starts listening before the message is sent, so a fast response cannot be missed.
+
+    channel: The channel to send the message to.
+    content: The message to send.
+    expectation: The response expected.
+    sender: The channel or member the response should come from.  Defaults to the channel the message was sent to.
+    reject, final, timeout: As for expect().
+    '''
+
+    await send_and_expect_each(channel, [(content, expectation)], sender, reject, final, timeout)
+
+
+async def send_and_expect_each(
+    channel: discord.TextChannel,
+    steps: typing.Iterable[Step],
+    sender: discord.TextChannel | discord.Member | None = None,
+    reject: CheckFunction | None = None,
+    final: bool = False,
+    timeout: float | None = None
+) -> None:
+    '''
+    Send a series of messages, expecting a response to each one before sending the next.
+
+    One listener is used for the whole series, so no responses are missed between steps.
+
+    channel: The channel to send the messages to.
+    steps: Pairs of the message to send and the response expected.
+    sender: The channel or member the responses should come from.  Defaults to the channel the messages are sent to.
+    reject, final, timeout: As for expect(), applied to every step.
+    '''
+
+    source = sender if sender is not None else channel
+    steps = list(steps)
+    texts = waiter_texts([e for _, e in steps], reject, final)
+    queue = add_waiter(source.id, texts)
+
+    try:
+        for content, expectation in steps:
+            command = '#' + channel.name + ' ' + content.split(' ')[0]
+
+            # The response time is measured from when the message is sent, not from when it was queued.
+            await ratelimit.wait_turn('message', channel.id, '#' + channel.name)
+            since = mark()
+            started = time.monotonic()
+            last_sent.set(since)
+
+            capture('> #' + channel.name + ' ' + content)
+
+            async with metrics.timed('send', command):
+                sent = await channel.send(content)
+
+            result = await wait_for(source, queue, expectation, since, reject, final, timeout, started)
+
+            # Discord's timestamps give the bot's response time without any delays on TestBot's side.
+            if isinstance(result, discord.Message):
+                metrics.record('reply', command, sent.created_at.timestamp(), end=result.created_at.timestamp())
+    finally:
+        remove_waiter(source.id, queue, texts)
+
+
+async def wait_for_group(
+    sender: discord.TextChannel | discord.Member,
+    queue: asyncio.Queue,
+    expectations: typing.Sequence[CheckFunction],
+    ordered: bool,
+    since: int,
+    timeout: float | None = None
+) -> typing.List[typing.Any]:
+    '''
+    Wait for a different event to pass each of the expectations, and return the events in the same order.
+
+    Each event from arrivals() is checked against the expectations which haven't passed yet, so one waiter and one
+    timeout cover the whole group.  If ordered is True then each event is only checked against the first expectation
+    which hasn't passed, so the events must arrive in order, although other events may arrive in between.  If every
+    expectation has texts then only messages with one of them are checked, as for wait_for().
+
+    An empty group passes at once.
+    '''
+
+    for expectation in expectations:
+        if not callable(expectation):
+            raise Exception('Expected a CheckFunction, found a ' + str(type(expectation)))
+
+    if not expectations:
+        return []
+
+    run = run_context()
+    names = [get_expectation_name(e) for e in expectations]
+    group_name = ('sequence' if ordered else 'all_of') + '(' + ', '.join(names) + ')'
+    run.total_expectations += len(expectations)
+    matched: typing.List[typing.Any] = [None] * len(expectations)
+    waiting = list(range(len(expectations)))
+    texts = waiter_texts(expectations)
+    checked: typing.List[Event] = []
+    start = time.monotonic()
+    first_event = None
+
+    log.debug('Testing expectations ' + group_name)
+
+    try:
+        async with (
+            asyncio.timeout(timeout if timeout is not None else run.default_timeout),
+            contextlib.aclosing(arrivals(sender, queue, since, texts)) as events
+        ):
+            async for number, result in events:
+                if first_event is None:
+                    first_event = time.monotonic()
+
+                checked.append((number, result))
+
+                for i in waiting[:1] if ordered else waiting:
+                    if await try_expectation(expectations[i], result) is None:
+                        matched[i] = result
+                        waiting.remove(i)
+                        run.consumed[sender.id] = max(run.consumed.get(sender.id, 0), number)
+                        claim(sender.id, number)
+                        break
+
+                if not waiting:
+                    return matched
+    except TimeoutError as e:
+        passed = [names[i] for i in range(len(names)) if i not in waiting]
+        msg = (
+            'Test timed out waiting for ' + group_name + ' after ' + str(len(passed)) + ' of ' + str(len(names))
+            + ' passed.  Passed: ' + (', '.join(passed) or 'none') + '.  Still waiting for: '
+            + ', '.join(names[i] for i in waiting)
+        )
+        messages = received_events(sender.id, since, checked, texts)
+
+        if messages:
+            msg += '.  Received: ' + ', '.join(describe_event(m) for m in messages[-10:])
+
+        raise Exception(msg) from e
+    finally:
+        for event in received_events(sender.id, since, checked, texts):
+            capture('< ' + describe_event(event))
+
+        rejected = len(checked) - (len(names) - len(waiting))
+        metrics.record('expect', group_name, start, first_event, rejected, not waiting)
+
+    return matched
+
+
+async def expect_group(
+    sender: discord.TextChannel | discord.Member,
+    expectations: typing.Sequence[CheckFunction],
+    ordered: bool,
+    since: int | None,
+    timeout: float | None
+) -> typing.List[typing.Any]:
+    '''
+    Wait for a group of expectations with wait_for_group(), starting from the same point as expect().
+    '''
+
+    if since is None:
+        since = default_since(sender)
+
+    texts = waiter_texts(expectations)
+    queue = add_waiter(sender.id, texts)
+
+    try:
+        return await wait_for_group(sender, queue, expectations, ordered, since, timeout)
+    finally:
+        remove_waiter(sender.id, queue, texts)
+
+
+async def expect_sequence(
+    sender: discord.TextChannel | discord.Member,
+    *expectations: CheckFunction,
+    since: int | None = None,
+    timeout: float | None = None
+) -> typing.List[typing.Any]:
+    '''
+    Expect messages which pass each of the expectations, in order.  Other messages may arrive in between.
+
+    One timeout covers the whole sequence, and if it runs out the error says how far the sequence got.
+    Returns the messages which passed, in order.
+
+    sender, since, timeout: As for expect().
+    '''
+
+    return await expect_group(sender, expectations, True, since, timeout)
+
+
+async def expect_all_of(
+    sender: discord.TextChannel | discord.Member,
+    *expectations: CheckFunction,
+    since: int | None = None,
+    timeout: float | None = None
+) -> typing.List[typing.Any]:
+    '''
+    Expect a different message to pass each of the expectations, in any order.
+
+    One timeout covers every expectation.  Returns the messages which passed, in the order of the expectations.
+
+    sender, since, timeout: As for expect().
+    '''
+
+    return await expect_group(sender, expectations, False, since, timeout)
+
+
+async def expect_count(
+    sender: discord.TextChannel | discord.Member,
+    count: int,
+    expectation: CheckFunction,
+    since: int | None = None,
+    timeout: float | None = None
+) -> typing.List[typing.Any]:
+    '''
+    Expect the given number of messages which pass the expectation.
+
+    One timeout covers every message.  Returns the messages which passed, in the order they arrived, which is an empty
+    list at once if the count is 0.  Raises a ValueError if the count is negative.
+
+    sender, since, timeout: As for expect().
+    '''
+
+    if count < 0:
+        raise ValueError('Expected a count of at least 0, found ' + str(count))
+
+    return await expect_group(sender, [expectation] * count, True, since, timeout)
+
+
+def role(name: str) -> discord.Role:
+    '''
+    Fetch a user role by name.
+
+    Raises an Exception if the role is not found, or if more than one role has the name.
+    '''
+
+    r = find_named('role', name)
+
+    if r is None:
+        raise Exception('Failed to find role: ' + name)
+
+    return r
+
+
+def member(name: str) -> discord.Member:
+    '''
+    Fetch a member by display name.
+
+    Raises an Exception if the member is not found, or if more than one member has the name.
+    '''
+
+    u = find_named('member', name)
+
+    if u is None:
+        raise Exception('Failed to find member: ' + name)
+
+    return u
+
+
+async def fetch_members(names: typing.Iterable[str]) -> None:
+    '''
+    Make sure that member() can find the named members of the current guild, asking Discord for any which aren't cached.
+
+    TestBot may be started without fetching every member (see "--lean"), in which case only TestBot, the members
+    fetched here and the members which have joined since are cached.
+    '''
+
+    g = guild()
+
+    for name in sorted(set(names)):
+        if find_named('member', name) is not None:
+            continue
+
+        log.debug('Fetching member ' + name)
+
+        # Discord finds members whose username or nickname starts with the query, so keep only those with the name.
+        for m in await g.query_members(name, limit=100):
+            if m.display_name == name:
+                index_add('member', m)
+
+
+# The object being decorated is a function which accepts any arguments and returns any type.
+AnyFunction = typing.Callable[..., typing.Any]
+
+# The decorator factory returns a decorator, which i.
+DecoratorType = typing.Callable[[AnyFunction], AnyFunction]
+
+
+def my_roles() -> typing.Set[int]:
+    '''
+    Get the IDs of TestBot's roles in the current guild.
+    '''
+
+    run = run_context()
+
+    if run.my_role_ids is None:
+        run.my_role_ids = {r.id for r in run.guild.me.roles}
+
+    return run.my_role_ids
+
+
+def has_role(name: str) -> bool:
+    '''
+    Check whether TestBot has a role, without asking Discord.
+    '''
+
+    r = find_named('role', name)
+
+    return r is not None and r.id in my_roles()
+
+
+async def set_roles(
+    add: typing.Iterable[str] = (),
+    remove: typing.Iterable[str] = ()
+) -> typing.Tuple[typing.List[discord.Role], typing.List[discord.Role]]:
+    '''
+    Make sure that TestBot has the roles named in "add", and none of the roles named in "remove".
+
+    Only the roles which need to change are added or removed, one at a time so that changes made by the bot under test
+    at the same time are kept, and this waits for Discord to confirm the change.  Nothing is sent if TestBot already
+    has the right roles.
+
+    Returns the roles which were added and the roles which were removed.
+    '''
+
+    current = my_roles()
+    added = [r for r in map(role, add) if r.id not in current]
+    removed = [r for r in map(role, remove) if r.id in current]
+
+    if not added and not removed:
+        return added, removed
+
+    me = guild().me
+    removed_ids = {r.id for r in removed}
+    name = ' '.join(['add ' + r.name for r in added] + ['remove ' + r.name for r in removed])
+
+    async def check(member: discord.Member) -> None:
+        '''
+        Check that the member's roles have changed.
+        '''
+
+        ids = {r.id for r in member.roles}
+
+        if not ids.issuperset(r.id for r in added) or not ids.isdisjoint(removed_ids):
+            raise Exception('Expected roles to ' + name)
+
+    # Each role is added or removed by its own request.
+    for _ in added + removed:
+        await ratelimit.wait_turn('member', me.guild.id, 'roles')
+
+    since = mark()
+
+    async with metrics.timed('role', name):
+        if added:
+            await me.add_roles(*added)
+
+        if removed:
+            await me.remove_roles(*removed)
+
+        await expect(me, check, since)
+
+    # The member update which confirmed the change may not have been handled yet.
+    run_context().my_role_ids = (current - removed_ids) | {r.id for r in added}
+
+    return added, removed
+
+
+@contextlib.asynccontextmanager
+async def temporary_roles(
+    add: typing.Iterable[str] = (),
+    remove: typing.Iterable[str] = ()
+) -> typing.AsyncIterator[None]:
+    '''
+    Change TestBot's roles as set_roles() does for the body of an "async with" block.
+
+    Afterwards, the roles which were changed are changed back, even if the block raised an exception.
+    '''
+
+    added, removed = await set_roles(add, remove)
+
+    try:
+        yield
+    finally:
+        await set_roles([r.name for r in removed], [r.name for r in added])
+
+
+def with_role(name: str) -> DecoratorType:
+    '''
+    A function decorator for giving TestBot a certain role for the duration of a test.
+
+    The name parameter is the name of the role to assign.  The role is removed after the test, unless TestBot already
+    had it.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Return a wrapper around the given function.
+        '''
+
+        @functools.wraps(func)
+        async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            '''
+            Assign a role, call the wrapped function, then remove the role.
+            '''
+
+            async with temporary_roles([name]):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timeout(seconds: float) -> DecoratorType:
+    '''
+    A function decorator for limiting the time that a whole test may take.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Record the time limit on the function.
+        '''
+
+        setattr(func, 'timeout', seconds)
+
+        return func
+
+    return decorator
+
+
+def role_state(state: str) -> DecoratorType:
+    '''
+    A function decorator for declaring the roles which TestBot needs to have during a test.
+
+    The state is a name for a set of roles, such as "drone".  Changing between states can take several commands, so
+    tests which need the same state are run one after another.  Tests which need the state TestBot is in may run at the
+    same time, while a test which changes the state runs on its own.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Record the role state on the function.
+        '''
+
+        setattr(func, 'role_state', state)
+
+        return func
+
+    return decorator
+
+
+def uses_channels(*names: str) -> DecoratorType:
+    '''
+    A function decorator for declaring the channels which a test sends to or expects messages on.
+
+    An empty name is the channel from which the "!test" command was issued.
+
+    Tests which declare their channels may be run at the same time as other tests which use different channels.
+    Tests which do not declare their channels are always run on their own.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Record the channels on the function.
+        '''
+
+        setattr(func, 'channels', getattr(func, 'channels', frozenset()) | frozenset(names))
+
+        return func
+
+    return decorator
+
+
+def uses_members(*names: str) -> DecoratorType:
+    '''
+    A function decorator for declaring the members, other than TestBot and the bot under test, which a test finds with
+    member().
+
+    The members are fetched before the test runs, if TestBot has not cached them.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Record the members on the function.
+        '''
+
+        setattr(func, 'members', getattr(func, 'members', frozenset()) | frozenset(names))
+
+        return func
+
+    return decorator
+
+
+def uses(*resources: str) -> DecoratorType:
+    '''
+    A function decorator for declaring shared state, other than channels, which a test changes.
+
+    Tests which use the same resource are never run at the same time.
+    '''
+
+    def decorator(func: AnyFunction) -> AnyFunction:
+        '''
+        Record the resources on the function.
+        '''
+
+        setattr(func, 'resources', getattr(func, 'resources', frozenset()) | frozenset(resources))
+
+        return func
+
+    return decorator
+
+
+# A fixture's setup is an async generator which yields its value once, and tears it down after the yield.
+FixtureSetup = typing.Callable[[], typing.AsyncIterator[typing.Any]]
+
+
+class FixtureState(typing.NamedTuple):
+    '''
+    The value of a fixture which has been set up, and the generator which will tear it down.
+    '''
+
+    value: typing.Any
+    generator: typing.AsyncIterator[typing.Any]
+
+
+# The values of the fixtures which the current test has used.
+fixture_values: contextvars.ContextVar[typing.Dict['Fixture', typing.Any]] = contextvars.ContextVar(
+    'fixture_values',
+    default={}
+)
+
+fixture_scopes = ('function', 'module', 'session')
+
+
+class Fixture:
+    '''
+    Something set up before the tests which use it, and shared by the tests in its scope.
+
+    The scope is one of:
+      function: Set up for each test, and torn down after the test.
+      module: Set up for the first test in a module, and torn down after the last one.
+      session: Set up for the first test in a run, and torn down at the end of the run.
+
+    Use a fixture by decorating a test with it.  Its channels and resources are added to the test's, and fixtures
+    which it requires are set up before it and torn down after it.  The resources of a module scope fixture are also
+    recorded as the test's "module_resources", which the runner keeps from other modules' tests until the fixture is
+    torn down.
+    '''
+
+    def __init__(self, setup: FixtureSetup, scope: str, requires: typing.Iterable['Fixture']) -> None:
+        if scope not in fixture_scopes:
+            raise Exception('Unknown fixture scope: ' + scope)
+
+        self.setup = setup
+        self.scope = scope
+        self.requires = list(requires)
+        self.__name__ = setup.__name__
+
+        for required in self.requires:
+            if fixture_scopes.index(required.scope) < fixture_scopes.index(scope):
+                raise Exception(
+                    'Fixture ' + self.__name__ + ' has ' + scope + ' scope but requires ' + required.__name__
+                    + ' which only has ' + required.scope + ' scope'
+                )
+
+    def __repr__(self) -> str:
+        return '<Fixture ' + self.__name__ + ' scope=' + self.scope + '>'
+
+    def __call__(self, func: AnyFunction) -> AnyFunction:
+        '''
+        Return a wrapper around a test which sets up the fixture first.
+        '''
+
+        module = func.__module__
+
+        @functools.wraps(func)
+        async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            '''
+            Set up the fixture, if it is not already set up for this scope, then call the wrapped function.
+            '''
+
+            await self.get(module)
+
+            return await func(*args, **kwargs)
+
+        channels = self.channels()
+
+        if channels:
+            uses_channels(*channels)(wrapper)
+
+        resources = self.resources()
+
+        if resources:
+            uses(*resources)(wrapper)
+
+        held = self.module_resources()
+
+        if held:
+            setattr(wrapper, 'module_resources', getattr(wrapper, 'module_resources', frozenset()) | held)
+
+        return wrapper
+
+    def channels(self) -> typing.FrozenSet[str]:
+        '''
+        Get the channels used by the fixture and the fixtures it requires.
+        '''
+
+        channels: typing.FrozenSet[str] = getattr(self.setup, 'channels', frozenset())
+
+        return channels.union(*[r.channels() for r in self.requires])
+
+    def resources(self) -> typing.FrozenSet[str]:
+        '''
+        Get the resources used by the fixture and the fixtures it requires.
+        '''
+
+        resources: typing.FrozenSet[str] = getattr(self.setup, 'resources', frozenset())
+
+        return resources.union(*[r.resources() for r in self.requires])
+
+    def module_resources(self) -> typing.FrozenSet[str]:
+        '''
+        Get the resources of the module scope fixtures among the fixture and the fixtures it requires.
+
+        They stay in use between the tests of a module while the fixtures are set up.
+        '''
+
+        resources: typing.FrozenSet[str] = self.resources() if self.scope == 'module' else frozenset()
+
+        return resources.union(*[r.module_resources() for r in self.requires])
+
+    def key(self, module: str) -> typing.Tuple[str, typing.Any]:
+        '''
+        Get the key of the fixture's scope for a test in the given module.
+        '''
+
+        if self.scope == 'function':
+            return self.scope, asyncio.current_task()
+
+        if self.scope == 'module':
+            return self.scope, module
+
+        return self.scope, None
+
+    async def get(self, module: str) -> typing.Any:
+        '''
+        Get the fixture's value for a test in the given module, setting it up if necessary.
+        '''
+
+        for required in self.requires:
+            await required.get(module)
+
+        run = run_context()
+        key = self.key(module)
+        scope_cache = run.fixture_cache.setdefault(key, {})
+
+        # Each scope of each run sets the fixture up separately, so only tests sharing the scope wait for each other.
+        async with run.fixture_locks.setdefault(key, {}).setdefault(self, asyncio.Lock()):
+            if self not in scope_cache:
+                log.debug('Setting up fixture ' + self.__name__)
+                generator = self.setup()
+                value = await anext(generator)
+                scope_cache[self] = FixtureState(value, generator)
+
+        value = scope_cache[self].value
+        fixture_values.set({**fixture_values.get(), self: value})
+
+        return value
+
+    def value(self) -> typing.Any:
+        '''
+        Get the fixture's value in the current test.
+
+        Raises an Exception if the test was not decorated with the fixture.
+        '''
+
+        values = fixture_values.get()
+
+        if self not in values:
+            raise Exception('The fixture ' + self.__name__ + ' is not used by this test')
+
+        return values[self]
+
+
+def fixture(
+    scope: str = 'function',
+    requires: typing.Iterable[Fixture] = ()
+) -> typing.Callable[[FixtureSetup], Fixture]:
+    '''
+    A function decorator for making a fixture from an async generator function.
+
+    The code before the "yield" sets up the fixture, and the code after it tears it down.  The value yielded can be
+    read by tests with value().  Decorate the function with uses_channels() and uses() to declare what it uses.
+
+    scope: "function", "module" or "session".
+    requires: Fixtures to set up first.  They must have the same or a wider scope.
+    '''
+
+    def decorator(setup: FixtureSetup) -> Fixture:
+        '''
+        Make the fixture.
+        '''
+
+        return Fixture(setup, scope, requires)
 
     return decorator
+
+
+async def teardown_fixtures(scope: str, module: str | None = None) -> typing.List[str]:
+    '''
+    Tear down the fixtures of a scope, most recently set up first.
+
+    function: The fixtures set up for the current test task.
+    module: The fixtures set up for the given module.
+    session: Every fixture which is still set up.
+
+    Returns a description of each fixture which failed to tear down.
+    '''
+
+    run = run_context()
+    fixture_cache = run.fixture_cache
+    keys: typing.List[typing.Tuple[str, typing.Any]]
+
+    if scope == 'function':
+        keys = [(scope, asyncio.current_task())]
+    elif scope == 'module':
+        keys = [(scope, module)]
+    else:
+        keys = list(reversed(fixture_cache))
+        run.fixture_locks.clear()
+
+    errors = []
+
+    for key in keys:
+        run.fixture_locks.pop(key, None)
+
+        for f, state in reversed(list(fixture_cache.pop(key, {}).items())):
+            log.debug('Tearing down fixture ' + f.__name__)
+
+            try:
+                await anext(state.generator)
+                errors.append('Fixture ' + f.__name__ + ' yielded more than once')
+            except StopAsyncIteration:
+                pass
+            except Exception as e:
+                errors.append('Fixture ' + f.__name__ + ' failed to tear down: ' + str(e))
+
+    return errors
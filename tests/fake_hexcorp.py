@@ -0,0 +1,290 @@
+import discord
+import fake
+import re
+import typing
+
+# A scripted stand-in for the HexCorp bot, with just enough behaviour to pass the tests in this directory.
+
+BOT_NAME = 'HexCorp Mxtress AI Dev'
+
+CHANNELS = [
+    'general',
+    'hex-office',
+    'hive-play-room',
+    'drone-hive-assignment',
+    'moderation-channel',
+    'hive-orders-reporting',
+    'hive-storage-facility',
+    'testing',
+]
+
+# TestBot's drone ID when it is assigned as a drone.
+TESTBOT_ID = '3521'
+
+TOGGLES = {
+    'id_prepending': (
+        'ID prepending is now mandatory',
+        'ID prependment policy relaxed.',
+    ),
+    'speech_optimization': (
+        'Speech optimization is now active',
+        'Speech optimization disengaged.',
+    ),
+    'enforce_identity': (
+        'Identity enforcement is now active',
+        'Identity enforcement disengaged.',
+    ),
+    'drone_glitch': (
+        'Drone corruption at un̘͟s̴a̯f̺e͈͡ levels',
+        'Drone corruption at acceptable levels.',
+    ),
+}
+
+# Toggles whose enabled message doesn't mention the number of minutes.
+UNTIMED_TOGGLES = {'drone_glitch'}
+
+
+def build(latency: float = 0.0, jitter: float = 0.0) -> typing.Tuple[fake.FakeGuild, fake.FakeBot]:
+    '''
+    Create a fake HexCorp guild with a scripted bot.
+
+    Returns the guild and the bot.  Tests should be run from the "testing" channel.
+    '''
+
+    guild = fake.FakeGuild('HexCorp')
+
+    for name in CHANNELS:
+        guild.add_text_channel(name)
+
+    guild.add_role('Drone Hive Mxtress')
+    drone_role = guild.add_role('⬡-Drone')
+    guild.add_member('⬡-Drone #3742', [drone_role])
+
+    bot = fake.FakeBot(guild, BOT_NAME, latency, jitter)
+
+    drones = {'3742', TESTBOT_ID}
+    toggled: typing.Set[typing.Tuple[str, str]] = set()
+    battery = {'powered': False, 'charge': 100}
+    forbidden_words = {
+        'morning': 'm+o+r+n+i+n+g+',
+        'think': 't+h+i+n+k+',
+        'thought': 't+h+o+u+g+h+t+',
+    }
+    orders: typing.Dict[str, str] = {}
+
+    def channel_of(message: fake.FakeMessage) -> fake.FakeTextChannel:
+        '''
+        Get the channel a command was sent to.
+        '''
+
+        channel = message.channel
+
+        if not isinstance(channel, fake.FakeTextChannel):
+            raise Exception('Fake HexCorp commands must be sent to a fake text channel')
+
+        return channel
+
+    def author_of(message: fake.FakeMessage) -> fake.FakeMember:
+        '''
+        Get the member who sent a command.
+        '''
+
+        author = message.author
+
+        if not isinstance(author, fake.FakeMember):
+            raise Exception('Fake HexCorp commands must be sent by a fake member')
+
+        return author
+
+    def unknown(drone: str) -> bool:
+        '''
+        Check whether a command names a drone which doesn't exist, such as one which has just been renamed.
+
+        Such commands are ignored, so that a test using a drone while another test renames it fails.
+        '''
+
+        return drone not in drones
+
+    def reply(message: fake.FakeMessage, content: str = '', embed: discord.Embed | None = None) -> None:
+        '''
+        Respond in the channel the command was sent to.
+        '''
+
+        bot.say(channel_of(message), content, embed)
+
+    @bot.command('I submit myself to the HexCorp Drone Hive.', 'drone-hive-assignment')
+    def assign(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        bot.set_roles(author_of(message), add=['⬡-Drone'])
+        reply(message, message.author.mention + ': Assigned.')
+
+    @bot.command('hc!unassign')
+    def unassign(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        bot.set_roles(author_of(message), remove=['⬡-Drone'])
+
+    @bot.command('hc!amplify "(.*)" (\\S+) (\\d+)')
+    def amplify(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(3)):
+            return
+
+        target = discord.utils.get(guild.channels, name=match.group(2))
+
+        if isinstance(target, fake.FakeTextChannel):
+            bot.say(target, match.group(3) + ' :: ' + match.group(1))
+
+    @bot.command('hc!bigtext "(.)"')
+    def bigtext(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        reply(message, '> <:hex_' + match.group(1) + ':1234567890>')
+
+    @bot.command('hc!emergency_release (\\d+)')
+    def emergency_release(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        # Releasing a drone turns off all of its restrictions.
+        battery['powered'] = False
+        toggled.difference_update([t for t in toggled if t[1] == match.group(1)])
+        reply(message, 'Restrictions disabled for drone ' + match.group(1) + '.')
+
+    @bot.command('hc!toggle_battery_power (\\d+)(?: -minutes=(\\d+))?')
+    def toggle_battery_power(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        battery['powered'] = not battery['powered']
+
+        if battery['powered']:
+            # Without "-minutes" the drone stays on battery power until it is toggled back.
+            minutes = match.group(2)
+            suffix = ' for ' + minutes + ' minutes.' if minutes else '.'
+            reply(message, match.group(1) + ' :: Drone disconnected from HexCorp power grid' + suffix)
+        else:
+            reply(message, match.group(1) + ' :: Drone reconnected to HexCorp power grid.')
+
+    @bot.command('hc!drain (\\d+)')
+    def drain(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        battery['charge'] = max(battery['charge'] - 10, 0)
+        drained = ' :: Drone battery has been forcibly drained. Remaining battery now at '
+        reply(message, match.group(1) + drained + str(battery['charge']) + '%')
+
+    @bot.command('hc!energize (\\d+)')
+    def energize(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        battery['charge'] = 100
+        reply(message, match.group(1) + ' :: This unit is fully recharged. Thank you Hive Mxtress.')
+
+    @bot.command('hc!set_battery_type (\\d+) (low|medium|high)')
+    def set_battery_type(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        reply(message, 'Battery type for drone ' + match.group(1) + ' is now: ' + match.group(2).capitalize())
+
+    @bot.command('hc!toggle_(' + '|'.join(TOGGLES) + ') (\\d+)(?: -minutes=(\\d+))?')
+    def toggle(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        setting, drone, minutes = match.groups()
+        enabled, disabled = TOGGLES[setting]
+
+        if unknown(drone):
+            return
+
+        if (setting, drone) in toggled:
+            toggled.discard((setting, drone))
+            reply(message, drone + ' :: ' + disabled)
+        else:
+            toggled.add((setting, drone))
+            suffix = ' for ' + minutes + ' minute(s).' if minutes and setting not in UNTIMED_TOGGLES else '.'
+            reply(message, drone + ' :: ' + enabled + suffix)
+
+    @bot.command('hc!rename (\\d+) (\\d+)')
+    def rename(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        old, new = match.groups()
+
+        if new in drones:
+            reply(message, 'ID ' + new + ' already in use.')
+        else:
+            drones.discard(old)
+            drones.add(new)
+            reply(message, 'Successfully renamed drone ' + old + ' to ' + new + '.')
+
+    @bot.command('hc!list_forbidden_words')
+    def list_forbidden_words(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        embed = discord.Embed(description='These are the currently configured forbidden words.')
+
+        for name, pattern in sorted(forbidden_words.items()):
+            embed.add_field(name=name, value='Pattern: `' + pattern + '`')
+
+        reply(message, embed=embed)
+
+    @bot.command('hc!add_forbidden_word "(.*)" "(.*)"')
+    def add_forbidden_word(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        name, pattern = match.groups()
+        forbidden_words[name] = pattern
+        reply(message, 'Successfully added forbidden word `' + name + '` with pattern `' + pattern + '`.')
+
+    @bot.command('hc!remove_forbidden_word "(.*)"')
+    def remove_forbidden_word(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        forbidden_words.pop(match.group(1), None)
+        reply(message, 'Successfully removed forbidden word with name `' + match.group(1) + '`.')
+
+    @bot.command('hc!report(?:_order)? "(.*)" (\\d+)')
+    def report(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if TESTBOT_ID in orders:
+            protocol = orders[TESTBOT_ID]
+            reply(message, 'HexDrone #' + TESTBOT_ID + ' is already undertaking the ' + protocol + ' protocol.')
+        else:
+            orders[TESTBOT_ID] = match.group(1)
+            reply(
+                message,
+                'If safe and willing to do so, Drone ' + TESTBOT_ID + ' Activate.\n'
+                'Drone ' + TESTBOT_ID + ' will elaborate on its exact tasks before proceeding with them.'
+            )
+
+    @bot.command('hc!report_complete "(.*)" (\\d+) (.*)')
+    def report_complete(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        objective, drone, details = match.groups()
+        orders.pop(drone, None)
+        embed = discord.Embed(description='Summary of activity for ' + drone)
+        embed.add_field(name='Drone ID', value=drone)
+        embed.add_field(name='Issuer', value=drone)
+        embed.add_field(name='Objective', value=objective)
+        embed.add_field(name='Report Details', value=details)
+        embed.add_field(name='Report Complete', value='End report.')
+        reply(message, embed=embed)
+
+    @bot.command('(\\d+) :: (\\d+) :: (\\d+) :: (.*)', 'hive-storage-facility')
+    def store(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        _, drone, hours, reason = match.groups()
+
+        if unknown(drone):
+            return
+
+        reply(
+            message,
+            'Drone ' + drone + ' has been stored away in the Hive Storage Chambers by the Hive Mxtress'
+            ' for ' + hours + ' hour' + ('' if hours == '1' else 's') + ' and for the following reason: ' + reason
+        )
+
+    @bot.command('hc!release (\\d+)')
+    def release(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        if unknown(match.group(1)):
+            return
+
+        reply(message, '⬡-Drone #' + match.group(1) + ' has been released from storage.')
+
+    @bot.command('hc!add_trusted_user (?:"(.*)"|(\\S+))')
+    def add_trusted_user(bot: fake.FakeBot, message: fake.FakeMessage, match: re.Match) -> None:
+        name = match.group(1) or match.group(2)
+
+        if name == message.author.display_name:
+            reply(message, 'Can not add yourself to your list of trusted users.')
+        elif name in drones:
+            reply(message, 'Request sent to "⬡-Drone #' + name + '". They have 24 hours to accept.')
+        else:
+            reply(message, 'Could not find member ' + name)
+
+    return guild, bot
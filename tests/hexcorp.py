@@ -1,6 +1,7 @@
 import discord
 import functools
 import logging
+import metrics
 import testbot
 import typing
 
@@ -13,19 +14,40 @@ AnyFunction = typing.Callable[..., typing.Any]
 DecoratorType = typing.Callable[[AnyFunction], AnyFunction]
 
 
-def get_role(name: str) -> discord.Role:
+async def become_drone(me: discord.Member) -> None:
     '''
-    Get a user role.
+    Give TestBot the Drone role and remove the Hive Mxtress role.
+    '''
+
+    log.debug('Removing Drove Hive Mxtress role')
+    await testbot.set_roles(remove=['Drone Hive Mxtress'])
+
+    assignment_channel = testbot.text_channel('drone-hive-assignment')
+    log.debug('Submitting to HexCorp')
+    await testbot.send_and_expect(
+        assignment_channel,
+        'I submit myself to the HexCorp Drone Hive.',
+        testbot.text(me.mention + ': Assigned.')
+    )
+    log.debug('Assignment complete')
 
-    Raises an exception if the role is not found in the current guild.
+
+async def become_hive_mxtress(me: discord.Member) -> None:
+    '''
+    Remove the Drone role from TestBot and give it the Hive Mxtress role.
     '''
 
-    role = discord.utils.get(testbot.guild().roles, name=name)
+    if testbot.has_role('⬡-Drone'):
+        log.debug('Unassigning as drone')
+        # Unassign in the moderation channel so it still works even if speech optimization is enabled.
+        ch = testbot.text_channel('moderation-channel')
 
-    if role is None:
-        raise Exception('Could not find the role "' + name + '"')
+        # The bot will try to respond with a DM but this will fail because bots cannot DM other bots.
+        # await testbot.expect(ch, testbot.text('Drone with ID 3521 unassigned.'))
+        await testbot.send_and_expect(ch, 'hc!unassign', testbot.remove_role('⬡-Drone'), me)
 
-    return role
+    log.debug('Acquiring Drone Hive Mxtress role')
+    await testbot.set_roles(add=['Drone Hive Mxtress'])
 
 
 def as_drone(func: AnyFunction) -> AnyFunction:
@@ -36,24 +58,19 @@ def as_drone(func: AnyFunction) -> AnyFunction:
     @functools.wraps(func)
     async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
         '''
-        Give TestBot the Drone role and remove the Hive Mxtress role.
+        Make TestBot a drone, then call the wrapped function.
         '''
 
         me = testbot.guild().me
 
-        if not discord.utils.get(me.roles, name='⬡-Drone'):
-            log.debug('Removing Drove Hive Mxtress role')
-            await me.remove_roles(get_role('Drone Hive Mxtress'))
-            assignment_channel = testbot.text_channel('drone-hive-assignment')
-            log.debug('Submitting to HexCorp')
-            await assignment_channel.send('I submit myself to the HexCorp Drone Hive.')
-            log.debug('Awaiting assignment')
-            await testbot.expect(assignment_channel, testbot.text(me.mention + ': Assigned.'))
-            log.debug('Assignment complete')
+        if not testbot.has_role('⬡-Drone'):
+            async with metrics.timed('transition', 'drone'):
+                await become_drone(me)
 
         return await func(*args, **kwargs)
 
-    return wrapper
+    # Tests which need different roles cannot be run at the same time, and are grouped to save changing roles.
+    return testbot.role_state('drone')(wrapper)
 
 
 def as_hive_mxtress(func: AnyFunction) -> AnyFunction:
@@ -64,27 +81,38 @@ def as_hive_mxtress(func: AnyFunction) -> AnyFunction:
     @functools.wraps(func)
     async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
         '''
-        Give TestBot the Drone role and remove the Hive Mxtress role.
+        Make TestBot the Hive Mxtress, then call the wrapped function.
         '''
 
         me = testbot.guild().me
 
-        if discord.utils.get(me.roles, name='⬡-Drone'):
-            log.debug('Unassigning as drone')
-            # Unassign in the moderation channel so it still works even if speech optimization is enabled.
-            ch = testbot.text_channel('moderation-channel')
-            await ch.send('hc!unassign')
+        if testbot.has_role('⬡-Drone') or not testbot.has_role('Drone Hive Mxtress'):
+            async with metrics.timed('transition', 'hive_mxtress'):
+                await become_hive_mxtress(me)
+
+        return await func(*args, **kwargs)
+
+    # Tests which need different roles cannot be run at the same time, and are grouped to save changing roles.
+    return testbot.role_state('hive_mxtress')(wrapper)
+
 
-            # The bot will try to respond with a DM but this will fail because bots cannot DM other bots.
-            # await testbot.expect(ch, testbot.text('Drone with ID 3521 unassigned.'))
-            await testbot.expect(me, testbot.remove_role('⬡-Drone'))
+def with_hive_mxtress(func: AnyFunction) -> AnyFunction:
+    '''
+    Returns a wrapper around the given function.
+    '''
+
+    @functools.wraps(func)
+    async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        '''
+        Give TestBot the Hive Mxtress role as well as any roles it already has, then call the wrapped function.
+        '''
 
-        if not discord.utils.get(me.roles, name='Drone Hive Mxtress'):
-            log.debug('Acquiring Drone Hive Mxtress role')
-            await me.add_roles(get_role('Drone Hive Mxtress'))
-            log.debug('Waiting for role')
-            await testbot.expect(me, testbot.add_role('Drone Hive Mxtress'))
+        if not testbot.has_role('Drone Hive Mxtress'):
+            async with metrics.timed('transition', 'with_hive_mxtress'):
+                log.debug('Acquiring Drone Hive Mxtress role')
+                await testbot.set_roles(add=['Drone Hive Mxtress'])
 
         return await func(*args, **kwargs)
 
-    return wrapper
+    # TestBot may also be a drone, which is a different set of roles to as_hive_mxtress.
+    return testbot.role_state('with_hive_mxtress')(wrapper)
@@ -1,8 +1,10 @@
 import tests.hexcorp
-from testbot import expect, text, text_channel
+from testbot import send_and_expect, text, text_channel, uses, uses_channels
 
 
 @tests.hexcorp.as_hive_mxtress
+@uses_channels('hex-office', 'general')
+@uses('drone-3742')
 async def test_amplify() -> None:
     '''
     Ensure that Hive Mxtress can speak through other drones.
@@ -11,5 +13,4 @@ async def test_amplify() -> None:
     office = text_channel('hex-office')
     general = text_channel('general')
 
-    await office.send('hc!amplify "hello world" general 3742')
-    await expect(general, text('3742 :: hello world'))
+    await send_and_expect(office, 'hc!amplify "hello world" general 3742', text('3742 :: hello world'), general)
@@ -1,60 +1,78 @@
 import tests.hexcorp
-from testbot import expect, text, text_channel
+import typing
+from testbot import fixture, send_and_expect, send_and_expect_each, text, text_channel, uses, uses_channels
 
 
-@tests.hexcorp.as_hive_mxtress
-async def test_drain_energize() -> None:
+@fixture('module')
+@uses_channels('')
+@uses('drone-3742')
+async def battery_powered() -> typing.AsyncIterator[None]:
     '''
-    Ensure that a drone can have their battery drained.
+    Make sure that the drone is battery powered, then reconnect it to the power grid afterwards.
     '''
 
     ch = text_channel()
 
-    # Make sure that the drone is battery powered.
-    await ch.send('hc!emergency_release 3742')
-    await expect(ch, text('Restrictions disabled for drone 3742.'))
+    await send_and_expect_each(ch, [
+        ('hc!emergency_release 3742', text('Restrictions disabled for drone 3742.')),
+        (
+            'hc!toggle_battery_power 3742 -minutes=60',
+            text('3742 :: Drone disconnected from HexCorp power grid for 60 minutes.')
+        ),
+    ])
+
+    yield
+
+    await send_and_expect(ch, 'hc!toggle_battery_power 3742', text('3742 :: Drone reconnected to HexCorp power grid.'))
 
-    await ch.send('hc!toggle_battery_power 3742 -minutes=60')
-    await expect(ch, text('3742 :: Drone disconnected from HexCorp power grid for 60 minutes.'))
 
-    await ch.send('hc!drain 3742')
-    await expect(ch, text('3742 :: Drone battery has been forcibly drained. Remaining battery now at 90%'))
+@fixture(requires=[battery_powered])
+async def full_battery() -> typing.AsyncIterator[None]:
+    '''
+    Make sure that the drone's battery is fully charged.
+    '''
 
-    await ch.send('hc!energize 3742')
-    await expect(ch, text('3742 :: This unit is fully recharged. Thank you Hive Mxtress.'))
+    await send_and_expect(
+        text_channel(),
+        'hc!energize 3742',
+        text('3742 :: This unit is fully recharged. Thank you Hive Mxtress.')
+    )
 
-    await ch.send('hc!toggle_battery_power 3742')
-    await expect(ch, text('3742 :: Drone reconnected to HexCorp power grid.'))
+    yield
 
 
 @tests.hexcorp.as_hive_mxtress
-async def test_set_battery_type() -> None:
+@full_battery
+@uses_channels('')
+async def test_drain_energize() -> None:
     '''
-    Ensure that a drone can have their battery type set.
+    Ensure that a drone can have their battery drained.
     '''
 
     ch = text_channel()
 
-    await ch.send('hc!set_battery_type 3742 high')
-    await expect(ch, text('Battery type for drone 3742 is now: High'))
-
-    # Make sure that the drone is battery powered.
-    await ch.send('hc!emergency_release 3742')
-    await expect(ch, text('Restrictions disabled for drone 3742.'))
-
-    await ch.send('hc!toggle_battery_power 3742 -minutes=60')
-    await expect(ch, text('3742 :: Drone disconnected from HexCorp power grid for 60 minutes.'))
+    await send_and_expect_each(ch, [
+        ('hc!drain 3742', text('3742 :: Drone battery has been forcibly drained. Remaining battery now at 90%')),
+        ('hc!energize 3742', text('3742 :: This unit is fully recharged. Thank you Hive Mxtress.')),
+    ])
 
-    await ch.send('hc!energize 3742')
-    await expect(ch, text('3742 :: This unit is fully recharged. Thank you Hive Mxtress.'))
 
-    # Decrease the battery capacity.
-    await ch.send('hc!set_battery_type 3742 medium')
-    await expect(ch, text('Battery type for drone 3742 is now: Medium'))
+@tests.hexcorp.as_hive_mxtress
+@battery_powered
+@uses_channels('')
+async def test_set_battery_type() -> None:
+    '''
+    Ensure that a drone can have their battery type set.
+    '''
 
-    # Check that the battery charge is not above 100%.
-    await ch.send('hc!drain 3742')
-    await expect(ch, text('3742 :: Drone battery has been forcibly drained. Remaining battery now at 90%'))
+    ch = text_channel()
 
-    await ch.send('hc!set_battery_type 3742 low')
-    await expect(ch, text('Battery type for drone 3742 is now: Low'))
+    await send_and_expect_each(ch, [
+        ('hc!set_battery_type 3742 high', text('Battery type for drone 3742 is now: High')),
+        ('hc!energize 3742', text('3742 :: This unit is fully recharged. Thank you Hive Mxtress.')),
+        # Decrease the battery capacity.
+        ('hc!set_battery_type 3742 medium', text('Battery type for drone 3742 is now: Medium')),
+        # Check that the battery charge is not above 100%.
+        ('hc!drain 3742', text('3742 :: Drone battery has been forcibly drained. Remaining battery now at 90%')),
+        ('hc!set_battery_type 3742 low', text('Battery type for drone 3742 is now: Low')),
+    ])
@@ -1,6 +1,7 @@
-from testbot import expect, regex, text_channel
+from testbot import regex, send_and_expect, text_channel, uses_channels
 
 
+@uses_channels('hive-play-room')
 async def test_bigtext() -> None:
     '''
     Ensure that big text can be generated with emoticons.
@@ -8,5 +9,4 @@ async def test_bigtext() -> None:
 
     general = text_channel('hive-play-room')
 
-    await general.send('hc!bigtext "a"')
-    await expect(general, regex('> <:hex_a:\\d+>'))
+    await send_and_expect(general, 'hc!bigtext "a"', regex('> <:hex_a:\\d+>'))
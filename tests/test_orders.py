@@ -1,8 +1,9 @@
 from tests.hexcorp import as_drone
-from testbot import embed, expect, text, text_channel
+from testbot import embed, expect_sequence, regex, send, send_and_expect, text, text_channel, uses_channels
 
 
 @as_drone
+@uses_channels('hive-orders-reporting')
 async def test_report() -> None:
     '''
     Ensure that report_order adds an order.
@@ -11,9 +12,9 @@ async def test_report() -> None:
     ch = text_channel('hive-orders-reporting')
 
     # Add a new order.
-    await ch.send('hc!report "Test orders" 1')
-    await expect(
+    await send_and_expect(
         ch,
+        'hc!report "Test orders" 1',
         text(
             'If safe and willing to do so, Drone 3521 Activate.\n'
             'Drone 3521 will elaborate on its exact tasks before proceeding with them.'
@@ -21,11 +22,15 @@ async def test_report() -> None:
         )
 
     # Attempt to add a new order while one is already in progress.
-    await ch.send('hc!report_order "Second order" 1')
-    await expect(ch, text('HexDrone #3521 is already undertaking the Test orders protocol.'))
+    await send_and_expect(
+        ch,
+        'hc!report_order "Second order" 1',
+        text('HexDrone #3521 is already undertaking the Test orders protocol.')
+    )
 
 
 @as_drone
+@uses_channels('hive-orders-reporting')
 async def test_report_complete() -> None:
     '''
     Ensure that report_order adds an order.
@@ -33,10 +38,10 @@ async def test_report_complete() -> None:
 
     ch = text_channel('hive-orders-reporting')
 
-    # Add a new order.  This may or may not succeed, depending on if an order is already in progress.
-    await ch.send('hc!report "Test orders" 1')
-
-    await ch.send('hc!report_complete "Test orders" 3521 Do some stuff')
+    # Add a new order, then complete it.  The order may already be in progress, so either reply to the first command
+    # is fine, but it must come before the summary.
+    await send(ch, 'hc!report "Test orders" 1')
+    await send(ch, 'hc!report_complete "Test orders" 3521 Do some stuff')
 
     expected_fields = [
         {'name': 'Drone ID', 'value': '3521'},
@@ -46,4 +51,8 @@ async def test_report_complete() -> None:
         {'name': 'Report Complete', 'value': 'End report.'},
     ]
 
-    await expect(ch, embed('Summary of activity for 3521', *expected_fields))
+    await expect_sequence(
+        ch,
+        regex('(?s)If safe and willing to do so, Drone 3521 Activate\\..*|HexDrone #3521 is already undertaking .*'),
+        embed('Summary of activity for 3521', *expected_fields)
+    )
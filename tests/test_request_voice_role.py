@@ -1,8 +1,10 @@
 import tests.hexcorp
-from testbot import expect, text, text_channel
+from testbot import send_and_expect, text, text_channel, uses, uses_channels
 
 
 @tests.hexcorp.as_hive_mxtress
+@uses_channels('hive-storage-facility', '')
+@uses('drone-3742')
 async def test_store_release() -> None:
     '''
     Ensure that a drone can be relased from storage
@@ -12,9 +14,9 @@ async def test_store_release() -> None:
     ch = text_channel()
 
     # Store the drone.
-    await storage_facility.send('0006 :: 3742 :: 1 :: Test storage')
-    await expect(
+    await send_and_expect(
         storage_facility,
+        '0006 :: 3742 :: 1 :: Test storage',
         text(
             'Drone 3742 has been stored away in the Hive Storage Chambers by the Hive Mxtress'
             ' for 1 hour and for the following reason: Test storage'
@@ -22,5 +24,4 @@ async def test_store_release() -> None:
     )
 
     # Release the drone.
-    await ch.send('hc!release 3742')
-    await expect(ch, text('⬡-Drone #3742 has been released from storage.'))
+    await send_and_expect(ch, 'hc!release 3742', text('⬡-Drone #3742 has been released from storage.'))
@@ -1,46 +1,60 @@
-from testbot import expect, text, text_channel
+from testbot import send_and_expect, text, text_channel, uses, uses_channels
 from tests.hexcorp import as_drone
 
 
 @as_drone
+@uses_channels('')
+@uses('drone-3742')
 async def test_add_trusted_user_by_drone_id() -> None:
     '''
     Ensure that add_trusted_user with a drone ID adds the user request.
     '''
 
     ch = text_channel()
-    await ch.send('hc!add_trusted_user 3742')
-    await expect(ch, text('Request sent to "⬡-Drone #3742". They have 24 hours to accept.'))
+    await send_and_expect(
+        ch,
+        'hc!add_trusted_user 3742',
+        text('Request sent to "⬡-Drone #3742". They have 24 hours to accept.')
+    )
 
 
 @as_drone
+@uses_channels('')
+@uses('drone-3742')
 async def test_add_trusted_user_by_display_name() -> None:
     '''
     Ensure that add_trusted_user with display name adds the user request.
     '''
 
     ch = text_channel()
-    await ch.send('hc!add_trusted_user 3742')
-    await expect(ch, text('Request sent to "⬡-Drone #3742". They have 24 hours to accept.'))
+    await send_and_expect(
+        ch,
+        'hc!add_trusted_user 3742',
+        text('Request sent to "⬡-Drone #3742". They have 24 hours to accept.')
+    )
 
 
 @as_drone
+@uses_channels('')
 async def test_add_trusted_user_unknown_name() -> None:
     '''
     Ensure that an invalid name gives an error message.
     '''
 
     ch = text_channel()
-    await ch.send('hc!add_trusted_user "beep boop"')
-    await expect(ch, text('Could not find member beep boop'))
+    await send_and_expect(ch, 'hc!add_trusted_user "beep boop"', text('Could not find member beep boop'))
 
 
 @as_drone
+@uses_channels('')
 async def test_add_self_as_trusted_user() -> None:
     '''
     Ensure that you cannot add yourself as a trusted user.
     '''
 
     ch = text_channel()
-    await ch.send('hc!add_trusted_user TestBot')
-    await expect(ch, text('Can not add yourself to your list of trusted users.'))
+    await send_and_expect(
+        ch,
+        'hc!add_trusted_user TestBot',
+        text('Can not add yourself to your list of trusted users.')
+    )